@@ -2,6 +2,7 @@
 # timeline -> files
 
 import os
+import struct
 #import csv
 import numpy as np
 import pandas as pd
@@ -21,19 +22,70 @@ class acoustic_recorder(object):
             self._load_logger_head(path)
 
     def __getitem__(self,t):
-        df = self._map(t).reset_index()
-        s = None
-        for f in df['file_path']:
-            if s is None:
-                s = Signal.from_wav(f)
-            else:
-                s = join(s, Signal.from_wav(f))
-        # further triming
-        i0 = int( (t.start - df['time'].iloc[0]).seconds*s.fs )
-        i1 = int( (df['time'].iloc[-1] - t.stop).seconds*s.fs )
-        s = Signal(s[i0:i1], s.fs)
-        t = df['time'].iloc[0] + pd.Timedelta( i0/s.fs ,unit='seconds')
-        return s, t
+        ''' Signal over a time slice, normalized by its maximum, and time of
+        its first sample
+        '''
+        return self.read(t.start, t.stop, normalize=True)
+
+    def read(self, start, stop, normalize=False):
+        ''' Read samples between two times across files
+
+        Only the required samples are read: WAV data chunks are memory-mapped
+        and samples are copied into a single buffer. Files are assumed to be
+        contiguous in time, their start time is given by their name.
+
+        Parameters
+        ----------
+        start, stop: pd.Timestamp or str
+        normalize: boolean
+            Divide by the maximum absolute value, otherwise samples are
+            scaled to [-1, 1] according to the sample format
+
+        Returns
+        -------
+        s: Signal
+            None if no sample is found
+        t: pd.Timestamp
+            time of the first sample (sub-second accuracy)
+        '''
+        start, stop = pd.Timestamp(start), pd.Timestamp(stop)
+        tf = self.df.index.values.astype('datetime64[ns]')
+        paths = self.df['file_path'].values
+        # files starting before stop, from the last one starting before start
+        i0 = max(np.searchsorted(tf, np.datetime64(start, 'ns'), side='right')-1, 0)
+        i1 = np.searchsorted(tf, np.datetime64(stop, 'ns'), side='right')
+        pieces = []
+        for path, t in zip(paths[i0:i1], tf[i0:i1]):
+            h = self._header(path)
+            if pieces and h['fs'] != pieces[0][0]['fs']:
+                raise ValueError('Sampling frequency changes in '+path)
+            # first sample at or after start, up to the first sample at or after stop
+            a = _ceil_samples((np.datetime64(start, 'ns')-t).astype(np.int64), h['fs'])
+            b = _ceil_samples((np.datetime64(stop, 'ns')-t).astype(np.int64), h['fs'])
+            a, b = min(max(a, 0), h['nframes']), min(max(b, 0), h['nframes'])
+            if b > a:
+                pieces.append((h, a, b, t))
+        if not pieces:
+            return None, None
+        h, a, b, t = pieces[0]
+        fs = h['fs']
+        data = np.empty((sum(p[2]-p[1] for p in pieces), h['channels']), dtype=np.float32)
+        k = 0
+        for p in pieces:
+            data[k:k+p[2]-p[1]] = read_wav_frames(*p[:3])
+            k += p[2]-p[1]
+        t = pd.Timestamp(t) + pd.Timedelta(int(round(a*1e9/fs)), unit='ns')
+        data = data[:,0] if data.shape[1] == 1 else data.T
+        if normalize:
+            data /= np.max(np.abs(data)) or 1.
+        return Signal(data, fs), t
+
+    def _header(self, path):
+        if not hasattr(self, '_headers'):
+            self._headers = {}
+        if path not in self._headers:
+            self._headers[path] = read_wav_header(path)
+        return self._headers[path]
 
     def _load_logger_head(self, path):
         # load CSV file
@@ -43,11 +95,12 @@ class acoustic_recorder(object):
                          comment='f')
         df = df.set_index('file_name')
         # list files actually available:
-        dfiles = pd.DataFrame()
+        file_path, file_name = [], []
         for dirname, dirnames, filenames in os.walk(path):
             if dirname != path:
-                dfiles = dfiles.append(pd.DataFrame({'file_path': [os.path.join(dirname, f) for f in filenames if '.wav' in f],
-                                                     'file_name': [f for f in filenames if '.wav' in f]}), ignore_index=True)
+                file_path += [os.path.join(dirname, f) for f in filenames if '.wav' in f]
+                file_name += [f for f in filenames if '.wav' in f]
+        dfiles = pd.DataFrame({'file_path': file_path, 'file_name': file_name})
         dfiles = dfiles.set_index('file_name')
         #
         df = pd.concat([dfiles, df], join='inner', axis=1)
@@ -80,3 +133,88 @@ def join(s1, s2):
     '''
     assert s1.fs == s2.fs
     return Signal(np.concatenate([s1,s2]), fs=s1.fs)
+
+def _ceil_samples(dt_ns, fs):
+    ''' Index of the first sample at or after dt_ns nanoseconds '''
+    return -((-int(dt_ns)*int(fs))//10**9)
+
+def read_wav_header(path):
+    ''' Parse the header of a WAV file
+
+    Returns
+    -------
+    h: dict
+        path, fs, channels, bits, dtype, offset (of the data chunk in bytes),
+        nframes
+    '''
+    with open(path, 'rb') as f:
+        riff, size, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(path+' is not a WAV file')
+        fmt = None
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                raise ValueError('No data chunk in '+path)
+            cid, csize = struct.unpack('<4sI', head)
+            if cid == b'fmt ':
+                b = f.read(csize + csize%2)
+                tag, channels, fs, _, align, bits = struct.unpack('<HHIIHH', b[:16])
+                if tag == 0xFFFE and csize >= 26:
+                    # WAVE_FORMAT_EXTENSIBLE, format in the sub-format GUID
+                    tag = struct.unpack('<H', b[24:26])[0]
+                fmt = (tag, channels, fs, align, bits)
+            elif cid == b'data':
+                offset = f.tell()
+                # size may be wrong in truncated files
+                csize = min(csize, os.fstat(f.fileno()).st_size - offset)
+                break
+            else:
+                f.seek(csize + csize%2, 1)
+    if fmt is None:
+        raise ValueError('No fmt chunk in '+path)
+    tag, channels, fs, align, bits = fmt
+    if tag == 1 and bits in _pcm_dtypes:
+        dtype = _pcm_dtypes[bits]
+    elif tag == 3 and bits in [32, 64]:
+        dtype = '<f%d'%(bits//8)
+    else:
+        raise ValueError('Unsupported WAV format (tag %d, %d bits) in %s'%(tag, bits, path))
+    return {'path': path, 'fs': fs, 'channels': channels, 'bits': bits, 'dtype': dtype,
+            'offset': offset, 'nframes': csize//align}
+
+_pcm_dtypes = {8: 'u1', 16: '<i2', 24: 'u1', 32: '<i4'}
+
+def read_wav_frames(h, i0, i1):
+    ''' Read frames i0 to i1 (excluded) of a WAV file from its memory-mapped
+    data chunk, scaled to [-1, 1] for integer formats
+
+    Parameters
+    ----------
+    h: dict
+        output of read_wav_header
+
+    Returns
+    -------
+    data: np.ndarray
+        float32 array with shape (i1-i0, channels)
+    '''
+    nch = h['channels']
+    if h['bits'] == 24:
+        mm = np.memmap(h['path'], dtype='u1', mode='r', offset=h['offset'],
+                       shape=(h['nframes'], nch, 3))
+        b = mm[i0:i1].astype(np.int32)
+        x = b[...,0] | (b[...,1] << 8) | (b[...,2] << 16)
+        # sign extension
+        x = (x << 8) >> 8
+        data = x.astype(np.float32)/2**23
+    else:
+        mm = np.memmap(h['path'], dtype=h['dtype'], mode='r', offset=h['offset'],
+                       shape=(h['nframes'], nch))
+        data = mm[i0:i1].astype(np.float32)
+        if h['bits'] == 8:
+            data = (data-128.)/128.
+        elif h['dtype'][1] == 'i':
+            data /= 2**(h['bits']-1)
+    del mm
+    return data
@@ -15,11 +15,10 @@ import copy
 import datetime
 
 import pandas as pd
-import pynmea2
 
 # cognac data and tools
 #from data import *
-from .utils import gps_data
+from .gps import read_gps_tois
 
 
 # flag controlling the production or not of figures
@@ -35,32 +34,10 @@ prtfig=True
 
 # shouldn't this be in utils?
 
-def read_logger_file(file, verbose=False):
-
-    # init gps container
-    gps = gps_data()
-
-    if isinstance(file, list):
-
-        for f in file:
-            gps = gps + read_logger_file(f)
-
-    else:
-
-        print('Reads ' + file)
-
-        gpsfile = pynmea2.NMEAFile(file)
-
-        data = pd.DataFrame()
-        for d in gpsfile:
-            if verbose:
-                print(d)
-            time = datetime.datetime.combine(d.datestamp, d.timestamp)
-            data = data.append({'lon': d.longitude, 'lat': d.latitude, 'time': time}, ignore_index=True)
-        #
-        gps.d = data.set_index('time')
-
-    return gps
+def read_logger_file(file, verbose=False, max_workers=None):
+    ''' Read gps logger files, see gps.read_gps_tois
+    '''
+    return read_gps_tois(file, verbose=verbose, max_workers=max_workers)
 
 
 #
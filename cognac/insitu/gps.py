@@ -2,10 +2,11 @@
 # ------------------------- GPS data -----------------------------------
 #
 
+import numpy as np
 import pandas as pd
-import pynmea2
 import pickle
 import copy
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib.pyplot as plt
 from  matplotlib.dates import date2num, datetime, num2date
@@ -21,9 +22,68 @@ gps_attrs = ['d']
 
 class gps(object):
     ''' Data container for gps data
+
+    Rows added with add or + are buffered and the DataFrame d is built
+    once, when it is first accessed
     '''
     def __init__(self, lon=[], lat=[], time=[]):
-        self.d = pd.DataFrame()
+        self._d = pd.DataFrame()
+        # DataFrames and columns of rows not yet concatenated to _d
+        self._pending = []
+        self._rows = {}
+        self._sort = False
+
+    @property
+    def d(self):
+        if self._rows or self._pending:
+            self._flush_rows()
+            frames = [df for df in [self._d]+self._pending
+                      if len(df)>0 or len(df.columns)>0]
+            self._d = pd.concat(frames) if frames else pd.DataFrame()
+            self._pending = []
+        if self._sort:
+            self._d = self._d.sort_index(kind='mergesort')
+            self._sort = False
+        return self._d
+
+    @d.setter
+    def d(self, value):
+        self._d = value
+        self._pending = []
+        self._rows = {}
+        self._sort = False
+
+    def _flush_rows(self):
+        ''' Convert buffered rows into a pending DataFrame '''
+        if self._rows:
+            time = self._rows.pop('time')
+            self._pending.append(pd.DataFrame(self._rows,
+                                              index=pd.Index(time, name='time')))
+            self._rows = {}
+
+    def _append(self, time, sort, **columns):
+        ''' Buffer rows, columns are lists with the same length as time '''
+        if self._rows and list(self._rows) != ['time']+list(columns):
+            self._flush_rows()
+        if not self._rows:
+            self._rows = {'time': []}
+            self._rows.update({key: [] for key in columns})
+        self._rows['time'].extend(time)
+        for key, val in columns.items():
+            self._rows[key].extend(val)
+        self._sort = self._sort or sort
+
+    def __getstate__(self):
+        return {'_d': self.d, '_pending': [], '_rows': {}, '_sort': False}
+
+    def __setstate__(self, state):
+        # objects pickled before rows were buffered
+        if 'd' in state:
+            state['_d'] = state.pop('d')
+        state.setdefault('_pending', [])
+        state.setdefault('_rows', {})
+        state.setdefault('_sort', False)
+        self.__dict__.update(state)
 
     def __getitem__(self, item):
         if item is 'time':
@@ -33,7 +93,8 @@ class gps(object):
             return self.d[item]
 
     def __add__(self, other):
-        self.d = self.d.append(other.d)
+        self._flush_rows()
+        self._pending.append(other.d)
         return self
 
     def add(self, lon, lat, time, sort=False):
@@ -42,11 +103,7 @@ class gps(object):
         if not isinstance(time,list): time=[time]
         #d = xr.Dataset({'lon': (['time'], lon), 'lat': (['time'], lat)},
         #               coords = {'time': time})
-        d = pd.DataFrame({'lon': lon, 'lat': lat}, index=time)
-        d.index.rename('time', inplace=True)
-        self.d = self.d.append(d)
-        if sort:
-            self.d = self.d.sortby('time')
+        self._append(time, sort, lon=lon, lat=lat)
 
     def trim(self, t0, t1, inplace=True):
         ''' select data between t0 and t1 '''
@@ -217,29 +274,176 @@ class gps(object):
             self.fill_with_d(d)
 
 
-def read_gps_tois(file, verbose=False):
+def read_gps_tois(file, verbose=False, max_workers=None):
+    ''' Read NMEA files (RMC and GGA sentences)
+
+    Parameters
+    ----------
+    file: str or list of str
+        NMEA file(s), lists of files are read concurrently and concatenated
+        in time order
+    verbose: boolean
+    max_workers: int, optional
+        Number of processes used for lists of files, runs serially if 0
 
+    Returns
+    -------
+    gp: gps
+    '''
     # init gps container
     gp = gps()
-    if isinstance(file, list):
-        for f in file:
-            gp = gp + read_gps_tois(f)
+    if not isinstance(file, list):
+        file = [file]
+    if not file:
+        # e.g. a glob matching no file
+        return gp
+    if max_workers == 0 or len(file) == 1:
+        out = [_read_nmea_file(f, verbose) for f in file]
     else:
-        print('Reads ' + file)
-        gpsfile = pynmea2.NMEAFile(file)
-        data = pd.DataFrame()
-        for d in gpsfile:
-            if verbose:
-                print(d)
-            time = datetime.datetime.combine(d.datestamp, d.timestamp)
-            data = data.append({'lon': d.longitude, 'lat': d.latitude,
-                                'time': time},
-                                ignore_index=True)
-        #
-        gp.d = data.set_index('time')
-
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            out = list(executor.map(_read_nmea_file, file, [verbose]*len(file)))
+    time = np.concatenate([o[0] for o in out]).astype('datetime64[ns]')
+    lon = np.concatenate([o[1] for o in out])
+    lat = np.concatenate([o[2] for o in out])
+    if len(file) > 1:
+        i = np.argsort(time, kind='stable')
+        time, lon, lat = time[i], lon[i], lat[i]
+    gp.d = pd.DataFrame({'lon': lon, 'lat': lat},
+                        index=pd.DatetimeIndex(time, name='time'))
     return gp
 
+def _read_nmea_file(file, verbose=False):
+    ''' Single pass NMEA parser, GGA sentences are dated with the last RMC
+    date (incremented when crossing midnight), GGA fixes at times already
+    given by a RMC sentence are dropped
+
+    Returns
+    -------
+    time: np.ndarray of datetime64[ms]
+    lon, lat: np.ndarray
+    '''
+    print('Reads ' + file)
+    with open(file, 'r', errors='replace') as f:
+        lines = f.read().splitlines()
+    n = len(lines)
+    # preallocated outputs, days since 1970-01-01 and milliseconds of the day
+    day = np.full(n, -1, dtype=np.int64)
+    tod = np.zeros(n, dtype=np.int64)
+    lon = np.zeros(n)
+    lat = np.zeros(n)
+    rmc = np.zeros(n, dtype=bool)
+    _days = {}
+    k = 0
+    current_day, last_tod = -1, -1
+    for line in lines:
+        i = line.find('$')
+        if i < 0:
+            continue
+        d = line[i:].split('*')[0].split(',')
+        kind = d[0][3:]
+        try:
+            if kind == 'RMC':
+                if len(d) < 10 or d[2] != 'A':
+                    continue
+                date = d[9]
+                if date not in _days:
+                    _days[date] = (datetime.date(2000+int(date[4:6]), int(date[2:4]),
+                                                 int(date[0:2])).toordinal() - _epoch)
+                current_day = _days[date]
+                ilat, ilon, rmc[k] = 3, 5, True
+            elif kind == 'GGA':
+                if len(d) < 7 or d[6] in ['', '0']:
+                    continue
+                ilat, ilon = 2, 4
+            else:
+                continue
+            t = d[1]
+            ms = (int(t[0:2])*3600 + int(t[2:4])*60)*1000 + int(round(float(t[4:])*1000))
+            if kind == 'GGA' and current_day >= 0 and ms < last_tod - 43200000:
+                # midnight crossed since last dated sentence
+                current_day += 1
+            last_tod = ms
+            x = float(d[ilat])
+            lat[k] = (x//100 + (x % 100)/60.) * (-1. if d[ilat+1] == 'S' else 1.)
+            x = float(d[ilon])
+            lon[k] = (x//100 + (x % 100)/60.) * (-1. if d[ilon+1] == 'W' else 1.)
+        except (ValueError, IndexError):
+            # corrupted sentence
+            rmc[k] = False
+            continue
+        if verbose:
+            print(line)
+        day[k], tod[k] = current_day, ms
+        k += 1
+    day, tod, lon, lat, rmc = day[:k], tod[:k], lon[:k], lat[:k], rmc[:k]
+    # GGA fixes preceding the first RMC sentence
+    undated = day < 0
+    if np.any(undated) and not np.all(undated):
+        i = np.argmax(~undated)
+        day[undated] = day[i] - (tod[undated] > tod[i])
+    elif np.all(undated) and k > 0:
+        print('No RMC sentence in '+file+', GGA fixes cannot be dated')
+        k = 0
+        day, tod, lon, lat, rmc = day[:0], tod[:0], lon[:0], lat[:0], rmc[:0]
+    time = (day*86400000 + tod).astype('datetime64[ms]')
+    # RMC and GGA sentences at the same time
+    keep = np.ones(k, dtype=bool)
+    if np.any(rmc) and not np.all(rmc):
+        keep[~rmc] = ~np.isin(time[~rmc], time[rmc])
+    return time[keep], lon[keep], lat[keep]
+
+_epoch = datetime.date(1970, 1, 1).toordinal()
+
+def join_gps(time, gp, tolerance=0., interpolate=False):
+    ''' Positions of the gps fixes nearest to given times
+
+    Parameters
+    ----------
+    time: list or DatetimeIndex
+        times to locate
+    gp: gps
+    tolerance: float
+        maximum time difference with the fix used [s], 0 requires an exact
+        match
+    interpolate: boolean
+        linearly interpolate between the fixes preceding and following
+        each time, when both are within tolerance
+
+    Returns
+    -------
+    lon, lat: np.ndarray
+        NaN where no fix is found
+    offset: np.ndarray
+        time of the nearest fix minus time [s], NaN where no fix is found
+    '''
+    te = pd.DatetimeIndex(time).values.astype('datetime64[ns]').astype(np.int64)
+    lon, lat, offset = (np.full(te.size, np.nan) for i in range(3))
+    d = gp.d
+    if te.size == 0 or len(d) == 0:
+        return lon, lat, offset
+    # first fix of duplicated times is used
+    d = d[~d.index.duplicated(keep='first')].sort_index()
+    tf = d.index.values.astype('datetime64[ns]').astype(np.int64)
+    flon, flat = d['lon'].values, d['lat'].values
+    # fixes preceding (p) and following or at (n) each time
+    i = np.searchsorted(tf, te, side='left')
+    p, n = np.maximum(i-1, 0), np.minimum(i, tf.size-1)
+    dp = np.where(i > 0, te - tf[p], np.iinfo(np.int64).max)
+    dn = np.where(i < tf.size, tf[n] - te, np.iinfo(np.int64).max)
+    use_n = dn <= dp
+    j = np.where(use_n, n, p)
+    dist = np.where(use_n, dn, dp)
+    ok = dist <= int(round(tolerance*1e9))
+    lon[ok], lat[ok] = flon[j[ok]], flat[j[ok]]
+    offset[ok] = (tf[j[ok]] - te[ok])*1e-9
+    if interpolate:
+        tol = int(round(tolerance*1e9))
+        both = (dp <= tol) & (dn <= tol) & (dn > 0)
+        w = dp[both]/(dp[both] + dn[both])
+        lon[both] = flon[p[both]] + (flon[n[both]] - flon[p[both]])*w
+        lat[both] = flat[p[both]] + (flat[n[both]] - flat[p[both]])*w
+    return lon, lat, offset
+
 def interp_gps(time, gp):
     '''Interpolate lists of gps onto a given timeline
     '''
@@ -8,22 +8,29 @@ import pandas as pd
 from .gps import *
 from .arecorder import *
 
-source_attrs = ['gps', 'emission']
+source_attrs = ['gps', 'emission', 'diagnostics']
 
 class source_rtsys(object):
     ''' Data container for rtsys acoustical source log
     '''
-    def __init__(self, file=None, verbose=-1):
+    def __init__(self, file=None, verbose=-1, max_workers=None, **kwargs):
         if file is not None:
-            self.gps, self.emission = read_log_file(file, verbose)
+            self.gps, self.emission, self.diagnostics = \
+                read_log_file(file, verbose, diagnostics=True, max_workers=max_workers,
+                              **kwargs)
 
     def __add__(self, other):
         if hasattr(self, 'gps') and hasattr(self, 'emission'):
-            self.gps.d = self.gps.d.append(other.gps.d)
-            self.emission.d = self.emission.d.append(other.emission.d)
+            self.gps = self.gps + other.gps
+            self.emission = self.emission + other.emission
+            if hasattr(other, 'diagnostics'):
+                self.diagnostics = pd.concat([getattr(self, 'diagnostics', None),
+                                              other.diagnostics], ignore_index=True)
         else:
             self.gps = other.gps
             self.emission = other.emission
+            if hasattr(other, 'diagnostics'):
+                self.diagnostics = other.diagnostics
         return self
 
     def trim(self, t0, t1, inplace=True):
@@ -71,29 +78,125 @@ class emissions(gps):
     ''' Data container for emission data
     '''
 
-    def add(self, time, sound, lon, lat, sort=False):
+    def add(self, time, sound, lon, lat, sort=False, offset=None):
         if not isinstance(lon,list): lon=[lon]
         if not isinstance(lat,list): lat=[lat]
         if not isinstance(time,list): time=[time]
         if not isinstance(sound,list): sound=[sound]
-        d = pd.DataFrame({'lon': lon, 'lat': lat, 'sound': sound},
-                         index = time)
-        d.index.rename('time', inplace=True)
-        self.d = self.d.append(d)
-        if sort:
-            self.d = self.d.sortby('time')
+        if offset is None:
+            self._append(time, sort, lon=lon, lat=lat, sound=sound)
+        else:
+            if not isinstance(offset,list): offset=[offset]
+            self._append(time, sort, lon=lon, lat=lat, sound=sound, gps_offset=offset)
 
-def read_log_file(file, verbose):
+    def locate(self, gp, tolerance=0., interpolate=False):
+        ''' (Re)compute emission positions from gps data, see gps.join_gps '''
+        d = self.d
+        lon, lat, offset = join_gps(d.index, gp, tolerance=tolerance,
+                                    interpolate=interpolate)
+        d = d.assign(lon=lon, lat=lat, gps_offset=offset)
+        self.d = d
 
-    print('Reads '+file)
+# log lines of interest, dispatched with a single search per line
+_log_re = re.compile(r'(?P<sync>PPS :: sync)'
+                     r'|(?P<rmc>GPS :: \$GNRMC)'
+                     r'|(?P<tx>DSP :: Transmission done)'
+                     r'|(?P<wav>WAV :: Reading)'
+                     r'|(?P<idx>WAV :: sent repondeur_idx)')
+_sync_re = re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})')
+_wav_re = re.compile(r'son(\d+)\.wav')
+_idx_re = re.compile(r'(\d+)/(\d+)\s*$')
+
+diagnostics_columns = ['file', 'line', 'kind', 'value', 'text']
+
+def read_log_file(file, verbose, diagnostics=False, max_workers=None,
+                  tolerance=0., interpolate=False):
+    ''' Read rtsys source log files
+
+    Parameters
+    ----------
+    file: str or list of str
+        log file(s), lists of files are parsed concurrently
+    verbose: int
+        >0 prints anomalies
+    diagnostics: boolean
+        returns a table of synchronisation and cycle anomalies
+    max_workers: int, optional
+        Number of processes used for lists of files, runs serially if 0
+    tolerance: float
+        Maximum time difference between emissions and gps fixes [s], 0
+        requires an exact match, see gps.join_gps
+    interpolate: boolean
+        Interpolate positions between gps fixes
+
+    Returns
+    -------
+    gp: gps
+    edata: emissions
+        gps_offset is the time difference to the gps fix used [s]
+    diag: pandas.DataFrame, if diagnostics
+        file, line number, kind of anomaly, value and log line
+    '''
+    if not isinstance(file, list):
+        file = [file]
+    if not file:
+        # e.g. a glob matching no file
+        if diagnostics:
+            return gps(), emissions(), pd.DataFrame([], columns=diagnostics_columns)
+        return gps(), emissions()
+    if max_workers == 0 or len(file) == 1:
+        out = [_parse_log_file(f, verbose) for f in file]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            out = list(executor.map(_parse_log_file, file, [verbose]*len(file)))
+    out = {key: np.concatenate([o[key] for o in out]) if key != 'diag'
+                else sum([o[key] for o in out], [])
+           for key in out[0]}
 
-    # init gps container
+    # gps fixes, degrees and minutes converted at once
     gp = gps()
+    t = out['rmc_time']
+    h = t//10000
+    m = (t - h*10000)//100
+    d = out['rmc_date']
+    day = d//10000
+    month = (d - day*10000)//100
+    time = pd.to_datetime(pd.DataFrame({'year': 2000+(d - day*10000 - month*100),
+                                        'month': month, 'day': day, 'hour': h,
+                                        'minute': m, 'second': np.floor(t - h*10000 - m*100)}))
+    gp.d = pd.DataFrame({'lon': _nmea2deg(out['lon'], out['lon_h'], 'W'),
+                         'lat': _nmea2deg(out['lat'], out['lat_h'], 'S')},
+                        index=pd.DatetimeIndex(time, name='time'))
 
-    # open and read data
-    fptr = open(file, 'r')
-    lines = fptr.readlines()
-    fptr.close()
+    # emissions, those preceding the first pps sync are discarded
+    edata = emissions()
+    synced = out['e_time'] != ''
+    e_time = pd.to_datetime(out['e_time'][synced], format='%Y-%m-%dT%H:%M:%S').tolist()
+    e_sound = out['e_sound'][synced].tolist()
+
+    # find coordinates corresponding to emission time
+    if gp.d.size>0:
+        e_lon, e_lat, e_offset = join_gps(e_time, gp, tolerance=tolerance,
+                                          interpolate=interpolate)
+        # fill in emission data container
+        edata.add(e_time, e_sound, e_lon.tolist(), e_lat.tolist(),
+                  offset=e_offset.tolist())
+
+    if diagnostics:
+        return gp, edata, pd.DataFrame(out['diag'], columns=diagnostics_columns)
+    return gp, edata
+
+def _nmea2deg(x, hemisphere, negative):
+    ''' ddmm.mmmm to decimal degrees '''
+    deg = np.floor(x / 100)
+    return (deg + (x - deg * 100) / 60.) * np.where(hemisphere == negative, -1., 1.)
+
+def _parse_log_file(file, verbose):
+    ''' Single pass over a log file, returns columns of gps fixes (raw nmea
+    values), emissions and a list of anomalies
+    '''
+    print('Reads '+file)
 
     # init variables
     gps_sync_start = -1
@@ -104,161 +207,107 @@ def read_log_file(file, verbose):
     cycle_time = -1
     max_idx = -1
     idx_son=-1
-    t_nan = datetime.datetime(1, 1, 1, 0, 0, 0)
-    pps_sync_date = t_nan
+    pps_sync_date = ''
 
-    # init final arrays
-    edata = emissions()
-    e_time=[]; e_sound=[]; e_lon=[]; e_lat=[]
+    # columns
+    rmc = {'rmc_time': [], 'rmc_date': [], 'lat': [], 'lat_h': [], 'lon': [], 'lon_h': []}
+    e_time=[]; e_sound=[]
+    diag = []
+    def _diag(i, kind, value, line):
+        diag.append((file, i, kind, value, line))
+        if verbose>0: print(i, line, '('+kind+': '+str(value)+')')
 
-    for i, line in enumerate(lines):
-        line = line.replace('\n', '').replace('\r', '')
-        if "PPS :: Configured next TX" in line:
-            # (Occurs once early in the file)
-            #if verbose: print Fore.WHITE, i, line
-            pass
-        if "PPS :: sync" in line:
-            # (doesn't mean there is valid position)
-            date = line.split(' ')[3].split('T')[1].replace('Z', '').split(':')
-            # date is the number of seconds since midnight
-            date = int(date[0]) * 3600 + int(date[1]) * 60 + int(date[2])
-            if pps_delta_sync == -1:
-                # skips first sync
-                #print Fore.CYAN, i, line
-                pass
-            else:
-                # cycle_time = time between pps_sync, typiquement 3s
-                ## print Fore.CYAN, i, line, " delta=%d"%(date-pps_delta_sync)
-                if cycle_time == -1:
-                    # use first cycle_time as reference
-                    cycle_time = date - pps_delta_sync
-                else:
-                    if (date - pps_delta_sync != cycle_time and current_idx != max_idx):
-                        # indicate when the time between synchro is the not initial one
-                        #print Fore.LIGHTRED_EX, i, line, " delta=%d, idx:%d" % (date - pps_delta_sync, current_idx)
-                        pass
+    with open(file, 'r', errors='replace') as fptr:
+        for i, line in enumerate(fptr):
+            match = _log_re.search(line)
+            if match is None:
+                continue
+            line = line.rstrip('\r\n')
+            kind = match.lastgroup
+            if kind == 'sync':
+                # (doesn't mean there is valid position)
+                d = _sync_re.search(line, match.end())
+                # date is the number of seconds since midnight
+                date = int(d.group(4)) * 3600 + int(d.group(5)) * 60 + int(d.group(6))
+                if pps_delta_sync != -1:
+                    # cycle_time = time between pps_sync, typiquement 3s
+                    if cycle_time == -1:
+                        # use first cycle_time as reference
+                        cycle_time = date - pps_delta_sync
+                    elif date - pps_delta_sync != cycle_time and current_idx != max_idx:
+                        # time between synchro is the not initial one
+                        _diag(i, 'sync_delta', date - pps_delta_sync, line)
+                    # sync_timer is the number of sync achieved since last emission
+                    sync_timer += 1
+                pps_delta_sync = date
+                # store date
+                pps_sync_date = d.group(0)
+            elif kind == 'rmc':
+                # GPS data
+                d = line[match.start():].split(',')
+                if d[2] == 'V' and gps_sync_start == -1:
+                    # no coordinates available
+                    if gps_sync_stop == -1:
+                        time = float(d[1])
+                        gps_sync_start = (int(time // 10000) * 3600 + int(time // 100 % 100) * 60
+                                          + int(time % 100))
+                        _diag(i, 'gps_sync_start', gps_sync_start, line)
                     else:
-                        #print Fore.CYAN, i, line, " delta=%d" % (date - pps_delta_sync)
-                        pass
-                # sync_timer is the number of sync achieved since last emission
-                sync_timer += 1
-                if verbose>0: print('sync_timer='+str(sync_timer))
-            pps_delta_sync = date
-            # store date
-            year = int(line.split(' ')[3].split('T')[0].split('-')[0])
-            month = int(line.split(' ')[3].split('T')[0].split('-')[1])
-            day = int(line.split(' ')[3].split('T')[0].split('-')[2])
-            h = int(line.split(' ')[3].split('T')[1].replace('Z', '').split(':')[0])
-            m = int(line.split(' ')[3].split('T')[1].replace('Z', '').split(':')[1])
-            s = int(line.split(' ')[3].split('T')[1].replace('Z', '').split(':')[2])
-            #pps_sync_date = date2num(datetime.datetime(year, month, day, h, m, s))
-            pps_sync_date = datetime.datetime(year, month, day, h, m, s)
-        if "PPS :: idle" in line:
-            # debug: once sync is done, checks that sync is activated
-            #print Fore.GREEN, i, line
-            pass
-        if "GPS :: $GNRMC" in line:
-            # GPS data
-            if line.split(',')[2] == 'V' and gps_sync_start == -1:
-                # no coordinates available
-                if gps_sync_stop == -1 and gps_sync_start == -1:
-                    #
-                    time = float(line.split(',')[1])
-                    h = int( time / 10000 )
-                    m = int( (time - h * 10000) / 100 )
-                    s = int( time - h * 10000 - m * 100 )
-                    gps_sync_start = h * 3600 + m * 60 + s
-                    if verbose>0: print(i, "(GPS sync start)", line)
-                    #
-                    if line.split(',')[9] is not '':
-                        date = float(line.split(',')[9])
-                        day = int( date/1e4 )
-                        month = int( (date-day*1e4)/1e2 )
-                        year = 2000+int( date-day*1e4-month*1e2 )
-                    #
-                if gps_sync_stop != -1:
-                    if verbose>0: print(i, "(GPS sync lost!)", line)
-            if line.split(',')[2] == 'A':
-                # coordinates available
-                time = float(line.split(',')[1])
-                h = int(time / 10000)
-                m = int( (time - h * 10000) / 100 )
-                s = int( time - h * 10000 - m * 100 )
-                #
-                date = float(line.split(',')[9])
-                day = int(date / 1e4)
-                month = int((date - day * 1e4) / 1e2)
-                year = 2000+int(date - day * 1e4 - month * 1e2)
-                #
-                lon = float(line.split(',')[5])
-                lond = np.floor(lon / 100)
-                lon = lond + (lon - lond * 100) / 60.
-                #
-                lat = float(line.split(',')[3])
-                latd = np.floor(lat / 100)
-                lat = latd + (lat - latd * 100) / 60.
-                # store data
-                #time = date2num(datetime.datetime(year, month, day, h, m, s))
-                time = datetime.datetime(year, month, day, h, m, s)
-                gp.add(lon, lat, time)
-                #
-                if gps_sync_stop == -1:
-                    gps_sync_stop = h * 3600 + m * 60 + s
-                    if verbose>0: print(i, "(GPS sync done)", line, "(Took %.2f seconds)" % ( \
-                    gps_sync_stop - gps_sync_start))
-                #
-        if "DSP :: Transmission done" in line:
-            # this is when the sound is produced
-            # checks that the sound a synchronisation occurred since last emission
-            if sync_timer != 1 and cycle_time != -1:
-                if verbose>0: print(i, line,
-                "(ERROR detected wrong cycle time: %ds)" % (cycle_time * sync_timer))
-            sync_timer = 0
-        if "WAV :: Reading" in line:
-            # store file number
-            idx_son = int( line.split('/')[-1].replace('son','').replace('.wav','') )
-        if "WAV :: sent repondeur_idx" in line:
-            # This piece of codes checks which sounds is emitted
-            idx_data = line.split(' ')[-1].split('/')
-            idx = int(idx_data[0])
-            max_idx = int(idx_data[1])
-            if current_idx == -1:
-                # first emissions
-                if idx != 0:
+                        _diag(i, 'gps_sync_lost', np.nan, line)
+                elif d[2] == 'A':
+                    # coordinates available
+                    try:
+                        fix = (float(d[1]), float(d[9]), float(d[3]), d[4], float(d[5]), d[6])
+                    except (ValueError, IndexError):
+                        _diag(i, 'gps_corrupted', np.nan, line)
+                        continue
+                    for key, val in zip(rmc, fix):
+                        rmc[key].append(val)
+                    time = fix[0]
+                    if gps_sync_stop == -1:
+                        gps_sync_stop = (int(time // 10000) * 3600 + int(time // 100 % 100) * 60
+                                         + int(time % 100))
+                        _diag(i, 'gps_sync_done', gps_sync_stop - gps_sync_start, line)
+            elif kind == 'tx':
+                # this is when the sound is produced
+                # checks that the sound a synchronisation occurred since last emission
+                if sync_timer != 1 and cycle_time != -1:
+                    _diag(i, 'wrong_cycle_time', cycle_time * sync_timer, line)
+                sync_timer = 0
+            elif kind == 'wav':
+                # store file number
+                idx_son = int(_wav_re.search(line).group(1))
+            elif kind == 'idx':
+                # checks which sounds is emitted
+                d = _idx_re.search(line)
+                idx = int(d.group(1))
+                max_idx = int(d.group(2))
+                if current_idx == -1:
                     # first sound should be 0
-                    if verbose>0: print(i, line, "(Error idx should be 0)")
-            else:
-                # following emissions
-                good_value = (current_idx + 1) % (max_idx + 1)
-                if idx != good_value and verbose>-1:
-                    if verbose>0: print(i, line, "(Error idx should be %d)" % good_value)
-            current_idx = idx
-            # store sound and time
-            e_time.append(pps_sync_date)
-            e_sound.append(idx)
-            if idx != idx_son and verbose>-1:
-                print(i, line, idx_son, 'Error repondeur and wav reading line do not match')
-
-    # find coordinates corresponding to emission time
-    if gp.d.size>0:
-        for t in e_time:
-            l = gp['lon'].loc[gp['time'] == t ].values
-            if l.size>0:
-                e_lon.append( l[0] )
-            else:
-                e_lon.append( np.NaN )
-            #
-            l = gp['lat'].loc[gp['time'] == t ].values
-            if l.size>0:
-                e_lat.append( l[0] )
-            else:
-                e_lat.append( np.NaN )
-
-        # fill in emission data container
-        edata.add(e_time, e_sound, e_lon, e_lat)
-        edata.d = edata.d.loc[edata['time']!=t_nan]
+                    if idx != 0:
+                        _diag(i, 'first_idx', idx, line)
+                else:
+                    # following emissions
+                    good_value = (current_idx + 1) % (max_idx + 1)
+                    if idx != good_value:
+                        _diag(i, 'idx_sequence', good_value, line)
+                current_idx = idx
+                # store sound and time
+                e_time.append(pps_sync_date)
+                e_sound.append(idx)
+                if idx != idx_son:
+                    diag.append((file, i, 'wav_mismatch', idx_son, line))
+                    if verbose>-1:
+                        print(i, line, idx_son, 'Error repondeur and wav reading line do not match')
 
-    return gp, edata
+    out = {key: np.array(val, dtype=float) for key, val in rmc.items()
+           if key not in ['lat_h', 'lon_h']}
+    out['lat_h'] = np.array(rmc['lat_h'], dtype=object)
+    out['lon_h'] = np.array(rmc['lon_h'], dtype=object)
+    out['e_time'] = np.array(e_time, dtype=object)
+    out['e_sound'] = np.array(e_sound, dtype=int)
+    out['diag'] = diag
+    return out
 
 def load_emission_sequence(path):
     files = sorted(glob(path+'*.wav'),
@@ -0,0 +1,321 @@
+''' Benchmarks of float simulations and controllers
+
+Run from the command line:
+    python float_bench.py                 # full suite
+    python float_bench.py --quick         # shorter simulations
+    python float_bench.py --save b.json   # store results
+    python float_bench.py --compare b.json # compare with stored results
+    python float_bench.py -k time_step    # select benchmarks by name
+
+Benchmarks rely on a synthetic water profile built from points so that no
+WOA file is required. Each benchmark reports the best and median wall time
+over repeats, a throughput (e.g. time steps per second) and the peak
+memory allocated during one extra run (tracemalloc).
+'''
+
+import io
+import json
+import gc
+import tracemalloc
+import platform
+from copy import deepcopy
+from contextlib import redirect_stdout
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from float_lib import autonomous_float, waterp, eta_field, descent
+
+
+#------------------------------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------------------------------
+
+def synthetic_waterp(dz_table=None, pmax=1000., dp=10.):
+    ''' Mediterranean-like water profile built from points
+
+    Parameters
+    ----------
+    dz_table: float, optional
+        Tabulate the profile with this resolution [m]
+    pmax, dp: float
+        Maximum pressure and pressure resolution [dbar]
+    '''
+    p = np.arange(0., pmax+dp, dp)
+    temp = 20. - 12.*(1.-np.exp(-p/200.))
+    s = 37.5 + 1.*(1.-np.exp(-p/300.))
+    return waterp(pressure=list(p), temperature=list(temp), salinity=list(s),
+                  lon=6., lat=42., name='synthetic', dz_table=dz_table)
+
+
+def synthetic_float(w, model='ENSTA', z_eq=-250., z_vmax=-400.):
+    ''' Float ballasted at z_eq with a piston that reaches equilibrium at z_vmax
+    when fully out
+    '''
+    f = autonomous_float(model=model)
+    p, temp, rho = w.get_p(z_eq), w.get_temp(z_eq), w.get_rho(z_eq)
+    f.adjust_m(p, temp, rho)
+    p, temp, rho = w.get_p(z_vmax), w.get_temp(z_vmax), w.get_rho(z_vmax)
+    vmax = f.volume4equilibrium(p, temp, rho)
+    f.init_piston(d_max=.14, vol_max=vmax, vol=vmax)
+    return f
+
+
+def ctrl_params(mode, f, w):
+    ''' Control parameters required on top of time_step defaults
+    '''
+    if mode == 'sliding':
+        fmax, fmin, afmax, wmax = f.compute_bounds(w, -500.)
+        return {'mode': 'sliding', 'd3y_ctrl': afmax/f.m}
+    elif mode == 'pid':
+        return {'mode': 'pid', 'Kp': 1.e-7, 'Ki': 0., 'Kd': 1.e-5}
+    return {'mode': mode}
+
+
+#------------------------------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------------------------------
+
+class benchmark():
+    ''' A timed piece of code
+
+    Parameters
+    ----------
+    name: str
+        Benchmark name, e.g. 'time_step.feedback.kalman'
+    func: function
+        Code to time, takes the output of setup as argument
+    setup: function, optional
+        Called before each repeat, outside of the timed section
+    n: int
+        Number of units processed by one call of func (time steps, depths ...),
+        used to compute the throughput
+    unit: str
+        Name of the units, e.g. 'steps'
+    number: int
+        Number of calls of func per repeat
+    '''
+
+    def __init__(self, name, func, setup=None, n=1, unit='calls', number=1):
+        self.name = name
+        self.func = func
+        self.setup = setup
+        self.n = n
+        self.unit = unit
+        self.number = number
+
+    def _call(self, seed):
+        np.random.seed(seed)
+        arg = self.setup() if self.setup is not None else None
+        gc.collect()
+        t0 = perf_counter()
+        for i in range(self.number):
+            self.func(arg)
+        return (perf_counter()-t0)/self.number
+
+    def run(self, repeat=3, seed=0):
+        ''' Time the benchmark and measure its peak memory
+
+        Returns
+        -------
+        out: dict
+            name, best and median time [s], throughput [unit/s], peak memory [MB]
+        '''
+        with redirect_stdout(io.StringIO()):
+            times = [self._call(seed) for r in range(repeat)]
+            # memory is traced in a separate call, tracing slows execution down
+            np.random.seed(seed)
+            arg = self.setup() if self.setup is not None else None
+            gc.collect()
+            tracemalloc.start()
+            self.func(arg)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        best = min(times)
+        return {'name': self.name, 'best': best, 'median': float(np.median(times)),
+                'rate': self.n/best, 'unit': self.unit+'/s', 'peak_mb': peak/1.e6}
+
+    def __repr__(self):
+        return 'benchmark(%r)'%self.name
+
+
+def suite(quick=False):
+    ''' Build the list of benchmarks
+
+    Parameters
+    ----------
+    quick: boolean
+        Shorter simulations, for smoke tests
+
+    Returns
+    -------
+    benchmarks: list of benchmark
+    '''
+    with redirect_stdout(io.StringIO()):
+        return _suite(quick)
+
+
+def _suite(quick):
+    w = synthetic_waterp()
+    wt = synthetic_waterp(dz_table=1.)
+    f = synthetic_float(w)
+    T = 600. if quick else 3600.
+    dt_step = 1.
+    nsteps = int(T/dt_step)
+    z_target = lambda t: -50.+t*0.
+    t_eta = np.arange(0., T+60., 60.)
+    etas = {'': None,
+            '.eta': lambda t: 5.*np.sin(2.*np.pi*t/1200.),
+            '.eta_field': eta_field(t_eta, 5.*np.sin(2.*np.pi*t_eta[:,None]/1200.)
+                                    *np.exp(np.arange(0., -500., -50.)/200.)[None,:],
+                                    z=np.arange(0., -500., -50.))}
+    b = []
+    #
+    # time stepping, for each control mode
+    for mode in ['sliding', 'pid', 'feedback', 'kalman_feedback']:
+        for kalman in [False, True]:
+            if mode == 'kalman_feedback' and not kalman:
+                continue
+            for ename, eta in etas.items():
+                ctrl = ctrl_params(mode, f, w)
+                kwargs = {} if eta is None else {'eta': eta}
+                def _ts(f1, ctrl=ctrl, kalman=kalman, kwargs=kwargs):
+                    f1.time_step(w, T=T, dt_step=dt_step, dt_store=60., z=0., w=0.,
+                                 v=f1.piston.vol_max, usepiston=True, z_target=z_target,
+                                 ctrl=dict(ctrl), kalman=kalman, **kwargs)
+                name = 'time_step.'+mode+('.kalman' if kalman else '')+ename
+                b.append(benchmark(name, _ts, setup=lambda: deepcopy(f),
+                                   n=nsteps, unit='steps'))
+    # free fall without control
+    for integrator in ['euler', 'rk4', 'rk23']:
+        def _ts(f1, integrator=integrator):
+            f1.time_step(w, T=T, dt_step=dt_step, dt_store=60., z=0., w=0.,
+                         v=f1.piston.vol_max-1.e-5, usepiston=True,
+                         integrator=integrator)
+        b.append(benchmark('time_step.nocontrol.'+integrator, _ts,
+                           setup=lambda: deepcopy(f), n=nsteps, unit='steps'))
+    #
+    # water profile getters
+    z = np.linspace(-900., 0., 10000)
+    for wname, wp in [('', w), ('.table', wt)]:
+        for getter in ['get_temp', 'get_s', 'get_p', 'get_theta', 'get_rho']:
+            g = getattr(wp, getter)
+            b.append(benchmark('waterp.'+getter+wname+'.scalar',
+                               lambda arg, g=g: g(-100.), number=1000))
+            b.append(benchmark('waterp.'+getter+wname+'.array',
+                               lambda arg, g=g: g(z), n=z.size, unit='depths', number=10))
+    #
+    # float utilities and equilibrium solvers
+    b.append(benchmark('compute_bounds', lambda arg: f.compute_bounds(w, -500.),
+                       number=100))
+    def _descent(arg):
+        # bounds and trajectories cached on the float are dropped so that
+        # the full computation is timed
+        f.__dict__.pop('_bounds', None)
+        f.__dict__.pop('_trajectories', None)
+        descent(T, -400., f, w)
+    b.append(benchmark('descent', _descent, number=10))
+    b.append(benchmark('descent.cached', lambda arg: descent(T, -400., f, w),
+                       setup=lambda: descent(T, -400., f, w), number=10))
+    p, temp, rho = w.get_p(z), w.get_temp(z), w.get_rho(z)
+    b.append(benchmark('volume4equilibrium', lambda arg: f.volume4equilibrium(p, temp, rho),
+                       n=z.size, unit='depths', number=100))
+    b.append(benchmark('z4equilibrium.cached', lambda arg: f.z4equilibrium(w),
+                       setup=lambda: f.equilibrium_maps(w), number=100))
+    b.append(benchmark('equilibrium_maps', lambda arg: f.equilibrium_maps(w, refresh=True),
+                       number=3))
+    return b
+
+
+def run(benchmarks, repeat=3, select=None, verbose=1):
+    ''' Run benchmarks
+
+    Parameters
+    ----------
+    benchmarks: list of benchmark
+    repeat: int
+        Number of timed repeats
+    select: str, optional
+        Only run benchmarks whose name contains this string
+    verbose: int
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        Results indexed by benchmark name
+    '''
+    out = []
+    for b in benchmarks:
+        if select is not None and select not in b.name:
+            continue
+        r = b.run(repeat=repeat)
+        if verbose>0:
+            print('%-45s %10.3e s %12.4g %-10s %8.2f MB'
+                  %(r['name'], r['best'], r['rate'], r['unit'], r['peak_mb']))
+        out.append(r)
+    return pd.DataFrame(out).set_index('name')
+
+
+def save(df, file):
+    ''' Store results along with the environment in a json file
+    '''
+    info = {'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'processor': platform.processor()}
+    with open(file, 'w') as fptr:
+        json.dump({'info': info, 'results': df.reset_index().to_dict(orient='records')},
+                  fptr, indent=1)
+
+
+def load(file):
+    ''' Load results stored with save
+    '''
+    with open(file, 'r') as fptr:
+        d = json.load(fptr)
+    return pd.DataFrame(d['results']).set_index('name')
+
+
+def compare(df, ref, threshold=.1):
+    ''' Compare results with reference ones
+
+    Parameters
+    ----------
+    df, ref: pandas.DataFrame
+        Output of run or load
+    threshold: float
+        Relative change of the best time above which a benchmark is flagged
+
+    Returns
+    -------
+    cmp: pandas.DataFrame
+        best times, speedup (ref/new), peak memory change and flag
+    '''
+    cmp = pd.DataFrame({'best': df['best'], 'best_ref': ref['best'],
+                        'peak_mb': df['peak_mb'], 'peak_mb_ref': ref['peak_mb']}).dropna()
+    cmp['speedup'] = cmp['best_ref']/cmp['best']
+    cmp['flag'] = ''
+    cmp.loc[cmp['speedup']<1./(1.+threshold), 'flag'] = 'slower'
+    cmp.loc[cmp['speedup']>1.+threshold, 'flag'] = 'faster'
+    return cmp
+
+
+#------------------------------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark float simulations')
+    parser.add_argument('--quick', action='store_true', help='shorter simulations')
+    parser.add_argument('--repeat', type=int, default=3, help='number of repeats')
+    parser.add_argument('-k', dest='select', default=None,
+                        help='only run benchmarks whose name contains this string')
+    parser.add_argument('--save', default=None, help='json file where results are stored')
+    parser.add_argument('--compare', default=None, help='json file with reference results')
+    args = parser.parse_args()
+
+    df = run(suite(quick=args.quick), repeat=args.repeat, select=args.select)
+    if args.save is not None:
+        save(df, args.save)
+    if args.compare is not None:
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None,
+                               'display.width', 200):
+            print(compare(df, load(args.compare)))
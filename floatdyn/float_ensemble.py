@@ -0,0 +1,636 @@
+import numpy as np
+import xarray as xr
+
+from float_lib import (g, watth, control_sliding, control_feedback,
+                       integrators, scheduler, eta_field)
+
+# variables logged when a Kalman filter is used
+_kalman_log = ['z_kalman', 'w_kalman', 'gammaE_kalman', 'Ve_kalman']
+
+
+#------------------------------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------------------------------
+
+# float parameters that may vary across ensemble members
+_float_params = ['m', 'V', 'gamma', 'alpha', 'temp0', 'a', 'c1', 'L']
+# piston parameters that may vary across ensemble members
+_piston_params = ['vol_min', 'vol_max', 'dvdt_min', 'dvdt_max', 'efficiency']
+# control parameters that may vary across ensemble members
+_ctrl_params = ['dt_ctrl', 'dz_nochattering', 'tau', 'nu', 'delta', 'd3y_ctrl',
+                'Kp', 'Ki', 'Kd']
+
+
+#
+class float_ensemble():
+
+    def __init__(self, f, N=None, **kwargs):
+        ''' Ensemble of floats that are time stepped together, the state of
+        all members (z, w, v, Ve, piston volume, nrg) is held in arrays
+
+        Parameters
+        ----------
+            f : autonomous_float or list of autonomous_float
+                Float(s) the ensemble is built from. If a single float is
+                provided, it is replicated N times
+            N : int, optional
+                Number of members, inferred from f or kwargs if not provided
+            kwargs : per member parameters (scalars or arrays of size N)
+                float parameters: m, V, gamma, alpha, temp0, a, c1, L
+                piston parameters: vol_min, vol_max, dvdt_min, dvdt_max, efficiency
+
+        Usage:
+
+        fe = float_ensemble(f, m=f.m+np.linspace(-1.e-3,1.e-3,100))
+
+        builds an ensemble of 100 floats with masses spread around f.m
+        '''
+        if isinstance(f, (list, tuple)):
+            floats = list(f)
+        else:
+            floats = [f]
+        if N is None:
+            N = max([len(floats)]+[np.size(val) for val in kwargs.values()])
+        self.N = N
+        if len(floats) not in [1, N]:
+            print('Number of floats and ensemble size do not match')
+            return
+        if any([lf.c0 != 0 for lf in floats]):
+            # as in autonomous_float._f, forces ignore c0
+            print(' !!! linear drag coefficient not implemented yet')
+            return
+        #
+        self.model = floats[0].model
+        for key in _float_params+['rho_cte', 'gammaV']:
+            self._set_member_param(key, [getattr(lf, key) for lf in floats])
+        if all([hasattr(lf, 'piston') for lf in floats]):
+            pistons = [lf.piston for lf in floats]
+            self._set_member_param('vol_min', [p.vol_min for p in pistons])
+            self._set_member_param('vol_max', [p.vol_max for p in pistons])
+            self._set_member_param('dvdt_min', [p.omega2dvdt(p.omega_min) for p in pistons])
+            self._set_member_param('dvdt_max', [p.omega2dvdt(p.omega_max) for p in pistons])
+            self._set_member_param('efficiency', [p.efficiency for p in pistons])
+            self._set_member_param('vol_error', [p.vol_error for p in pistons])
+            self.vol = np.broadcast_to(np.array([p.vol for p in pistons], dtype=float),
+                                       (N,)).copy()
+            self._piston = True
+        else:
+            self._piston = False
+        #
+        for key, val in kwargs.items():
+            if key in _float_params or key in _piston_params:
+                self._set_member_param(key, val)
+            else:
+                print('Unknown member parameter: '+key)
+        if self._piston:
+            self.vol = np.clip(self.vol, self.vol_min, self.vol_max)
+
+        #auxiliary parameters, updated only if perturbed
+        if 'm' in kwargs or 'V' in kwargs:
+            self.rho_cte = self.m / self.V #kg.m^-3
+        if 'gamma' in kwargs or 'V' in kwargs:
+            self.gammaV = self.gamma*self.V #m^2
+
+    def _set_member_param(self, key, val):
+        setattr(self, key, np.broadcast_to(np.array(val, dtype=float),
+                                           (self.N,)).copy())
+
+    def __repr__(self):
+        strout='Float ensemble of %d members, parameters (min / max): \n'%(self.N)
+        for key in _float_params:
+            val = getattr(self, key)
+            strout+='  %-6s = %.3e / %.3e\n'%(key, np.amin(val), np.amax(val))
+        if self._piston:
+            for key in _piston_params:
+                val = getattr(self, key)
+                strout+='  %-10s = %.3e / %.3e\n'%(key, np.amin(val), np.amax(val))
+        return strout
+
+    def __len__(self):
+        return self.N
+
+    def rho(self, p=None, temp=None, v=None, z=None, waterp=None):
+        ''' Returns float densities i.e. mass over volume
+        '''
+        if v is None:
+            if hasattr(self,'v'):
+                v = self.v
+            else:
+                v = 0.
+        if p is not None and temp is not None:
+            return self.m/(self.V*(1.-self.gamma*p+self.alpha*(temp-self.temp0))+v)
+        elif z is not None and waterp is not None:
+            # assumes thermal equilibrium
+            p, tempw = waterp.get_p(z), waterp.get_temp(z)
+            return self.rho(p=p, temp=tempw, v=v)
+        else:
+            print('You need to provide p/temp or z/waterp')
+
+    def volume(self, **kwargs):
+        ''' Returns float volumes (V+v)
+        '''
+        return self.m/self.rho(**kwargs)
+
+    def _f(self, z, waterp, Lv, v=None, w=None):
+        ''' Compute the vertical force exterted on the floats
+        '''
+        p, tempw = waterp.get_p(z), waterp.get_temp(z)
+        rhow = waterp.get_rho(z)
+        rhof = self.rho(p=p,temp=tempw,v=v)
+        #
+        f = -self.m*g
+        f += self.m*rhow/rhof*g # we ignore DwDt terms for now
+        #
+        if w is None:
+            w = self.w
+        f += -self.m*self.c1/(2*Lv) * np.abs(w - waterp.detadt) * (w - waterp.detadt) #
+        return f
+
+    def _df(self, z, waterp, Lv, v=None, w=None):
+        ''' Compute gradients of the vertical force exterted on the floats
+        with respect to z, w and v
+        '''
+        return self._f_df(z, waterp, Lv, v=v, w=w)[1:4]
+
+    def _f_df(self, z, waterp, Lv, v=None, w=None):
+        ''' Vectorized counterpart of autonomous_float._f_df: vertical force,
+        its gradients with respect to z, w and v, and dVdz
+        '''
+        if v is None:
+            v = self.v
+        if w is None:
+            w = self.w
+        p, tempw, rhow = waterp.get_p(z), waterp.get_temp(z), waterp.get_rho(z)
+        dpdz, dtempdz = waterp.get_dz('p', z), waterp.get_dz('temp', z)
+        drhowdz = waterp.get_dz('rho', z)
+        #
+        vol = self.V*(1.-self.gamma*p+self.alpha*(tempw-self.temp0)) + v
+        dvoldz = self.V*(-self.gamma*dpdz+self.alpha*dtempdz)
+        wr = w - waterp.detadt
+        #
+        f = -self.m*g + g*rhow*vol - self.m*self.c1/(2*Lv)*np.abs(wr)*wr
+        df1 = g*(drhowdz*vol + rhow*dvoldz)
+        df2 = -self.m*self.c1/Lv*np.abs(wr)
+        df3 = g*rhow
+        return f, df1, df2, df3, dvoldz
+
+    def _init_ctrl(self, ctrl, waterp, dt_step):
+        ''' Fill in control parameters with defaults, member parameters
+        are broadcasted to arrays of size N
+        '''
+        ctrl_default = {'dt_ctrl': dt_step, 'dz_nochattering': 0.}
+        if ctrl['mode'] == 'sliding':
+            ctrl_default['tau'] = 60.
+            ctrl_default['waterp'] = waterp
+            ctrl_default['Lv'] = self.L
+        elif ctrl['mode'] == 'pid':
+            ctrl_default['error'] = 0.
+            ctrl_default['integral'] = 0.
+        elif ctrl['mode'] == 'feedback':
+            ctrl_default['tau'] = 3.25  # Set the root of feed-back regulation # s assesed by simulation
+            ctrl_default['nu'] = 0.10*2./np.pi # Set the limit speed : 3cm/s # m.s^-1 assesed by simulation
+            ctrl_default['delta'] = 0.11 #length scale that defines the zone of influence around the target depth, assesed by simulation
+            ctrl_default['gammaV'] = self.gammaV.copy()
+        elif ctrl['mode'] == 'kalman_feedback':
+            ctrl_default['tau'] = 3.25
+            ctrl_default['nu'] = 0.10*2./np.pi
+            ctrl_default['delta'] = 0.11
+            ctrl_default['kalman'] = getattr(self, 'kalman', None)
+        else:
+            print('!! mode '+ctrl['mode']+' is not implemented for ensembles')
+            return None
+        ctrl_default.update(ctrl)
+        ctrl = ctrl_default
+        for key in _ctrl_params+['error', 'integral']:
+            if key in ctrl:
+                ctrl[key] = np.broadcast_to(np.array(ctrl[key], dtype=float),
+                                            (self.N,)).copy()
+        # control ticks are shared by all members
+        ctrl['dt_ctrl'] = ctrl['dt_ctrl'][0]
+        return ctrl
+
+    def _control(self, z_target, ctrl, t, active):
+        ''' Vectorized counterpart of float_lib.control, only members that
+        are active have their control state updated
+        '''
+        if hasattr(z_target, 'derivatives'):
+            z_t, dz_t, d2z_t = z_target.derivatives(t)
+        else:
+            z_t = z_target(t)
+            dz_t = (z_target(t+.05)-z_target(t-.05))/.1
+            d2z_t = (z_target(t+.05)-2.*z_target(t)+z_target(t-.05))/.05**2
+        #
+        if ctrl['mode'] == 'sliding':
+            x2 = self.w
+            _f, df1, df2, df3, dvdz = self._f_df(self.z, ctrl['waterp'], ctrl['Lv'])
+            f2 = _f/self.m
+            f3 = dvdz*x2 # dVdz*w
+            df1, df2, df3 = df1/self.m, df2/self.m, df3/self.m
+            #
+            d3y = ctrl['d3y_ctrl']*control_sliding(self.z, self.w, f2, z_t, dz_t,
+                                                   d2z_t, ctrl['tau'])
+            u = df1*x2 + df2*f2 + df3*f3 - d3y
+            u = -u/df3
+
+        elif ctrl['mode'] == 'pid':
+            error = z_t - self.z
+            ctrl['integral'] = np.where(active, ctrl['integral'] + error*ctrl['dt_ctrl'],
+                                        ctrl['integral'])
+            derivative = (error - ctrl['error'])/ctrl['dt_ctrl']
+            ctrl['error'] = np.where(active, error, ctrl['error'])
+            u = ctrl['Kp']*error + ctrl['Ki']*ctrl['integral'] + ctrl['Kd']*derivative
+
+        elif ctrl['mode'] == 'feedback':
+            ldb1 = 2/ctrl['tau'] # /s
+            ldb2 = 1/ctrl['tau']**2 # /s^2
+            u = control_feedback(self.z, self.w, self.dwdt, z_t, ctrl['nu'], ctrl['gammaV'],
+                                 self.L, self.c1, self.m, self.rho_cte, self.a, None,
+                                 ldb1, ldb2, ctrl['delta'])
+
+        elif ctrl['mode'] == 'kalman_feedback':
+            kalman = ctrl['kalman']
+            u = kalman.control(kalman.x_hat, self.v, z_t, ctrl)
+        return u
+
+    def init_kalman(self, kalman, w, z, gammaE, Ve, verbose=0):
+        ''' Initialize a batched Kalman filter, defaults mirror
+        autonomous_float.init_kalman
+        '''
+        N = self.N
+        dt = 1. #s
+        depth_rms = 1e-3 # m
+        vel_rms = depth_rms/dt # mm/s
+        t2V = self.vol_error if self._piston else np.zeros(N)
+        gamma_alpha_gammaE = 1e-8
+        def _diag(*d):
+            # (N,4,4) stack of diagonal matrices
+            d = np.stack([np.broadcast_to(np.array(x, dtype=float), (N,)) for x in d], axis=-1)
+            return d[:,:,None]*np.eye(d.shape[1])
+        kalman_default = {'dt': dt, 'm': self.m, 'a': self.a,
+                          'rho': self.rho_cte,
+                          'c1': self.c1, 'L' : self.L,
+                          'gammaV' : self.gammaV,
+                          'gamma': _diag(vel_rms**2, depth_rms**2,
+                                         gamma_alpha_gammaE**2, (10.*t2V)**2),
+                          'gamma_alpha': _diag((10*vel_rms)**2, depth_rms**2,
+                                               gamma_alpha_gammaE**2, (10.*t2V)**2),
+                          'gamma_beta': np.array([[depth_rms**2]]),
+                          'verbose': verbose}
+        if type(kalman) is dict:
+            kalman_default.update(kalman)
+        x0 = np.stack(np.broadcast_arrays(-w, -z, gammaE, Ve), axis=-1)
+        self.kalman = kalman_ensemble(x0, **kalman_default)
+        return self.kalman
+
+    def _piston_update(self, dt, dvdt, active):
+        ''' Vectorized piston.update, expressed in volume space
+        '''
+        adv = np.minimum(np.abs(dvdt), self.dvdt_max)
+        adv[adv < self.dvdt_min] = 0.
+        vol = np.clip(self.vol + np.sign(dvdt)*adv*dt, self.vol_min, self.vol_max)
+        self.vol = np.where(active, vol, self.vol)
+
+    def time_step(self, waterp, T=600., dt_step=1.,
+                  z=None, w=None, v=None, Ve=None, t0=0., Lv=None,
+                  usepiston=False, z_target=None, gammaE=None,
+                  ctrl=None,
+                  kalman=None,
+                  eta=lambda t: 0.,
+                  log=['z', 'w', 'v', 'dwdt', 'Ve', 'gammaV', 'u'], dt_store=60.,
+                  log_nrg=True, p_float=1.e5,
+                  integrator='euler',
+                  verbose=0):
+        ''' Time step all floats of the ensemble given initial conditions,
+        mirrors autonomous_float.time_step
+
+        Parameters
+        ----------
+
+        waterp: water profile object
+                Contains information about the water profile
+        T: float
+            Length of the simulation in seconds [s]
+        dt_step: float
+            Simulation time step [s]
+        z, w, v: float or np.ndarray
+            Initial positions [m], vertical velocities [m.s^-1] and
+            volume adjustements [m^3]
+        Ve: float or np.ndarray
+            Initial volume offsets, used to initialize the Kalman filter [m^3]
+        t0: float
+            Initial time [t]
+        Lv: float or np.ndarray
+            Drag length scale [m]
+        usepiston: boolean, default is False
+            Turns piston usage [no dimension]
+        z_target: function
+            Target trajectory as a function of time [m]
+        gammaE: float or np.ndarray
+            Initial equivalent compressibility for the Kalman filter [m^2]
+        ctrl: dict
+            Contains control parameters, gains may be arrays of size N
+        kalman: boolean or dict
+            Turns on batched Kalman filtering, dict entries override the
+            filter defaults (see init_kalman and kalman_ensemble), e.g.
+            {'seed': 0, 'steady_state_tol': 1e-6}
+        eta: function, eta_field or tuple
+            Isopycnal displacement as a function of time, or sampled
+            displacements (see autonomous_float.time_step), depth dependent
+            ones are evaluated at each member depth
+        log: list of strings or False
+            List of variables that will logged
+        dt_store: float
+            Time interval between log storage
+        log_nrg: boolean, default is True
+            Turns on/off nrg computation and storage
+        p_float: float [Pa]
+            Internal float pressure in Pa
+        integrator: str or callable, default is 'euler'
+            Time integration scheme, see autonomous_float.time_step
+
+        Returns
+        -------
+        log: xarray.Dataset
+            Logged variables with dimensions (t, member)
+        '''
+        N = self.N
+        if isinstance(eta, tuple):
+            eta = eta_field(*eta)
+        #
+        def _init_state(val, name, default):
+            if val is None:
+                val = getattr(self, name, default)
+            return np.broadcast_to(np.array(val, dtype=float), (N,)).copy()
+        self.z = _init_state(z, 'z', 0.)
+        self.w = _init_state(w, 'w', 0.)
+        self.dwdt = np.zeros(N)
+        self.Ve = _init_state(Ve, 'Ve', 0.)
+        #
+        if kalman:
+            if gammaE is None:
+                gammaE = self.gammaV
+            self.init_kalman(kalman, self.w, self.z, gammaE, self.Ve, verbose)
+        #
+        if usepiston:
+            if v is not None:
+                self.vol = np.clip(_init_state(v, 'vol', 0.), self.vol_min, self.vol_max)
+            self.v = self.vol.copy()
+            if ctrl:
+                ctrl = self._init_ctrl(ctrl, waterp, dt_step)
+                self.ctrl = ctrl
+        else:
+            self.v = _init_state(v, 'v', 0.)
+        v0 = self.v.copy()
+        u = np.zeros(N)
+        #
+        if Lv is None:
+            Lv = self.L
+        self.Lv = Lv
+        #
+        self.nrg = np.zeros(N) # Wh
+        # multi-rate schedule of the components
+        sched = scheduler(t0, dt_step, T)
+        if kalman:
+            sched.add('kalman', self.kalman.dt, getattr(self.kalman, 'phase', 0.))
+        if usepiston and ctrl:
+            sched.add('ctrl', ctrl['dt_ctrl'], ctrl.get('phase_ctrl', 0.))
+        if log and dt_store is not None:
+            sched.add('store', dt_store)
+        self.scheduler = sched
+        if log:
+            log = list(log)
+            if log_nrg and 'nrg' not in log:
+                log.append('nrg')
+            if kalman:
+                log += [item for item in _kalman_log if item not in log]
+            Nt = sched.ticks('store').size if dt_store is not None else 0
+            _log = {item: np.full((Nt, N), np.nan) for item in log}
+            _t = np.full(Nt, np.nan)
+            it = 0
+        #
+        if isinstance(integrator, str):
+            integrator = integrators[integrator]()
+        def rhs(t, z, w):
+            waterp.update_eta(eta, t, z)
+            return w, self._f(z, waterp, self.Lv, w=w)/(1+self.a)/self.m
+        #
+        print('Start time stepping %d floats for %d min ...'%(N, T/60.))
+        #
+        for k, due in enumerate(sched):
+            t = t0 + k*dt_step
+            #
+            # get vertical force on floats
+            waterp.update_eta(eta, t, self.z) # update isopycnal displacement
+            _f = self._f(self.z, waterp, self.Lv)
+            #
+            # state estimation
+            if 'kalman' in due:
+                self.kalman.update_kalman(u, self.v, self.z)
+            #
+            # control starts here
+            if 'ctrl' in due:
+                # activate control only if difference between the target and actual vertical
+                # position is more than the dz_nochattering threshold
+                active = np.abs(self.z-z_target(t)) > ctrl['dz_nochattering']
+                if active.any():
+                    u = np.where(active, self._control(z_target, ctrl, t, active), u)
+                    v0 = np.where(active, self.vol, v0)
+                    self._piston_update(dt_step, u, active)
+                    self.v = self.vol.copy()
+                # energy integration, 1e4 converts from dbar to Pa
+                if log_nrg:
+                    moved = self.v != v0
+                    self.nrg[moved] += (dt_step * np.abs((waterp.get_p(self.z)*1.e4 - p_float)*u)
+                                        *watth /self.efficiency)[moved]
+
+            # Ve
+            self.gammaV = self.gamma*self.volume(z=self.z, waterp=waterp) #m^2
+            self.Ve = _f/(g*self.rho_cte) - self.gammaV * self.z - self.v
+
+            # store
+            if 'store' in due:
+                _t[it] = t
+                _state = {'z': self.z, 'w': self.w, 'v': self.v, 'dwdt': _f/self.m,
+                          'Ve': self.Ve, 'gammaV': self.gammaV, 'u': u, 'nrg': self.nrg}
+                if kalman:
+                    x_hat = self.kalman.x_hat
+                    _state.update(z_kalman=x_hat[:,1], w_kalman=x_hat[:,0],
+                                  gammaE_kalman=x_hat[:,2], Ve_kalman=x_hat[:,3])
+                for item in log:
+                    _log[item][it,:] = _state[item]
+                it += 1
+
+            # update variables
+            self.dwdt = _f/(1+self.a)/self.m
+            self.z, self.w = integrator(rhs, t, self.z, self.w, dt_step,
+                                        self.w, self.dwdt)
+            self.z = np.minimum(self.z, 0.)
+        print('... time stepping done')
+        #
+        if log:
+            self.log = self._log2xr(_t[:it], {item: _log[item][:it,:] for item in log})
+            return self.log
+
+    def _log2xr(self, t, log):
+        ''' Gather logs and member parameters into an xarray Dataset
+        '''
+        ds = xr.Dataset({item: (['t', 'member'], val) for item, val in log.items()},
+                        coords={'t': t, 'member': np.arange(self.N)})
+        params = _float_params + (_piston_params if self._piston else [])
+        for key in params:
+            ds[key] = ('member', getattr(self, key))
+        return ds
+
+
+#------------------------------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------------------------------
+
+#
+class kalman_ensemble():
+    ''' Kalman filter for the state estimation of an ensemble of floats,
+    vectorized counterpart of float_lib.Kalman: states are stacked in
+    (N,4) arrays and covariances in (N,4,4) arrays.
+    The observation is the depth only, the innovation covariance is thus
+    a scalar per member and is not inverted.
+
+    Parameters
+    ----------
+    x0: np.ndarray
+        Initial states [-w, -z, gammaE, Ve], shape (N,4)
+    dt: float
+        Filter time step, shared by all members [s]
+    m, a, rho, c1, L, gammaV: float or np.ndarray
+        Float parameters, scalars or arrays of size N
+    gamma, gamma_alpha: np.ndarray
+        Initial state covariance and model noise covariance, (4,4) or (N,4,4)
+    gamma_beta: np.ndarray
+        Observation noise covariance, (1,1) or (N,1,1)
+    seed: int, optional
+        Seed of the observation noise generator. If None, the global numpy
+        generator is used, which reproduces float_lib.Kalman for N=1
+    steady_state_tol: float, optional
+        If provided, gains and covariances of a member are frozen once the
+        relative variation of its covariance diagonal over one update falls
+        below this tolerance. Once all members have converged, updates skip
+        covariance computations altogether
+    '''
+
+    def __init__(self, x0, dt=1., m=None, a=None, rho=None, c1=None, L=None,
+                 gammaV=None, gamma=None, gamma_alpha=None, gamma_beta=None,
+                 seed=None, steady_state_tol=None, verbose=0, **params):
+
+        for key,val in params.items():
+            setattr(self,key,val)
+        self.x_hat = np.array(x0, dtype=float)
+        self.N = self.x_hat.shape[0]
+        N = self.N
+        self.dt = dt
+        self.m, self.a, self.rho = m, a, rho
+        self.c1, self.L, self.gammaV = c1, L, gammaV
+        self.gamma = np.broadcast_to(gamma, (N,4,4)).copy()
+        self.gamma_alpha = np.broadcast_to(gamma_alpha, (N,4,4))
+        self.gamma_beta = np.broadcast_to(gamma_beta, (N,1,1))
+        self.verbose = verbose
+        #
+        if seed is None:
+            self._normal = np.random.normal
+        else:
+            self._normal = np.random.default_rng(seed).normal
+        #
+        self.A_coeff = g*np.asarray(rho)/((np.asarray(a)+1)*np.asarray(m))
+        self.B_coeff = np.asarray(c1)/(2*np.asarray(L)*(1+np.asarray(a)))
+        # linearized model, time varying terms are updated in update_kalman
+        self.A = np.broadcast_to(np.eye(4), (N,4,4)).copy()
+        self.A[:,1,0] = dt
+        self.A[:,0,3] = -dt*self.A_coeff
+        #
+        self.steady_state_tol = steady_state_tol
+        self.steady = np.zeros(N, dtype=bool)
+        self.K = np.zeros((N,4))
+        self._Gup = np.zeros((N,4,4))
+
+    def gen_obs(self, z):
+        ''' Noisy depth observations
+        '''
+        return -z + self._normal(loc=0.0, scale=np.sqrt(self.gamma_beta[:,0,0]))
+
+    def update_kalman(self, u, v, z):
+        # same conventions as float_lib.Kalman.update_kalman
+        self.A[:,0,0] = 1 - self.dt*self.B_coeff*np.abs(self.x_hat[:,0])
+        self.A[:,0,1] = 1 + self.dt*self.A_coeff*self.x_hat[:,2]
+        self.A[:,0,2] = 1 + self.dt*self.A_coeff*self.x_hat[:,1]
+        y = self.gen_obs(z)
+        xup, Gup = self.kalman_correc(self.x_hat, self.gamma, y)
+        self.x_hat, self.gamma = self.kalman_predict(xup, Gup, u, v, self.A)
+        if self.verbose>0:
+            print('x_hat', self.x_hat)
+
+    def kalman_correc(self, x0, gamma0, y):
+        ytilde = y - x0[:,1]
+        if self.steady.all():
+            self.ytilde = ytilde
+            return x0 + self.K*ytilde[:,None], self._Gup
+        # C = [0, 1, 0, 0]: S = gamma0[1,1] + beta, K = gamma0[:,1]/S
+        S = gamma0[:,1,1] + self.gamma_beta[:,0,0]
+        K = gamma0[:,:,1]/S[:,None]
+        Gup = gamma0 - K[:,:,None]*gamma0[:,None,1,:]
+        if self.steady.any():
+            K = np.where(self.steady[:,None], self.K, K)
+            Gup = np.where(self.steady[:,None,None], self._Gup, Gup)
+        xup = x0 + K*ytilde[:,None]
+        #
+        self.S = S
+        self.K = K
+        self.ytilde = ytilde
+        return xup, Gup
+
+    def kalman_predict(self, xup, Gup, u, v, A):
+        if self.steady.all():
+            gamma1 = self.gamma
+        else:
+            gamma1 = A @ Gup @ A.transpose(0,2,1) + self.gamma_alpha
+            if self.steady.any():
+                gamma1 = np.where(self.steady[:,None,None], self.gamma, gamma1)
+            if self.steady_state_tol is not None:
+                self._check_steady(gamma1, Gup)
+        x1 = xup + self.f(xup, u, v)*self.dt
+        return x1, gamma1
+
+    def _check_steady(self, gamma1, Gup):
+        ''' Freeze gains and covariances of members that have converged
+        '''
+        d0 = np.diagonal(self.gamma, axis1=1, axis2=2)
+        d1 = np.diagonal(gamma1, axis1=1, axis2=2)
+        new = (np.amax(np.abs(d1-d0)/np.abs(d0), axis=1) < self.steady_state_tol) \
+              & ~self.steady
+        if new.any():
+            self._Gup[new] = Gup[new]
+            self.steady |= new
+            if self.verbose>0:
+                print('Kalman covariance converged for %d/%d members'
+                      %(self.steady.sum(), self.N))
+
+    def f(self, x, u, v):
+        dx = np.zeros_like(x)
+        dx[:,0] = -self.A_coeff*(x[:,3] - x[:,2]*x[:,1] + v) \
+                  -self.B_coeff*x[:,0]*np.abs(x[:,0])
+        dx[:,1] = x[:,0]
+        return dx
+
+    def control(self, x, v, depth_target, ctrl):
+        ''' Vectorized counterpart of float_lib.Kalman.control
+        '''
+        l1 = 2/ctrl['tau'] # /s
+        l2 = 1/ctrl['tau']**2 # /s^2
+        nu = ctrl['nu']
+        delta = ctrl['delta']
+        #
+        e = -depth_target - x[:,1]
+        y = x[:,0] - nu*np.arctan(e/delta)
+        dx1 = -self.A_coeff*(x[:,3] - x[:,2]*x[:,1] + v) \
+              -self.B_coeff*x[:,0]*np.abs(x[:,0])
+        D = 1. + (e/delta)**2
+        dy = dx1 + nu*x[:,0]/(delta*D)
+        s = np.where(x[:,0] > 0, 1., -1.)
+        return (1/self.A_coeff)*(l1*dy + l2*y \
+                + nu/delta*(dx1*D + 2*e*x[:,0]**2/delta**2)/(D**2) \
+                + s*2*self.B_coeff*x[:,0]*dx1) + x[:,2]*x[:,0]
@@ -1,8 +1,9 @@
-from math import atan
-import sys
+from math import atan, floor
+import sys, os
+import pickle, hashlib
+from time import perf_counter
 import numpy as np
 from scipy.interpolate import interp1d
-from scipy.optimize import fsolve, brentq
 from netCDF4 import Dataset
 import gsw
 
@@ -116,28 +117,54 @@ class autonomous_float():
 
     def volume4equilibrium(self, p_eq, temp_eq, rho_eq):
         ''' Find volume that needs to be added in order to be at equilibrium
-            prescribed pressure, temperature, density
+            prescribed pressure, temperature, density (floats or arrays)
         '''
-        v = fsolve(lambda x: rho_eq - self.rho(p=p_eq, temp=temp_eq, v=x),0.)[0]
-        return v
+        return self.m/rho_eq - self.V*(1.-self.gamma*p_eq+self.alpha*(temp_eq-self.temp0))
 
-    def z4equilibrium(self, waterp):
-        ''' Find depth that where float is at equilibrium
+    def z4equilibrium(self, waterp, v=None):
+        ''' Find depth that where float is at equilibrium, the shallowest
+        one if several exist, see equilibrium_maps
         '''
-        z = fsolve(lambda z: waterp.get_rho(z) - self.rho(z=z, waterp=waterp), 0.)[0]
-        return z
+        if v is None:
+            v = getattr(self, 'v', 0.)
+        return self.equilibrium_maps(waterp).depth(v)
 
     def adjust_m(self, p_eq, temp_eq, rho_eq):
         ''' Find mass that needs to be added in order to be at equilibrium
             prescribed pressure, temperature, density
         '''
-        def func(m):
-            self.m = m
-            return rho_eq - self.rho(p=p_eq, temp=temp_eq)
+        v = getattr(self, 'v', 0.)
         m0=self.m
-        self.m = fsolve(func,self.m)[0]
+        self.m = rho_eq*(self.V*(1.-self.gamma*p_eq+self.alpha*(temp_eq-self.temp0))+v)
         print('%.1f g were added to the float in order to be at equilibrium at %.0f dbar \n'%((self.m-m0)*1.e3,p_eq))
 
+    def equilibrium_maps(self, waterp, refresh=False, **kwargs):
+        ''' Tables of equilibrium depth vs piston volume and of required
+        volume vs depth, computed at once and cached for the float/water
+        profile pair. Maps are recomputed if float parameters, the water
+        profile or the isopycnal displacement change.
+
+        Parameters
+        ----------
+        waterp: water profile object
+        refresh: boolean
+            Force the computation of the maps
+        kwargs: passed to equilibrium_map (zmin, zmax, dz, v)
+
+        Returns
+        -------
+        emap: equilibrium_map
+        '''
+        key = (waterp._content_key(), tuple(np.ravel(waterp.eta)), self.m, self.V, self.gamma,
+               self.alpha, self.temp0, repr(sorted(kwargs.items())))
+        if not hasattr(self, '_eq_maps') or refresh:
+            self._eq_maps = {}
+        if key not in self._eq_maps:
+            if 'v' not in kwargs and hasattr(self, 'piston'):
+                kwargs['v'] = np.linspace(self.piston.vol_min, self.piston.vol_max, 200)
+            self._eq_maps[key] = equilibrium_map(self, waterp, **kwargs)
+        return self._eq_maps[key]
+
     def init_piston(self,**kwargs):
         self.piston = piston(self.model, **kwargs)
 
@@ -151,12 +178,10 @@ class autonomous_float():
     def set_piston4equilibrium(self, p_eq, temp_eq, rho_eq):
         ''' Adjust piston to be at equilibrium at a given pressure, temperature and density
         '''
-        self.v = self.piston.vol
-        #
-        def func(vol):
-            self.piston_update_vol(vol)
-            return rho_eq - self.rho(p=p_eq, temp=temp_eq)
-        vol = brentq(func, self.piston.vol_min, self.piston.vol_max)
+        vol = self.volume4equilibrium(p_eq, temp_eq, rho_eq)
+        if not self.piston.vol_min <= vol <= self.piston.vol_max:
+            print('Equilibrium volume is out of the piston range, piston is set at the closest bound')
+            vol = min(max(vol, self.piston.vol_min), self.piston.vol_max)
         self.piston_update_vol(vol)
         print('Piston reset : vol=%.1e cm^3  ' % (vol*1e6))
         return vol
@@ -180,13 +205,39 @@ class autonomous_float():
         f += -self.m*self.c1/(2*Lv) * np.abs(w - waterp.detadt) * (w - waterp.detadt) #
         return f
 
-    def _df(self,z,waterp,Lv):
+    def _df(self, z, waterp, Lv, v=None, w=None):
         ''' Compute gradients of the vertical force exterted on the float
+        with respect to z, w and v
         '''
-        df1 = ( self._f(z+5.e-2,waterp,Lv) - self._f(z-5.e-2,waterp,Lv) ) /1.e-1
-        df2 = ( self._f(z,waterp,Lv,w=self.w+5.e-3) - self._f(z,waterp,Lv,w=self.w-5.e-3) ) /1.e-2
-        df3 = ( self._f(z,waterp,Lv,v=self.v+5.e-5) - self._f(z,waterp,Lv,v=self.v-5.e-5) ) /1.e-4
-        return df1, df2, df3
+        return self._f_df(z, waterp, Lv, v=v, w=w)[1:4]
+
+    def _f_df(self, z, waterp, Lv, v=None, w=None):
+        ''' Compute the vertical force exterted on the float, its gradients
+        with respect to z, w and v, and the vertical derivative of the
+        float volume. Analytic expressions share water column lookups:
+
+        f = -m g + g rho_w (V(1-gamma p+alpha(temp-temp0))+v) - m c1/(2Lv) |w'| w'
+        '''
+        if self.c0 != 0:
+            print(' !!! linear drag coefficient not implemented yet')
+            return None
+        if v is None:
+            v = self.v
+        if w is None:
+            w = self.w
+        p, tempw, rhow = waterp.get_p(z), waterp.get_temp(z), waterp.get_rho(z)
+        dpdz, dtempdz = waterp.get_dz('p', z), waterp.get_dz('temp', z)
+        drhowdz = waterp.get_dz('rho', z)
+        #
+        vol = self.V*(1.-self.gamma*p+self.alpha*(tempw-self.temp0)) + v
+        dvoldz = self.V*(-self.gamma*dpdz+self.alpha*dtempdz)
+        wr = w - waterp.detadt
+        #
+        f = -self.m*g + g*rhow*vol - self.m*self.c1/(2*Lv)*np.abs(wr)*wr
+        df1 = g*(drhowdz*vol + rhow*dvoldz)
+        df2 = -self.m*self.c1/Lv*np.abs(wr)
+        df3 = g*rhow
+        return f, df1, df2, df3, dvoldz
 
     def compute_bounds(self,waterp,zmin,zmax=0.):
         ''' Compute approximate bounds on velocity and acceleration
@@ -224,12 +275,43 @@ class autonomous_float():
 
         return fmax, fmin, afmax, wmax
 
+    def motion_bounds(self, waterp, zmin, zmax=0., refresh=False):
+        ''' Cached compute_bounds, bounds are recomputed if float parameters,
+        piston limits, the water profile or the isopycnal displacement change
+        '''
+        if hasattr(self,'piston'):
+            vlim = (self.piston.vol_min, self.piston.vol_max)
+        else:
+            vlim = None
+        key = (waterp._content_key(), tuple(np.ravel(waterp.eta)), self.m, self.V, self.gamma,
+               self.alpha, self.temp0, self.L, self.c1, vlim, zmin, zmax)
+        if not hasattr(self, '_bounds') or refresh:
+            self._bounds = {}
+        if key not in self._bounds:
+            self._bounds[key] = self.compute_bounds(waterp, zmin, zmax=zmax)
+        return self._bounds[key]
+
     def init_kalman(self, kalman, w, z, gammaE, Ve, usepiston, t0, verbose):
 
+        x0 = [-w, -z, gammaE, Ve]
+
+        self.kalman = Kalman(x0, **self._kalman_params(kalman, verbose))
+        self.x_kalman = [self.kalman.x_hat]
+        self.gamma_kalman =[np.diag(self.kalman.gamma)]
+        self.t_kalman = [t0]
+
+    def _kalman_params(self, kalman, verbose):
+        ''' Kalman filter parameters: defaults derived from the float and
+        piston, updated with kalman if it is a dict
+        '''
         dt = 1. #s
         depth_rms = 1e-3 # m
         vel_rms = depth_rms/dt # mm/s
-        t2V = self.piston.vol_error  #vol_error = 7.158577010132995e-08
+        if hasattr(self, 'piston'):
+            t2V = self.piston.vol_error  #vol_error = 7.158577010132995e-08
+        else:
+            # e.g. offline replays, default piston of the float model
+            t2V = _default_vol_error(self.model)
         gamma_alpha_gammaE = 1e-8
         kalman_default = {'dt': dt, 'm': self.m, 'a': self.a,
                           'rho': self.rho_cte,
@@ -245,13 +327,109 @@ class autonomous_float():
 
         if type(kalman) is dict:
             kalman_default.update(kalman)
+        return kalman_default
 
-        x0 = [-w, -z, gammaE, Ve]
+    def save_checkpoint(self, file, **state):
+        ''' Save the full simulation state (float, piston, Kalman filter,
+        control and log states, random generator state) in a binary file,
+        see time_step. The file is replaced atomically.
 
-        self.kalman = Kalman(x0, **kalman_default)
-        self.x_kalman = [self.kalman.x_hat]
-        self.gamma_kalman =[np.diag(self.kalman.gamma)]
-        self.t_kalman = [t0]
+        Parameters
+        ----------
+        file: str
+            Checkpoint file
+        state: time stepping variables (step index, ...)
+        '''
+        fstate = {key: val for key, val in self.__dict__.items() if key != 'scheduler'}
+        if isinstance(fstate.get('ctrl'), dict) and 'waterp' in fstate['ctrl']:
+            # water profiles are provided again on resume
+            fstate['ctrl'] = dict(fstate['ctrl'], waterp=None)
+        state['float'] = fstate
+        state['random'] = np.random.get_state()
+        if hasattr(self, 'log'):
+            self.log.flush()
+        with open(file+'.tmp', 'wb') as fptr:
+            pickle.dump(state, fptr, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file+'.tmp', file)
+
+    def load_checkpoint(self, file, waterp=None):
+        ''' Restore the simulation state from a checkpoint file
+
+        Parameters
+        ----------
+        file: str
+            Checkpoint file
+        waterp: water profile object, optional
+            Water profile used by the control
+
+        Returns
+        -------
+        state: dict
+            time stepping variables
+        '''
+        with open(file, 'rb') as fptr:
+            state = pickle.load(fptr)
+        self.__dict__.update(state.pop('float'))
+        if isinstance(getattr(self, 'ctrl', None), dict) and 'waterp' in self.ctrl:
+            self.ctrl['waterp'] = waterp
+        np.random.set_state(state.pop('random'))
+        return state
+
+    def replay_kalman(self, t, v, z=None, p=None, lat=None, kalman=None,
+                      w0=0., gammaE=None, Ve=0., smooth=True):
+        ''' Re-estimate the float state from recorded data: depth (or
+        pressure) and piston volume histories, see Kalman.replay
+
+        Parameters
+        ----------
+        t: np.ndarray
+            Times of the depth/pressure record [s]
+        v: np.ndarray or tuple
+            Piston volume at times t [m^3], or (t_v, v) if sampled at
+            different times (linearly interpolated)
+        z: np.ndarray, optional
+            Depth record, negative downward [m]
+        p: np.ndarray, optional
+            Pressure record [dbar], used if z is not provided
+        lat: float, optional
+            Latitude used to convert pressure into depth
+        kalman: dict, optional
+            Filter parameters, see init_kalman
+        w0, gammaE, Ve: float
+            Initial state, gammaE defaults to self.gammaV
+
+        Returns
+        -------
+        ds: xarray.Dataset
+            Filtered (and smoothed) w, z, gammaE, Ve and their standard
+            deviations
+        '''
+        import xarray as xr
+        t = np.asarray(t, dtype=float)
+        if z is None:
+            z = gsw.z_from_p(np.asarray(p, dtype=float), lat)
+        z = np.asarray(z, dtype=float)
+        if isinstance(v, tuple):
+            v = np.interp(t, *v)
+        if gammaE is None:
+            gammaE = self.gammaV
+        if kalman is None:
+            kalman = True
+        # the float live filter is left untouched
+        kf = Kalman([-w0, -z[0], gammaE, Ve], **self._kalman_params(kalman, 0))
+        out = kf.replay(t, z, v, smooth=smooth)
+        #
+        ds = xr.Dataset(coords={'t': t})
+        ds['z_obs'] = ('t', z)
+        ds['v'] = ('t', np.broadcast_to(v, t.shape))
+        sign = np.array([-1., -1., 1., 1.])
+        for suffix in (['', '_smooth'] if smooth else ['']):
+            x = out['x'+suffix]*sign
+            std = np.sqrt(np.diagonal(out['gamma'+suffix], axis1=1, axis2=2))
+            for i, name in enumerate(['w', 'z', 'gammaE', 'Ve']):
+                ds[name+suffix] = ('t', x[:,i])
+                ds[name+suffix+'_std'] = ('t', std[:,i])
+        return ds
 
     def time_step(self, waterp, T=600., dt_step=1.,
                   z=None, w=None, v=None, Ve=None, t0=0., Lv=None,
@@ -262,7 +440,13 @@ class autonomous_float():
                   log=['t','z','w','v','dwdt', 'Ve', 'gammaV', 'u', 'z_kalman',
                        'w_kalman', 'v_kalman', 'Ve_kalman', 'gamma_diag1',
                        'gamma_diag2','gamma_diag3','gamma_diag4', 'dwdt_kalman', 'gammaE_kalman'], dt_store=60.,
+                  log_path=None,
                   log_nrg=True, p_float=1.e5,
+                  integrator='euler',
+                  events=None,
+                  checkpoint=None, dt_checkpoint=3600., resume=None,
+                  stop=None,
+                  profile=False,
                   verbose=0,
                   **kwargs):
         ''' Time step the float position given initial conditions
@@ -295,19 +479,133 @@ class autonomous_float():
         w_target: function
             Target velocity as a function of time [m.^s-1]
         ctrl: dict
-            Contains control parameters
-        eta: function
-            Isopycnal displacement as a function of time
+            Contains control parameters. Control, piston actuation and
+            energy integration form one component of the scheduler, run
+            every dt_ctrl [s] with ticks at phase_ctrl + n*dt_ctrl
+            (phase_ctrl defaults to 0)
+        kalman: boolean or dict, optional
+            Turns on the Kalman filter, a dict updates filter parameters
+            (see init_kalman). Correction and prediction form one
+            component, run every dt [s] with ticks at phase + n*dt
+            (phase defaults to 0)
+        eta: function, eta_field or tuple
+            Isopycnal displacement as a function of time, or sampled
+            displacements: eta_field or tuple (t, eta) or (t, eta, z)
         log: list of strings or False
             List of variables that will logged
         dt_store: float
             Time interval between log storage
+        log_path: str, optional
+            Directory where the log is memory-mapped, for long simulations
         log_nrg: boolean, default is True
             Turns on/off nrg computation and storage
         p_float: float [Pa]
             Internal float pressure in Pa
+        integrator: str or callable, default is 'euler'
+            Time integration scheme of the float vertical dynamics over one
+            time step: 'euler', 'rk4', 'rk23' (adaptive) or a callable,
+            see euler_step. Control, Kalman and storage still occur on the
+            dt_step grid.
+        events: dict, optional
+            Additional components (e.g. sensor models) called at their own
+            rate: {name: (dt, func)} or {name: (dt, func, phase)}, with
+            func(f, t, waterp). If func returns a dict, items that are
+            logged variables are stored in the log.
+            Components are dispatched by a scheduler (see scheduler), kept
+            in self.scheduler.
+        checkpoint: str, optional
+            File where the full simulation state is saved every
+            dt_checkpoint and at the end of the run, see save_checkpoint
+        dt_checkpoint: float
+            Time interval between checkpoints [s]
+        resume: str, optional
+            Checkpoint file the simulation is resumed from, bit-for-bit.
+            Other arguments (waterp, z_target, eta, ctrl, kalman, log ...)
+            need to match the original call, except for T which is the
+            total length from the original t0 and may be increased to
+            extend a run.
+        stop: func, optional
+            stop(f, t) is called at storage times, the simulation ends
+            early if it returns True (e.g. once the float has settled or
+            diverged). The final checkpoint then resumes from the stop time.
+        profile: boolean, default is False
+            Records cumulative wall time and call counts per phase of the
+            time step (eta, force, kalman, control, store, integrate ...)
+            and per water profile getter, available as self.timers after
+            the run (see phase_timers)
+
+        See stream for a generator counterpart that yields records while
+        the simulation runs.
         '''
+        dt_stop = dt_store if dt_store is not None else dt_step
+        for _ in self.stream(waterp, T=T, dt_step=dt_step,
+                             z=z, w=w, v=v, Ve=Ve, t0=t0, Lv=Lv,
+                             usepiston=usepiston, z_target=z_target, gammaE=gammaE,
+                             ctrl=ctrl, kalman=kalman, eta=eta,
+                             log=log, dt_store=dt_store, log_path=log_path,
+                             log_nrg=log_nrg, p_float=p_float,
+                             integrator=integrator, events=events,
+                             checkpoint=checkpoint, dt_checkpoint=dt_checkpoint,
+                             resume=resume,
+                             dt_yield=dt_stop if stop is not None else None,
+                             records=['t'],
+                             stop=(lambda r: stop(self, r['t'])) if stop is not None else None,
+                             profile=profile, verbose=verbose, **kwargs):
+            pass
+
+    def stream(self, waterp, T=600., dt_step=1.,
+               z=None, w=None, v=None, Ve=None, t0=0., Lv=None,
+               usepiston=False, z_target=None, gammaE=None,
+               ctrl=None,
+               kalman=None,
+               eta=lambda t: 0.,
+               log=False, dt_store=60.,
+               log_path=None,
+               log_nrg=True, p_float=1.e5,
+               integrator='euler',
+               events=None,
+               checkpoint=None, dt_checkpoint=3600., resume=None,
+               dt_yield=60., records=None, stop=None,
+               profile=False,
+               verbose=0,
+               **kwargs):
+        ''' Generator counterpart of time_step: yields decimated state
+        records while the simulation runs, memory use is thus bounded if
+        logging is off (default): Kalman estimate histories (x_kalman,
+        gamma_kalman, t_kalman) then only hold the latest estimate. Breaking out of the loop stops the
+        simulation, the float keeps its current state.
+
+        Usage:
+
+        for r in f.stream(waterp, T=86400., dt_yield=600., usepiston=True,
+                          z_target=z_target, ctrl=ctrl):
+            writer.write(r)
+            if abs(r['z']-z_target(r['t'])) > 100.:
+                break
+
+        Parameters
+        ----------
+        dt_yield: float
+            Time interval between records [s], dt_step for all time steps,
+            no record is yielded if None
+        records: list of strings, optional
+            Variables yielded among t, z, w, v, dwdt, Ve, gammaV, u, nrg and,
+            with a Kalman filter, z_kalman, w_kalman, gammaE_kalman,
+            Ve_kalman. All by default
+        stop: func, optional
+            stop(record) is called for each record, the simulation ends if
+            it returns True
+        Other parameters: see time_step
+
+        Yields
+        ------
+        record: dict
+        '''
+        prof = phase_timers() if profile else None
+        self.timers = prof
         t=t0
+        if isinstance(eta, tuple):
+            eta = eta_field(*eta)
         #
         if z is None:
             if not hasattr(self,'z'):
@@ -351,9 +649,8 @@ class autonomous_float():
                 
                 ctrl_default={'dt_ctrl': dt_step, 'dz_nochattering': 0.}
                 if ctrl['mode'] == 'sliding':
-                    ctrl_default = {'tau': 60., 'mode': 'sliding',
-                                    'waterp': waterp, 'Lv': self.L, } #,
-                    #                'f': self}
+                    ctrl_default.update({'tau': 60., 'mode': 'sliding',
+                                         'waterp': waterp, 'Lv': self.L, })
                 elif ctrl['mode'] == 'pid':
                     ctrl_default['error'] = 0.
                     ctrl_default['integral'] = 0.
@@ -397,89 +694,323 @@ class autonomous_float():
         self.Lv = Lv
         #
         if log_nrg:
-            if 'nrg' not in log:
+            if log and 'nrg' not in log:
                 log.append('nrg')
             self.nrg = 0. # Wh
-        if log:
+        if log and resume is None:
             if hasattr(self,'log'):
                 delattr(self,'log')
-            self.log = logger(log)
+            n_store = int(T/dt_store)+1 if dt_store is not None else 1
+            self.log = logger(log, n=n_store, path=log_path)
+        #
+        if isinstance(integrator, str):
+            integrator = integrators[integrator]()
+        self._nfeval = 0
+        def rhs(t, z, w):
+            self._nfeval += 1
+            waterp.update_eta(eta, t, z)
+            return w, self._f(z, waterp, self.Lv, w=w)/(1+self.a)/self.m
+        #
+        k0 = 0
+        partial = False
+        u = 0 #u initialisation for kalman
+        if resume is not None:
+            state = self.load_checkpoint(resume, waterp=waterp)
+            if state['dt_step'] != dt_step:
+                print('Warning: time step differs from the checkpoint one, %.2e s'
+                      %state['dt_step'])
+            k0, t0, u, v0 = state['k'], state['t0'], state['u'], state['v0']
+            # a run stopped early has processed step k0 except for the integration,
+            # whose force was computed before the control was applied
+            partial = state.get('partial', False)
+            _f_partial = state.get('force')
+            integrator = state['integrator']
+            if usepiston and ctrl:
+                ctrl = self.ctrl
+        #
+        # multi-rate schedule of the components
+        sched = scheduler(t0, dt_step, T)
+        if kalman and self.kalman:
+            sched.add('kalman', self.kalman.dt, getattr(self.kalman, 'phase', 0.))
+        if usepiston and ctrl:
+            sched.add('ctrl', ctrl['dt_ctrl'], ctrl.get('phase_ctrl', 0.))
+        if log and dt_store is not None:
+            sched.add('store', dt_store)
+        if events is None:
+            events = {}
+        for name, ev in events.items():
+            sched.add(name, *((ev[0],)+tuple(ev[2:])))
+        if checkpoint is not None:
+            sched.add('checkpoint', dt_checkpoint)
+        if dt_yield is not None:
+            sched.add('yield', dt_yield)
+        self.scheduler = sched
+        #
+        if prof is not None:
+            prof.lap('setup')
+            prof.wrap(waterp, ['get_p', 'get_temp', 'get_rho', 'get_dz'], prefix='waterp.')
         #
         print('Start time stepping for %d min ...'%(T/60.))
         #
         _f=0.
-        u = 0 #u initialisation for kalman
-
-        while t<t0+T:
-            #
-            # get vertical force on float
-            waterp.update_eta(eta, t) # update isopycnal displacement
-            _f = self._f(self.z, waterp, self.Lv)
-            #
-            # state estimation starts here
-            if kalman:
-                if self.kalman and t_modulo_dt(t, self.kalman.dt, dt_step):
+        # index of the first step not integrated, stored in the final checkpoint
+        k_end, stopped = len(sched), False
+
+        try:
+            for k in range(k0, len(sched)):
+                due = sched[k] if not (partial and k == k0) else ()
+                t = t0 + k*dt_step
+                if prof is not None: prof.lap('schedule')
+                #
+                if 'checkpoint' in due and k > k0:
+                    self.save_checkpoint(checkpoint, k=k, t0=t0, dt_step=dt_step,
+                                         u=u, v0=v0, integrator=integrator)
+                    if prof is not None: prof.lap('checkpoint')
+                #
+                # get vertical force on float
+                waterp.update_eta(eta, t, self.z) # update isopycnal displacement
+                if prof is not None: prof.lap('eta')
+                if partial and k == k0:
+                    _f = _f_partial
+                else:
+                    _f = self._f(self.z, waterp, self.Lv)
+                    self._nfeval += 1
+                if prof is not None: prof.lap('force')
+                #
+                # state estimation starts here
+                if 'kalman' in due:
                     self.kalman.update_kalman(u, self.v, self.z)
                     #
-                    self.x_kalman.append(self.kalman.x_hat)
-                    self.gamma_kalman.append(np.diag(self.kalman.gamma))
-                    self.t_kalman.append(t)
+                    if log:
+                        self.x_kalman.append(self.kalman.x_hat)
+                        self.gamma_kalman.append(np.diag(self.kalman.gamma))
+                        self.t_kalman.append(t)
+                    else:
+                        # latest estimate only, memory stays bounded
+                        self.x_kalman[:] = [self.kalman.x_hat]
+                        self.gamma_kalman[:] = [np.diag(self.kalman.gamma)]
+                        self.t_kalman[:] = [t]
+                    if prof is not None: prof.lap('kalman')
 
-            #
-            # control starts here
-            if usepiston and ctrl and t_modulo_dt(t, ctrl['dt_ctrl'], dt_step):
-                # activate control only if difference between the target and actual vertical
-                # position is more than the dz_nochattering threshold
-                if np.abs(self.z-z_target(t)) > ctrl['dz_nochattering']:
-                    if verbose>0:
-                        print('[-w, -z, -dwdt, gammaV, Ve]',[-self.w, -self.z, -self.dwdt, self.gammaV, self.Ve])
-                    u = control(self.z, z_target, ctrl, t=t, w=self.w,
-                                dwdt=self.dwdt, v=self.v) #, f=ctrl['f'])
-                    #
-                    v0 = self.piston.vol
-                    self.piston.update(dt_step, u)
-                    self.v = self.piston.vol
-                # energy integration, 1e4 converts from dbar to Pa
-                if log_nrg and (self.v != v0):
-                    self.nrg += dt_step * np.abs((waterp.get_p(self.z)*1.e4 - p_float)*u) \
-                                *watth /self.piston.efficiency
-
-            # Ve
-            #self.Ve = _f/g/self.rho - gamma_e * self.z - self.v
-            self.gammaV = self.gamma*self.volume(z=self.z, waterp=waterp) #m^2 #ajout
-            self.Ve = _f/(g*self.rho_cte) - self.gammaV * self.z - self.v
-
-            # store
-            if log:
-                if (dt_store is not None) and t_modulo_dt(t, dt_store, dt_step):
+                #
+                # control starts here
+                if 'ctrl' in due:
+                    # activate control only if difference between the target and actual vertical
+                    # position is more than the dz_nochattering threshold
+                    if np.abs(self.z-z_target(t)) > ctrl['dz_nochattering']:
+                        if verbose>0:
+                            print('[-w, -z, -dwdt, gammaV, Ve]',[-self.w, -self.z, -self.dwdt, self.gammaV, self.Ve])
+                        u = control(self.z, z_target, ctrl, t=t, w=self.w,
+                                    dwdt=self.dwdt, v=self.v, f=self)
+                        #
+                        v0 = self.piston.vol
+                        self.piston.update(dt_step, u)
+                        self.v = self.piston.vol
+                    # energy integration, 1e4 converts from dbar to Pa
+                    if log_nrg and (self.v != v0):
+                        self.nrg += dt_step * np.abs((waterp.get_p(self.z)*1.e4 - p_float)*u) \
+                                    *watth /self.piston.efficiency
+                    if prof is not None: prof.lap('control')
+
+                # Ve
+                #self.Ve = _f/g/self.rho - gamma_e * self.z - self.v
+                self.gammaV = self.gamma*self.volume(z=self.z, waterp=waterp) #m^2 #ajout
+                self.Ve = _f/(g*self.rho_cte) - self.gammaV * self.z - self.v
+                if prof is not None: prof.lap('Ve')
+
+                # additional components
+                for name in due:
+                    if name in events:
+                        out = events[name][1](self, t, waterp)
+                        if log and isinstance(out, dict):
+                            self.log.store(**out)
+                        if prof is not None: prof.lap('event.'+name)
+
+                # store
+                if 'store' in due:
                     self.log.store(t=t, z=self.z, w=self.w, v=self.v, dwdt=_f/self.m, Ve=self.Ve,
                                    gammaV=self.gammaV, u=u)
                     if kalman:
                         self.log.store(z_kalman=self.kalman.x_hat[1],
-                                   w_kalman=self.kalman.x_hat[0],gammaE_kalman=self.kalman.x_hat[2],
-                                   Ve_kalman=self.kalman.x_hat[3], gamma_diag1=self.kalman.gamma[0,0],
-                                   gamma_diag2=self.kalman.gamma[1,1],gamma_diag3=self.kalman.gamma[2,2],
-                                   gamma_diag4=self.kalman.gamma[3,3], dwdt_kalman = -self.kalman.A_coeff*\
-                                   (self.kalman.x_hat[2] + self.kalman.x_hat[3] -self.kalman.gammaV*self.kalman.x_hat[1]) \
-                                   -self.kalman.B_coeff*abs(self.kalman.x_hat[0])*self.kalman.x_hat[0])
+                               w_kalman=self.kalman.x_hat[0],gammaE_kalman=self.kalman.x_hat[2],
+                               Ve_kalman=self.kalman.x_hat[3], gamma_diag1=self.kalman.gamma[0,0],
+                               gamma_diag2=self.kalman.gamma[1,1],gamma_diag3=self.kalman.gamma[2,2],
+                               gamma_diag4=self.kalman.gamma[3,3], dwdt_kalman = -self.kalman.A_coeff*\
+                               (self.kalman.x_hat[2] + self.kalman.x_hat[3] -self.kalman.gammaV*self.kalman.x_hat[1]) \
+                               -self.kalman.B_coeff*abs(self.kalman.x_hat[0])*self.kalman.x_hat[0])
                     if log_nrg:
                         self.log.store(nrg=self.nrg)
+                    if prof is not None: prof.lap('store')
 
-            # update variables
-            self.z += dt_step*self.w
-            self.z = np.amin((self.z,0.))
-            self.w += dt_step*_f/(1+self.a)/self.m
-            self.dwdt = _f/(1+self.a)/self.m
-            t+=dt_step
+                # stream
+                if 'yield' in due:
+                    record = {'t': t, 'z': self.z, 'w': self.w, 'v': self.v,
+                              'dwdt': _f/self.m, 'Ve': self.Ve, 'gammaV': self.gammaV,
+                              'u': u}
+                    if log_nrg:
+                        record['nrg'] = self.nrg
+                    if kalman:
+                        record.update(z_kalman=self.kalman.x_hat[1], w_kalman=self.kalman.x_hat[0],
+                                      gammaE_kalman=self.kalman.x_hat[2],
+                                      Ve_kalman=self.kalman.x_hat[3])
+                    if records is not None:
+                        record = {key: record[key] for key in records if key in record}
+                    if stop is not None and stop(record):
+                        print('Simulation stopped at t=%.0f s'%t)
+                        k_end, stopped = k, True
+                        break
+                    if prof is not None: prof.lap('yield')
+                    yield record
+                    # time spent by the consumer is not accounted for
+                    if prof is not None: prof.restart()
+
+                # update variables
+                self.dwdt = _f/(1+self.a)/self.m
+                self.z, self.w = integrator(rhs, t, self.z, self.w, dt_step,
+                                            self.w, self.dwdt)
+                self.z = np.amin((self.z,0.))
+                if prof is not None: prof.lap('integrate')
+        finally:
+            if prof is not None:
+                prof.unwrap(waterp)
+        if checkpoint is not None:
+            self.save_checkpoint(checkpoint, k=k_end, t0=t0, dt_step=dt_step,
+                                 u=u, v0=v0, integrator=integrator, partial=stopped,
+                                 force=_f)
         print('... time stepping done')
 
+# ------------------------------------------------------------------------------------------------------------
+# time integrators
+
+def euler_step(rhs, t, z, w, dt, dzdt, dwdt):
+    ''' Explicit Euler step of the float vertical dynamics
+
+    Parameters
+    ----------
+    rhs: func
+        rhs(t, z, w) returns the time derivatives (dzdt, dwdt)
+    t: float
+        Time at the beginning of the step [s]
+    z, w: float or np.ndarray
+        Position [m] and vertical velocity [m.s^-1] at time t
+    dt: float
+        Time step [s]
+    dzdt, dwdt: float or np.ndarray
+        Time derivatives at time t, i.e. rhs(t, z, w)
+
+    Returns
+    -------
+    z, w: position and velocity at time t+dt
+    '''
+    return z + dt*dzdt, w + dt*dwdt
+
+def rk4_step(rhs, t, z, w, dt, dzdt, dwdt):
+    ''' Classical 4th order Runge-Kutta step, see euler_step for arguments
+    '''
+    k2z, k2w = rhs(t+dt/2., z+dt/2.*dzdt, w+dt/2.*dwdt)
+    k3z, k3w = rhs(t+dt/2., z+dt/2.*k2z, w+dt/2.*k2w)
+    k4z, k4w = rhs(t+dt, z+dt*k3z, w+dt*k3w)
+    return (z + dt/6.*(dzdt + 2.*k2z + 2.*k3z + k4z),
+            w + dt/6.*(dwdt + 2.*k2w + 2.*k3w + k4w))
+
+class rk23_step():
+    ''' Adaptive Bogacki-Shampine 3(2) embedded scheme, substeps are adjusted
+    such that the local error is below atol + rtol*|y| for both position and
+    velocity, and the end of each step is reached exactly.
+    See euler_step for call arguments.
+
+    Parameters
+    ----------
+    rtol: float
+        Relative tolerance
+    atol_z: float
+        Absolute tolerance on position [m]
+    atol_w: float
+        Absolute tolerance on velocity [m.s^-1]
+    '''
+
+    def __init__(self, rtol=1.e-6, atol_z=1.e-4, atol_w=1.e-6):
+        self.rtol = rtol
+        self.atol_z = atol_z
+        self.atol_w = atol_w
+        self.h = None
+        self.nreject = 0
+
+    def __call__(self, rhs, t, z, w, dt, dzdt, dwdt):
+        t_end = t + dt
+        hp = dt if self.h is None else self.h
+        k1z, k1w = dzdt, dwdt
+        while t_end - t > 1.e-9*dt:
+            h = min(hp, t_end - t)
+            k2z, k2w = rhs(t+h/2., z+h/2.*k1z, w+h/2.*k1w)
+            k3z, k3w = rhs(t+3.*h/4., z+3.*h/4.*k2z, w+3.*h/4.*k2w)
+            zn = z + h*(2./9.*k1z + 1./3.*k2z + 4./9.*k3z)
+            wn = w + h*(2./9.*k1w + 1./3.*k2w + 4./9.*k3w)
+            k4z, k4w = rhs(t+h, zn, wn)
+            ez = h*(-5./72.*k1z + 1./12.*k2z + 1./9.*k3z - 1./8.*k4z)
+            ew = h*(-5./72.*k1w + 1./12.*k2w + 1./9.*k3w - 1./8.*k4w)
+            err = max(np.amax(np.abs(ez)/(self.atol_z + self.rtol*np.abs(zn))),
+                      np.amax(np.abs(ew)/(self.atol_w + self.rtol*np.abs(wn))))
+            fac = min(5., max(.2, .9*err**(-1./3.))) if err > 0. else 5.
+            if err <= 1.:
+                t, z, w = t+h, zn, wn
+                k1z, k1w = k4z, k4w # first same as last
+                # a step shortened to hit t_end does not shrink the next one
+                hp = max(hp, h*fac) if h < hp else h*fac
+            else:
+                self.nreject += 1
+                hp = h*fac
+        self.h = hp
+        return z, w
+
+#
+integrators = {'euler': lambda: euler_step, 'rk4': lambda: rk4_step, 'rk23': rk23_step}
+
+def compare_integrators(f, waterp, T=1800., ref='rk4', dt_ref=.1,
+                        dt={'euler': [.1, 1.], 'rk4': [1., 2., 5.], 'rk23': [5., 20., 60.]},
+                        dt_store=60., **kwargs):
+    ''' Compare accuracy and cost of time integrators against a reference
+    solution computed with a small time step (integrator ref, dt_ref).
+    Extra arguments are passed to time_step (e.g. z, w, v, eta), time steps
+    need to divide dt_store.
+
+    Returns
+    -------
+    out: dict
+        keys are (integrator, dt) and values are dicts with maximum position
+        error [m], number of force evaluations and wall time [s]
+    '''
+    from copy import deepcopy
+    from time import time
+    #
+    def _run(integrator, dt_step):
+        lf = deepcopy(f)
+        t0 = time()
+        lf.time_step(waterp, T=T, dt_step=dt_step, dt_store=dt_store,
+                     integrator=integrator, log=['t','z','w'], log_nrg=False, **kwargs)
+        return lf, time()-t0
+    fref, _ = _run(ref, dt_ref)
+    out = {}
+    print('%-6s %8s %12s %10s %10s'%('scheme', 'dt [s]', 'max |dz| [m]', 'n_eval', 'time [s]'))
+    for integrator, ldt in dt.items():
+        for dt_step in ldt:
+            lf, wall = _run(integrator, dt_step)
+            n = min(lf.log.z.size, fref.log.z.size)
+            err = np.amax(np.abs(lf.log.z[:n]-fref.log.z[:n]))
+            out[(integrator, dt_step)] = {'error': err, 'n_eval': lf._nfeval, 'time': wall}
+            print('%-6s %8.2f %12.2e %10d %10.2f'%(integrator, dt_step, err, lf._nfeval, wall))
+    return out
+
 #
 def control(z, z_target, ctrl, t=None, w=None, f=None, dwdt=None, v=None):
     ''' Implements the control of the float position
     '''
-    z_t = z_target(t)
-    dz_t = (z_target(t+.05)-z_target(t-.05))/.1
-    d2z_t = (z_target(t+.05)-2.*z_target(t)+z_target(t-.05))/.05**2
+    if hasattr(z_target, 'derivatives'):
+        z_t, dz_t, d2z_t = z_target.derivatives(t)
+    else:
+        z_t = z_target(t)
+        dz_t = (z_target(t+.05)-z_target(t-.05))/.1
+        d2z_t = (z_target(t+.05)-2.*z_target(t)+z_target(t-.05))/.05**2
     #
     if ctrl['mode'] == 'sliding':
         # add tests: if w is None, if f is None ...
@@ -487,10 +1018,10 @@ def control(z, z_target, ctrl, t=None, w=None, f=None, dwdt=None, v=None):
         x2 = w
         #x3=self.V+self.v
         #f1=x2
-        f2 = f._f(z, ctrl['waterp'], ctrl['Lv'])/f.m
-        f3 = ( f.volume(z=z+.5, waterp=ctrl['waterp'])
-             - f.volume(z=z-.5, waterp=ctrl['waterp']) )/1. *x2 # dVdz*w
-        df1, df2, df3 = f._df(f.z, ctrl['waterp'], ctrl['Lv'])
+        # force, jacobian and dVdz share water column lookups
+        _f, df1, df2, df3, dvdz = f._f_df(z, ctrl['waterp'], ctrl['Lv'], w=w, v=v)
+        f2 = _f/f.m
+        f3 = dvdz*x2 # dVdz*w
         df1, df2, df3 = df1/f.m, df2/f.m, df3/f.m
         #
         d3y = ctrl['d3y_ctrl']*control_sliding(z, w, f2, z_t, dz_t, d2z_t, ctrl['tau'])
@@ -576,14 +1107,12 @@ def control_feedback(z, dz, d2z, z_t, nu, gammaV, L, c1, m, rho, a, waterp,
     y = x1 - nu*np.arctan(e/delta)
     dy = dx1 + nu*x1/(delta*D)
 
-    if dz < 0:
-        return (1/A)*(lbd1*dy + lbd2*y\
-               + nu/delta*(dx1*D + 2*e*x1**2/delta**2)/(D**2)\
-               + 2*B*x1*dx1) + gammaV*x1
-    else: #dz >= 0 not differentiable at value 0 : critical value
-        return (1/A)*(lbd1*dy + lbd2*y\
-               + nu/delta*(dx1*D + 2*e*x1**2/delta**2)/(D**2)\
-               - 2*B*x1*dx1) + gammaV*x1
+    # dz >= 0 not differentiable at value 0 : critical value
+    # np.where keeps this valid for arrays of floats (see float_ensemble)
+    sdrag = np.where(dz < 0, 1., -1.)
+    return (1/A)*(lbd1*dy + lbd2*y\
+           + nu/delta*(dx1*D + 2*e*x1**2/delta**2)/(D**2)\
+           + sdrag*2*B*x1*dx1) + gammaV*x1
 #
 
 
@@ -649,17 +1178,69 @@ def compute_gamma(R,t,material=None,E=None,mu=.35):
 class logger():
     ''' Store a log of the float trajectory
 
+    Variables are stored in preallocated columns that are grown
+    geometrically when full. Columns may be memory-mapped to files
+    for long simulations. Logged variables are accessible as
+    attributes, e.g. log.z, log.t
+
     Parameters
     ----------
     var: list of strings
         List containing the name of variables that will be logged
+    n: int, optional
+        Expected number of records, used to preallocate columns
+    path: str, optional
+        Directory where columns are memory-mapped (one file per variable)
+    growth: float, optional
+        Factor by which columns are enlarged when full
 
     '''
 
-    def __init__(self, var):
+    def __init__(self, var, n=1000, path=None, growth=2.):
         self.var = var
+        self._path = path
+        self._growth = growth
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+        self._size = {}
+        self._data = {}
         for item in var:
-            setattr(self, item, np.array([]))
+            self._size[item] = 0
+            self._data[item] = self._alloc(item, max(int(n), 1))
+
+    def __getattr__(self, item):
+        # only called if item is not found the usual way
+        if item.startswith('_') or item not in self._data:
+            raise AttributeError(item)
+        return self._data[item][:self._size[item]]
+
+    def __len__(self):
+        return max(self._size.values()) if self._size else 0
+
+    def _alloc(self, item, n, old=None):
+        ''' Allocate (or enlarge) the column of a variable
+        '''
+        if self._path is None:
+            col = np.empty(n)
+            if old is not None:
+                col[:old.size] = old
+            return col
+        file = os.path.join(self._path, item+'.dat')
+        if old is not None:
+            old.flush()
+            del old
+        else:
+            open(file, 'wb').close()
+        # enlarge file, existing data is preserved
+        with open(file, 'r+b') as fptr:
+            fptr.truncate(n*np.dtype('float64').itemsize)
+        return np.memmap(file, dtype='float64', mode='r+', shape=(n,))
+
+    def _grow(self, item, n):
+        col = self._data[item]
+        nnew = max(int(col.size*self._growth), n)
+        self._data[item] = None
+        self._data[item] = self._alloc(item, nnew, old=col)
 
     def store(self, **kwargs):
         ''' Appends variables to the logger database:
@@ -671,9 +1252,70 @@ class logger():
         The above line will append values 10. and 1. to variables t and v respectively
 
         '''
+        for item, val in kwargs.items():
+            if item not in self._data:
+                continue
+            i = self._size[item]
+            if np.ndim(val) == 0:
+                if i >= self._data[item].size:
+                    self._grow(item, i+1)
+                self._data[item][i] = val
+                self._size[item] = i+1
+            else:
+                val = np.ravel(val)
+                if i+val.size > self._data[item].size:
+                    self._grow(item, i+val.size)
+                self._data[item][i:i+val.size] = val
+                self._size[item] = i+val.size
+
+    def __getstate__(self):
+        # columns are trimmed, memory-mapped ones are reopened from files
+        state = dict(self.__dict__)
+        if self._path is None:
+            state['_data'] = {item: col[:self._size[item]].copy()
+                              for item, col in self._data.items()}
+        else:
+            self.flush()
+            state['_data'] = {item: col.size for item, col in self._data.items()}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._path is not None:
+            self._data = {item: np.memmap(os.path.join(self._path, item+'.dat'),
+                                          dtype='float64', mode='r+', shape=(n,))
+                          for item, n in self._data.items()}
+
+    def flush(self):
+        ''' Flush memory-mapped columns to disk
+        '''
+        if self._path is not None:
+            for col in self._data.values():
+                col.flush()
+
+    def to_xarray(self):
+        ''' Convert the log to an xarray Dataset, variables logged at the same
+        rate as t share the time dimension
+        '''
+        import xarray as xr
+        ds = xr.Dataset()
+        if 't' in self._data:
+            ds = ds.assign_coords(t=np.array(self.t))
         for item in self.var:
-            if item in kwargs:
-                setattr(self, item, np.hstack((getattr(self, item), kwargs[item])))
+            if item == 't':
+                continue
+            val = np.array(getattr(self, item))
+            if 't' in self._data and val.size == self._size['t']:
+                ds[item] = ('t', val)
+            else:
+                ds[item] = (item+'_index', val)
+        return ds
+
+    def to_netcdf(self, file, **kwargs):
+        ''' Store the log in a netcdf file
+        '''
+        self.to_xarray().to_netcdf(file, **kwargs)
+        print('Log stored to '+file)
 
 # utils
 def plot_float_density(z, f, waterp, mid=False):
@@ -763,7 +1405,12 @@ def plot_log(f, z_target=None, eta=None, title=None):
     if z_target is not None:
         ax.plot(t / 60., z_target(t), color='r', label='target')
         if eta is not None:
-            ax.plot(t / 60., z_target(t) + eta(t), color='green', label='target+eta')
+            if isinstance(eta, eta_field):
+                # depth dependent displacements are taken at the target depth
+                _eta = eta(t, z_target(t)+t*0.)
+            else:
+                _eta = eta(t)
+            ax.plot(t / 60., z_target(t) + _eta, color='green', label='target+eta')
     ax.legend(loc=0)
     ax.set_ylabel('z [m]')
     if title is not None:
@@ -834,9 +1481,17 @@ def descent(Tmax, zt, f, waterp, zstart = 0):
     waterp: water profile object
         Used to compute maximum accelerations
 
+    Returns
+    -------
+    traj: trajectory
+        callable, trajectories are cached per float/water profile
     '''
+    key = ('descent', Tmax, zt, zstart)
+    traj = _cached_trajectory(f, waterp, key)
+    if traj is not None:
+        return traj
     # compute bounds on motions
-    fmax, fmin, afmax, wmax = f.compute_bounds(waterp,-500.)
+    fmax, fmin, afmax, wmax = f.motion_bounds(waterp,-500.)
     # build time line
     t = np.arange(0.,Tmax,1.)
     # build trajectory
@@ -847,13 +1502,328 @@ def descent(Tmax, zt, f, waterp, zstart = 0):
     z_target[np.where(z_target<zt)] = zt
 
     # convert to callable function
-    return interp1d(t, z_target, kind='linear', fill_value='extrapolate')
+    return _cached_trajectory(f, waterp, key, trajectory(t, z_target))
+
+
+def mission(segments, f=None, waterp=None, zstart=0., dt=1., wmax=None, amax=None):
+    ''' Contruct a multi-segment mission trajectory
+
+    Parameters
+    ----------
+    segments: list of tuples
+        Segments executed in sequence:
+            ('descent', z), ('ascent', z) or ('transit', z): go to depth z
+            ('hold', T): stay at the current depth for T seconds
+            ('yoyo', z_bottom, z_top, n): n round trips between z_bottom and
+                z_top, ending at z_top (n>=1)
+        A dict may be appended to transit segments (including yoyos) to
+        overide vertical speed and acceleration: {'w': .05, 'a': 1.e-4}
+    f: float object, optional
+        Used to compute maximum accelerations and velocities
+    waterp: water profile object, optional
+        Used to compute maximum accelerations and velocities
+    zstart: float
+        Initial depth [m]
+    dt: float
+        Time step of the trajectory [s]
+    wmax, amax: float, optional
+        Maximum vertical velocity [m/s] and acceleration [m/s^2],
+        required if f and waterp are not provided, override float bounds
+        otherwise
+
+    Returns
+    -------
+    traj: trajectory
+        callable, trajectories are cached per float/water profile
+
+    Example
+    -------
+    traj = mission([('descent', -200.), ('hold', 1800.),
+                    ('yoyo', -200., -100., 3), ('ascent', 0., {'w': .05})],
+                   f=f, waterp=w)
+    '''
+    key = ('mission', repr(segments), zstart, dt, wmax, amax)
+    traj = _cached_trajectory(f, waterp, key)
+    if traj is not None:
+        return traj
+    if f is not None and waterp is not None:
+        fmax, fmin, afmax, _wmax = f.motion_bounds(waterp,-500.)
+        # same acceleration as descent
+        _amax = afmax/2./f.m
+        wmax = _wmax if wmax is None else wmax
+        amax = _amax if amax is None else amax
+    if wmax is None or amax is None:
+        print('mission: wmax and amax or f and waterp need to be provided')
+        return None
+    #
+    z = [np.array([zstart], dtype=float)]
+    for seg in segments:
+        kind = seg[0]
+        opts = seg[-1] if isinstance(seg[-1], dict) else {}
+        w, a = opts.get('w', wmax), opts.get('a', amax)
+        z0 = z[-1][-1]
+        if kind in ['descent', 'ascent', 'transit']:
+            z.append(_transit(z0, seg[1], w, a, dt))
+        elif kind == 'hold':
+            z.append(np.full(int(round(seg[1]/dt)), z0))
+        elif kind == 'yoyo':
+            if seg[3] < 1:
+                print('mission: yoyo segments need at least one round trip')
+                return None
+            z.append(_transit(z0, seg[1], w, a, dt))
+            for n in range(seg[3]):
+                if n>0:
+                    z.append(_transit(seg[2], seg[1], w, a, dt))
+                z.append(_transit(seg[1], seg[2], w, a, dt))
+        else:
+            print('mission: segment '+str(kind)+' is not implemented')
+            return None
+    z = np.concatenate(z)
+    t = np.arange(z.size)*dt
+    return _cached_trajectory(f, waterp, key, trajectory(t, z))
+
+
+def _transit(z0, z1, w, a, dt):
+    ''' Depths (excluding z0) of a transit from z0 to z1, speed increases
+    linearly with time up to w
+    '''
+    if z1 == z0:
+        return np.zeros(0)
+    s = np.sign(z1-z0)
+    # time steps needed, upper bound
+    n = int(np.ceil(abs(z1-z0)/(w*dt) + w/a/dt)) + 2
+    t = np.arange(1, n+1)*dt
+    z = z0 + s*np.cumsum(np.minimum(t*a, w)*dt)
+    k = np.argmax(s*(z-z1) >= 0.)
+    z = z[:k+1]
+    z[-1] = z1
+    return z
+
+
+def _cached_trajectory(f, waterp, key, traj=None):
+    ''' Get (traj is None) or store trajectories in the float cache
+    '''
+    if f is None or waterp is None:
+        return traj
+    if hasattr(f,'piston'):
+        vlim = (f.piston.vol_min, f.piston.vol_max)
+    else:
+        vlim = None
+    key = key + (waterp._content_key(), tuple(np.ravel(waterp.eta)), f.m, f.V, f.gamma,
+                 f.alpha, f.temp0, f.L, f.c1, vlim)
+    if not hasattr(f, '_trajectories'):
+        f._trajectories = {}
+    if traj is not None:
+        f._trajectories[key] = traj
+    return f._trajectories.get(key)
+
+
+#------------------------------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------------------------------
+
+
+class trajectory():
+    ''' Target trajectory tabulated on a uniform time grid, depth and its
+    first two time derivatives are precomputed and looked up in constant
+    time. Values are held outside of the time range (zero derivatives).
+
+    Parameters
+    ----------
+    t: np.ndarray
+        Time [s], resampled on a uniform grid if need be
+    z: np.ndarray
+        Depth [m]
+    dzdt, d2zdt2: np.ndarray, optional
+        Derivatives, computed by finite differences if not provided
+
+    A single sample is a constant target.
+    '''
+
+    def __init__(self, t, z, dzdt=None, d2zdt2=None):
+        t = np.atleast_1d(np.asarray(t, dtype=float))
+        z = np.atleast_1d(np.asarray(z, dtype=float))
+        if t.size == 0:
+            raise ValueError('trajectory requires at least one sample')
+        if t.size == 1:
+            # held on a two sample grid
+            t, z = np.array([t[0], t[0]+1.]), np.repeat(z, 2)
+            dzdt, d2zdt2 = np.zeros(2), np.zeros(2)
+        dt = np.diff(t)
+        if not np.allclose(dt, dt[0]):
+            tu = np.arange(t[0], t[-1]+dt.min()/2., dt.min())
+            z = np.interp(tu, t, z)
+            dzdt = None if dzdt is None else np.interp(tu, t, dzdt)
+            d2zdt2 = None if d2zdt2 is None else np.interp(tu, t, d2zdt2)
+            t = tu
+        self.t = t
+        self.t0, self.dt = t[0], t[1]-t[0]
+        self.z = z
+        self.dzdt = np.gradient(z, self.dt) if dzdt is None else np.asarray(dzdt, dtype=float)
+        self.d2zdt2 = np.gradient(self.dzdt, self.dt) if d2zdt2 is None \
+                        else np.asarray(d2zdt2, dtype=float)
+
+    @property
+    def T(self):
+        return self.t[-1]-self.t0
+
+    def _index(self, t):
+        x = (t-self.t0)/self.dt
+        n = self.t.size
+        if np.ndim(x) == 0:
+            inside = 0. <= x <= n-1
+            x = min(max(x, 0.), n-1.)
+            i = min(int(x), n-2)
+        else:
+            x = np.asarray(x, dtype=float)
+            inside = (x >= 0.) & (x <= n-1)
+            x = np.clip(x, 0., n-1.)
+            i = np.minimum(x.astype(int), n-2)
+        return i, x-i, inside
+
+    def __call__(self, t):
+        i, a, inside = self._index(t)
+        return self.z[i]*(1.-a) + self.z[i+1]*a
+
+    def derivatives(self, t):
+        ''' Returns depth, velocity and acceleration at times t
+        '''
+        i, a, inside = self._index(t)
+        z = self.z[i]*(1.-a) + self.z[i+1]*a
+        dzdt = (self.dzdt[i]*(1.-a) + self.dzdt[i+1]*a)*inside
+        d2zdt2 = (self.d2zdt2[i]*(1.-a) + self.d2zdt2[i+1]*a)*inside
+        return z, dzdt, d2zdt2
+
+    def __repr__(self):
+        return 'trajectory(t0=%.0fs, T=%.0fs, dt=%.2fs, z=[%.1f, %.1f]m)' \
+                %(self.t0, self.T, self.dt, self.z.min(), self.z.max())
 
 
 #------------------------------------------------------------------------------------------------------------
 #------------------------------------------------------------------------------------------------------------
 
 
+class equilibrium_map():
+    ''' Tables of float equilibria in a water profile, see
+    autonomous_float.equilibrium_maps
+
+    The volume required to be at equilibrium is computed in closed form
+    on a vertical grid, equilibrium depths are the crossings of this
+    profile, linearly interpolated between grid points.
+
+    Parameters
+    ----------
+    f: autonomous_float
+    waterp: water profile object
+    zmin, zmax: float, optional
+        Vertical bounds of the grid [m], default to the profile bounds
+    dz: float
+        Vertical resolution [m]
+    v: np.ndarray, optional
+        Volumes for which equilibrium depths are tabulated [m^3], defaults
+        to the range of required volumes
+
+    Attributes
+    ----------
+    z, v_eq: np.ndarray
+        Depth grid (from the surface downward) and volume required to be
+        at equilibrium
+    stable: np.ndarray
+        True where an equilibrium is stable, i.e. the float goes back to it
+        after a vertical displacement
+    v, z_eq: np.ndarray
+        Volumes and corresponding (shallowest) equilibrium depths, NaN if
+        there is none
+    '''
+
+    def __init__(self, f, waterp, zmin=None, zmax=0., dz=1., v=None):
+        if zmin is None:
+            valid = ~np.ma.getmaskarray(waterp.temp)
+            zmin = np.amin(np.ma.filled(waterp.z, np.nan)[valid])
+        self.z = np.arange(zmax, zmin-dz/2., -dz)
+        p, temp, rho = waterp.get_p(self.z), waterp.get_temp(self.z), waterp.get_rho(self.z)
+        self.v_eq = f.volume4equilibrium(p, temp, rho)
+        # the float needs a smaller volume to be at equilibrium deeper
+        self.stable = np.gradient(self.v_eq, self.z) > 0.
+        if v is None:
+            v = np.linspace(np.amin(self.v_eq), np.amax(self.v_eq), 200)
+        self.v = np.asarray(v, dtype=float)
+        self.z_eq = self.depth(self.v)
+
+    def volume(self, z):
+        ''' Volume required to be at equilibrium at depth z
+        '''
+        return np.interp(z, self.z[::-1], self.v_eq[::-1])
+
+    def depth(self, v):
+        ''' Shallowest equilibrium depth for volume v, NaN if there is none
+        '''
+        v1 = np.atleast_1d(np.asarray(v, dtype=float))
+        d = self.v_eq[None,:] - v1[:,None]
+        cross = (d[:,:-1] == 0.) | (np.signbit(d[:,:-1]) != np.signbit(d[:,1:]))
+        i = np.argmax(cross, axis=1)
+        n = np.arange(v1.size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(d[n,i] == 0., 0., d[n,i]/(d[n,i]-d[n,i+1]))
+        z = self.z[i] + frac*(self.z[i+1]-self.z[i])
+        z[~cross.any(axis=1)] = np.nan
+        return z[0] if np.ndim(v) == 0 else z.reshape(np.shape(v))
+
+
+#------------------------------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------------------------------
+
+
+def _piston_defaults(model):
+    ''' Default piston parameters of a float model, see piston
+    '''
+    # default parameters
+    params = {'r': 0.025, 'phi': 0., 'd': 0., 'vol': 0., 'omega': 0., 'lead': 0.00175, 'tick_per_turn': 48, \
+      'phi_min': 0., 'd_min': 0., 'd_max': 0.07, 'vol_max': 1.718e-4,'vol_min': 0., \
+      'omega_max': 60./48*2.*np.pi, 'omega_min': 0.,
+      'efficiency':.1}
+    
+    
+    
+    if model == 'ENSTA':
+        # default parameters: ENSTA float
+        params = {'r': 0.025, 'phi': 0., 'd': 0., 'vol': 0., 'omega': 0., 'lead': 0.00175, 'tick_per_turn': 48, \
+                  'phi_min': 0., 'd_min': 0., 'd_max': 0.07, 'vol_max': 1.718e-4,'vol_min': 0., \
+                  'omega_max': 60./48*2.*np.pi, 'omega_min': 0.,
+                  'efficiency':.1, 'increment_error' : 1}
+        params['d_increment'] = params['lead']/params['tick_per_turn']
+    
+    elif model == 'IFREMER':
+        # default parameters: IFREMER float
+        params = {'r': 0.0195/2, 'phi': 0., 'd': 0., 'vol': 0., 'omega': 0., 'lead': 1, \
+                  'phi_min': 0., 'd_min': 0., 'd_max': 0.090, 'vol_max': 2.688e-5,'vol_min': 0., \
+                  'translation_max': 0.12/5600.*225., 'translation_min': 0.12/5600.*10.,
+                  'efficiency':.1, 'd_increment' : 0.12/5600., 'increment_error' : 10}
+
+        #translation_max = d_increment*(225 pulses par seconde)  (vitesse de translation max en m/s)
+        #translation_min fixe arbitrairement pour l'instant
+        
+        #d_increment le 4 vient du facteur 4 de la roue codeuse de thomas
+        #d_increment = 0.12/5600 ou 0.090/4200 selon la prise en compte ou non du gros piston
+
+        #dmax = 0.102 ancienne valeur pour IFREMER
+        
+        #verifier si importance lead et angles lors de la regulation, ecraser parametres redondants
+        #vol_max = 0.090*np.pi*(0.0195/2)**2+0.030*np.pi*(0.080/2)**2 = 1.777e-4
+    return params
+
+
+def _default_vol_error(model):
+    ''' Smallest volume variation of the default piston of a float model,
+    without building the piston [m^3]
+    '''
+    params = _piston_defaults(model)
+    if 'd_increment' in params:
+        d_increment = params['d_increment']
+    else:
+        d_increment = params['lead']/params['tick_per_turn']
+    return d_increment*params['r']**2*np.pi*params.get('increment_error', 1)
+
+
 class piston():
     ''' Piston object, facilitate float buoyancy control
     '''
@@ -908,39 +1878,7 @@ class piston():
         """
         
         
-        # default parameters
-        params = {'r': 0.025, 'phi': 0., 'd': 0., 'vol': 0., 'omega': 0., 'lead': 0.00175, 'tick_per_turn': 48, \
-          'phi_min': 0., 'd_min': 0., 'd_max': 0.07, 'vol_max': 1.718e-4,'vol_min': 0., \
-          'omega_max': 60./48*2.*np.pi, 'omega_min': 0.,
-          'efficiency':.1}
-        
-        
-        
-        if model == 'ENSTA':
-            # default parameters: ENSTA float
-            params = {'r': 0.025, 'phi': 0., 'd': 0., 'vol': 0., 'omega': 0., 'lead': 0.00175, 'tick_per_turn': 48, \
-                      'phi_min': 0., 'd_min': 0., 'd_max': 0.07, 'vol_max': 1.718e-4,'vol_min': 0., \
-                      'omega_max': 60./48*2.*np.pi, 'omega_min': 0.,
-                      'efficiency':.1, 'increment_error' : 1}
-            self.d_increment = params['lead']/params['tick_per_turn']
-        
-        elif model == 'IFREMER':
-            # default parameters: IFREMER float
-            params = {'r': 0.0195/2, 'phi': 0., 'd': 0., 'vol': 0., 'omega': 0., 'lead': 1, \
-                      'phi_min': 0., 'd_min': 0., 'd_max': 0.090, 'vol_max': 2.688e-5,'vol_min': 0., \
-                      'translation_max': 0.12/5600.*225., 'translation_min': 0.12/5600.*10.,
-                      'efficiency':.1, 'd_increment' : 0.12/5600., 'increment_error' : 10}
-
-            #translation_max = d_increment*(225 pulses par seconde)  (vitesse de translation max en m/s)
-            #translation_min fixe arbitrairement pour l'instant
-            
-            #d_increment le 4 vient du facteur 4 de la roue codeuse de thomas
-            #d_increment = 0.12/5600 ou 0.090/4200 selon la prise en compte ou non du gros piston
-
-            #dmax = 0.102 ancienne valeur pour IFREMER
-            
-            #verifier si importance lead et angles lors de la regulation, ecraser parametres redondants
-            #vol_max = 0.090*np.pi*(0.0195/2)**2+0.030*np.pi*(0.080/2)**2 = 1.777e-4
+        params = _piston_defaults(model)
        
         
 	#48 encoches
@@ -1084,12 +2022,24 @@ class piston():
 
 class Kalman(object):
     ''' Kalman filter for float state estimation
+
+    Parameters
+    ----------
+    x0: list
+        Initial state [-w, -z, gammaE, Ve]
+    steady_state_tol: float, optional
+        If provided, the gain and covariances are frozen once the relative
+        variation of the covariance diagonal over one update falls below
+        this tolerance, updates then skip the covariance computations
+    params: dt, m, a, rho, c1, L, gammaV, gamma, gamma_alpha, gamma_beta, ...
     '''
 
     def __init__(self, x0, **params):
 
+        self.steady_state_tol = None
         for key,val in params.items():
             setattr(self,key,val)
+        self.steady = False
 
         self.x_hat = np.array(x0)
         #self.u = 0
@@ -1135,18 +2085,42 @@ class Kalman(object):
         return x1, gamma1
 
     def kalman_predict(self, xup, Gup, u, v, A):
-        gamma1 = (A @ Gup @ A.T)
-        gamma1 += self.gamma_alpha
+        if self.steady:
+            gamma1 = self.gamma
+        else:
+            gamma1 = (A @ Gup @ A.T)
+            gamma1 += self.gamma_alpha
+            if self.steady_state_tol is not None:
+                self._check_steady(gamma1, Gup)
         x1 = xup + self.f(xup, u, v)*self.dt
         return x1, gamma1
 
+    def _check_steady(self, gamma1, Gup):
+        ''' Freeze gain and covariances if the covariance has converged
+        '''
+        d0 = np.diag(self.gamma)
+        dvar = np.abs(np.diag(gamma1) - d0)/np.abs(d0)
+        if np.amax(dvar) < self.steady_state_tol:
+            self.steady = True
+            self._Gup = Gup
+            if self.verbose>0:
+                print('Kalman covariance converged, gain is now frozen')
+
     def kalman_correc(self,x0,gamma0,y):
         C = self.C
+        ytilde = np.array(y) - C @ x0
+        if self.steady:
+            xup = x0 + self.K@ytilde
+            self.ytilde = ytilde
+            return xup, self._Gup
         if self.verbose>0:
             print(C.shape, self.gamma_beta.shape, gamma0.shape)
         S = C @ gamma0 @ C.T + self.gamma_beta
-        K = gamma0 @ C.T @ np.linalg.inv(S)
-        ytilde = np.array(y) - C @ x0
+        if S.shape == (1,1):
+            # single observation, no need to invert
+            K = gamma0 @ C.T / S[0,0]
+        else:
+            K = gamma0 @ C.T @ np.linalg.inv(S)
         Gup = (np.eye(len(x0))- K @ C) @ gamma0
         xup = x0 + K@ytilde
         #
@@ -1168,6 +2142,87 @@ class Kalman(object):
         dx[3] = 0.0
         return dx
 
+    def replay(self, t, z, v, u=None, smooth=True):
+        ''' Filter (and smooth) a recorded depth series with the float model,
+        without simulating the float dynamics. The online filter state is
+        left untouched, x_hat and gamma are used as initial conditions.
+
+        Time steps may be non-uniform, the model noise covariance is then
+        scaled by dt/self.dt. The smoother is a Rauch-Tung-Striebel pass
+        based on the linearized models of the filter.
+
+        Parameters
+        ----------
+        t: np.ndarray
+            Observation times [s]
+        z: np.ndarray
+            Observed positions, negative downward [m]
+        v: np.ndarray
+            Piston volume at times t [m^3]
+        u: np.ndarray, optional
+            Control at times t, not used by the model
+        smooth: boolean, default is True
+            Turns on the smoother pass
+
+        Returns
+        -------
+        out: dict
+            t, x (filtered states, (n,4)), gamma (filtered covariances, (n,4,4)),
+            x_pred, gamma_pred (predicted states and covariances) and with
+            smooth: x_smooth, gamma_smooth
+            States are [-w, -z, gammaE, Ve]
+        '''
+        t = np.asarray(t, dtype=float)
+        y = -np.asarray(z, dtype=float)
+        v = np.broadcast_to(np.asarray(v, dtype=float), t.shape)
+        if u is None:
+            u = np.zeros_like(t)
+        n = t.size
+        dt = np.diff(t)
+        #
+        x_p = np.zeros((n,4))      # predicted states (prior)
+        P_p = np.zeros((n,4,4))
+        x_f = np.zeros((n,4))      # filtered states (posterior)
+        P_f = np.zeros((n,4,4))
+        A = np.zeros((n-1,4,4))    # linearized models between samples
+        x_p[0] = self.x_hat
+        P_p[0] = self.gamma
+        beta = self.gamma_beta[0,0]
+        I4 = np.eye(4)
+        for k in range(n):
+            x, P = x_p[k], P_p[k]
+            # correction, C = [0, 1, 0, 0]
+            K = P[:,1]/(P[1,1] + beta)
+            x_f[k] = x + K*(y[k] - x[1])
+            P_f[k] = P - np.outer(K, P[1,:])
+            if k == n-1:
+                break
+            # prediction, same linearization as update_kalman
+            dtk = dt[k]
+            Ak = I4.copy()
+            Ak[1,0] = dtk
+            Ak[0,3] = -dtk*self.A_coeff
+            Ak[0,0] = 1 - dtk*self.B_coeff*np.abs(x[0])
+            Ak[0,1] = 1 + dtk*self.A_coeff*x[2]
+            Ak[0,2] = 1 + dtk*self.A_coeff*x[1]
+            A[k] = Ak
+            x_p[k+1] = x_f[k] + self.f(x_f[k], u[k], v[k])*dtk
+            P_p[k+1] = Ak @ P_f[k] @ Ak.T + self.gamma_alpha*(dtk/self.dt)
+        out = {'t': t, 'x': x_f, 'gamma': P_f, 'x_pred': x_p, 'gamma_pred': P_p}
+        if not smooth:
+            return out
+        #
+        # smoother gains, G_k = P_f[k] A_k^T P_p[k+1]^-1, computed at once
+        G = np.linalg.solve(P_p[1:], A @ P_f[:-1]).transpose(0,2,1)
+        x_s = x_f.copy()
+        P_s = P_f.copy()
+        for k in range(n-2, -1, -1):
+            x_s[k] = x_f[k] + G[k] @ (x_s[k+1] - x_p[k+1])
+            P_s[k] = P_f[k] + G[k] @ (P_s[k+1] - P_p[k+1]) @ G[k].T
+        out['x_smooth'] = x_s
+        out['gamma_smooth'] = P_s
+        return out
+
     def control(self, x, v, depth_target, ctrl):
 
         l1 = 2/ctrl['tau'] # /s
@@ -1222,22 +2277,32 @@ class waterp():
         longitude of the selected location
     lat: float, optional
         latitude of the selected location
+    dz_table: float, optional
+        vertical resolution of the lookup table of water properties [m],
+        see waterp.tabulate
+    woa: woa_store, optional
+        store WOA profiles are extracted from, a shared store of the
+        default WOA files is used otherwise
 
     '''
 
     def __init__(self, pressure=None, temperature=None, salinity=None,
-                       lon=None, lat=None, name=None):
+                       lon=None, lat=None, name=None, dz_table=None, woa=None):
 
         self._pts, self._woa = False, False
+        self._table = None
 
         if all([pressure, temperature, salinity, lon, lat]):
             self._load_from_pts(pressure, temperature, salinity,
                                 lon, lat, name)
-        elif all([lon ,lat]):
-            self._load_from_woa(lon,lat,name)
+        elif lon is not None and lat is not None:
+            self._load_from_woa(lon,lat,name,woa)
         else:
             print('Inputs missing')
 
+        if dz_table is not None:
+            self.tabulate(dz=dz_table)
+
     def _load_from_pts(self, pressure, temperature, salinity, lon, lat,
                        name):
         self._pts=True
@@ -1258,29 +2323,18 @@ class waterp():
         if name is None:
             self.name = 'Provided water profile at lon=%.0f, lat=%.0f'%(self.lon,self.lat)
 
-    def _load_from_woa(self, lon, lat, name):
+    def _load_from_woa(self, lon, lat, name, woa=None):
         self._woa=True
         #
-        self._tfile = 'woa18_A5B7_t00_01.nc'
-        nc = Dataset(self._tfile,'r')
+        if woa is None:
+            woa = get_woa_store()
+        self._woa_store = woa
+        self._tfile, self._sfile = woa.tfile, woa.sfile
         #
-        glon = nc.variables['lon'][:]
-        glat = nc.variables['lat'][:]
-        ilon = np.argmin(np.abs(lon-glon))
-        ilat = np.argmin(np.abs(lat-glat))
-        self.lon = glon[ilon]
-        self.lat = glat[ilat]
+        self.lon, self.lat, self.temp, self.s = woa.column(lon, lat)
         #
-        self.z = -nc.variables['depth'][:].data
+        self.z = -woa.depth
         self.p = gsw.p_from_z(self.z,self.lat)
-        #
-        self.temp = nc.variables['t_an'][0,:,ilat,ilon]
-        nc.close()
-        #
-        self._sfile = 'woa18_A5B7_s00_01.nc'
-        nc = Dataset(self._sfile,'r')
-        self.s = nc.variables['s_an'][0,:,ilat,ilon]
-        nc.close()
         # derive absolute salinity and conservative temperature
         self.SA = gsw.SA_from_SP(self.s, self.p, self.lon, self.lat)
         self.CT = gsw.CT_from_t(self.SA, self.temp, self.p)
@@ -1294,11 +2348,9 @@ class waterp():
 
     def show_on_map(self):
         if self._woa:
-            nc = Dataset(self._tfile,'r')
-            glon = nc.variables['lon'][:]
-            glat = nc.variables['lat'][:]
-            temps = nc.variables['t_an'][0,0,:,:]
-            nc.close()
+            woa = self._woa_store
+            glon, glat = woa.lon, woa.lat
+            temps = woa.surface_temp()
             #
             crs=ccrs.PlateCarree()
             plt.figure(figsize=(10, 5))
@@ -1328,9 +2380,113 @@ class waterp():
         plt.grid()
         return self.name
 
+    def tabulate(self, dz=.1, zmin=None, zmax=None):
+        ''' Precompute pressure, in situ temperature, absolute salinity,
+        conservative temperature and density on a uniform vertical grid.
+        Getters then rely on an index computation and a linear blend
+        instead of building interpolators and calling gsw.
+        The table needs to be recomputed if profiles are modified.
+
+        Parameters
+        ----------
+        dz: float
+            vertical resolution of the table [m], controls accuracy
+        zmin, zmax: float, optional
+            vertical bounds of the table [m], default to the profile bounds
+        '''
+        # ignore levels masked below the seafloor (WOA)
+        valid = ~(np.ma.getmaskarray(self.SA) | np.ma.getmaskarray(self.CT))
+        z = np.ma.filled(self.z, np.nan)[valid]
+        SA = np.ma.filled(self.SA, np.nan)[valid]
+        CT = np.ma.filled(self.CT, np.nan)[valid]
+        p = np.ma.filled(self.p, np.nan)[valid]
+        if zmin is None:
+            zmin = np.amin(z)
+        if zmax is None:
+            zmax = max(np.amax(z), 0.)
+        n = int(np.ceil((zmax-zmin)/dz))+1
+        zt = zmin + np.arange(n)*dz
+        tb = {'z0': zmin, 'dz': dz, 'idz': 1./dz, 'n': n, 'z': zt}
+        tb['p'] = interp(z, p, zt)
+        tb['SA'] = interp(z, SA, zt)
+        tb['CT'] = interp(z, CT, zt)
+        tb['temp'] = gsw.conversions.t_from_CT(tb['SA'], tb['CT'], tb['p'])
+        tb['rho'] = gsw.density.rho(tb['SA'], tb['CT'], tb['p'])
+        # pressure sensitivities, used to correct for isopycnal displacements
+        tb['dtempdp'] = ( gsw.conversions.t_from_CT(tb['SA'], tb['CT'], tb['p']+1.)
+                        - gsw.conversions.t_from_CT(tb['SA'], tb['CT'], tb['p']-1.) )/2.
+        tb['drhodp'] = ( gsw.density.rho(tb['SA'], tb['CT'], tb['p']+1.)
+                       - gsw.density.rho(tb['SA'], tb['CT'], tb['p']-1.) )/2.
+        self._table = tb
+
+    def _lookup(self, key, z, deriv=False):
+        ''' Linear interpolation (extrapolation outside bounds) in the table,
+        returns the vertical derivative of the interpolant if deriv is True
+        '''
+        tb = self._table
+        v = tb[key]
+        if np.ndim(z) == 0:
+            x = (z - tb['z0'])*tb['idz']
+            i = min(max(int(floor(x)), 0), tb['n']-2)
+        else:
+            x = (np.asarray(z, dtype=float) - tb['z0'])*tb['idz']
+            i = np.clip(np.floor(x).astype(int), 0, tb['n']-2)
+        if deriv:
+            return (v[i+1]-v[i])*tb['idz']
+        return v[i] + (x-i)*(v[i+1]-v[i])
+
+    def _get_tabulated(self, key, z):
+        ''' Get a tabulated variable accounting for isopycnal displacements:
+        pressure is not displaced, in situ temperature and density are
+        corrected at first order for the pressure difference
+        '''
+        if key == 'p' or (np.ndim(self.eta) == 0 and self.eta == 0.):
+            return self._lookup(key, z)
+        ze = z - self.eta
+        v = self._lookup(key, ze)
+        if key in ['temp', 'rho']:
+            v = v + self._lookup('d'+key+'dp', ze) \
+                    * (self._lookup('p', z) - self._lookup('p', ze))
+        return v
+
+    def _get_tabulated_dz(self, key, z):
+        ''' Get the vertical derivative of a tabulated variable, consistent
+        with _get_tabulated
+        '''
+        if key == 'p' or (np.ndim(self.eta) == 0 and self.eta == 0.):
+            return self._lookup(key, z, deriv=True)
+        ze = z - self.eta
+        dv = self._lookup(key, ze, deriv=True)
+        if key in ['temp', 'rho']:
+            dp = self._lookup('p', z) - self._lookup('p', ze)
+            ddp = self._lookup('p', z, deriv=True) - self._lookup('p', ze, deriv=True)
+            dv = dv + self._lookup('d'+key+'dp', ze, deriv=True)*dp \
+                    + self._lookup('d'+key+'dp', ze)*ddp
+        return dv
+
+    def get_dz(self, var, z, dz=5.e-2):
+        ''' get the vertical derivative of a variable ('p', 'temp' or 'rho'),
+        tabulated if available, centered finite difference otherwise
+
+        Parameters
+        ----------
+        var: str
+            'p', 'temp' or 'rho'
+        z: float or np.ndarray
+            depth [m]
+        dz: float
+            finite difference half step [m], used without table
+        '''
+        if self._table is not None:
+            return self._get_tabulated_dz(var, z)
+        getter = getattr(self, 'get_'+var)
+        return (getter(z+dz) - getter(z-dz))/2./dz
+
     def get_temp(self,z):
         ''' get in situ temperature
         '''
+        if self._table is not None:
+            return self._get_tabulated('temp', z)
         #return interp(self.z, self.temp, z)
         SA = interp(self.z, self.SA, z-self.eta)
         CT = interp(self.z, self.CT, z-self.eta)
@@ -1341,51 +2497,475 @@ class waterp():
         ''' get practical salinity
         '''
         #return interp(self.z, self.s, z-self.eta)
-        SA = interp(self.z, self.SA, z-self.eta)
-        CT = interp(self.z, self.CT, z-self.eta)
+        SA, CT = self._get_SA_CT(z)
         p = self.get_p(z)
         return gsw.conversions.SP_from_SA(SA, p, self.lon, self.lat)
 
     def get_p(self, z):
         ''' get pressure
         '''
+        if self._table is not None:
+            return self._lookup('p', z)
         return interp(self.z, self.p, z)
 
     def get_theta(self, z):
         ''' get potential temperature
         '''
+        SA, CT = self._get_SA_CT(z)
+        return gsw.conversions.pt_from_CT(SA,CT)
+
+    def _get_SA_CT(self, z):
+        ''' get absolute salinity and conservative temperature
+        '''
+        if self._table is not None:
+            return self._get_tabulated('SA', z), self._get_tabulated('CT', z)
         SA = interp(self.z, self.SA, z-self.eta)
         CT = interp(self.z, self.CT, z-self.eta)
-        return gsw.conversions.pt_from_CT(SA,CT)
+        return SA, CT
 
     def get_rho(self, z, ignore_temp=False):
+        if self._table is not None and not ignore_temp:
+            return self._get_tabulated('rho', z)
         p = self.get_p(z)
-        SA = interp(self.z, self.SA, z-self.eta)
-        CT = interp(self.z, self.CT, z-self.eta)
+        SA, CT = self._get_SA_CT(z)
         if ignore_temp:
             CT[:]=self.CT[0]
             print('Uses a uniform conservative temperature in water density computation, CT= %.1f degC' %self.CT[0])
         return gsw.density.rho(SA, CT, p)
 
-    def update_eta(self, eta, t):
+    def _content_key(self):
+        ''' Hash of the water column (profiles, location and table
+        resolution), used in cache keys of quantities derived from it.
+        The isopycnal displacement is not included.
+        '''
+        h = hashlib.sha1()
+        for v in [self.z, self.p, self.SA, self.CT]:
+            h.update(np.asarray(np.ma.filled(v, np.nan), dtype=float).tobytes())
+        h.update(repr((self.lon, self.lat)).encode())
+        if self._table is not None:
+            tb = self._table
+            h.update(repr((tb['z0'], tb['dz'], tb['n'])).encode())
+        return h.hexdigest()
+
+    def update_eta(self, eta, t, z=None):
         ''' Update isopycnal diplacement and water velocity given a function
         for isopycnal displacement and time
 
         Parameters
         ----------
-        eta: func
-            Isopycnal as a function time
+        eta: func or eta_field
+            Isopycnal as a function time, or precomputed (possibly depth
+            dependent) displacement field
         t: float
             Time in seconds
+        z: float or np.ndarray, optional
+            Float depth(s), required by depth dependent eta_field
         '''
-        self.eta = eta(t)
-        self.detadt = (eta(t+.1)-eta(t-.1))/.2
+        if isinstance(eta, eta_field):
+            self.eta, self.detadt = eta.interp(t, z)
+        else:
+            self.eta = eta(t)
+            self.detadt = (eta(t+.1)-eta(t-.1))/.2
+
+
+#
+class eta_field():
+    ''' Isopycnal displacements sampled in time, and optionally in depth
+    (e.g. isothermal displacements derived from numerical simulations),
+    to be used in place of an eta function in time_step.
+    Displacements and their time derivative are linearly interpolated
+    from precomputed tables, depth dependent displacements are evaluated
+    at float depths (which may be arrays for ensembles).
+
+    Parameters
+    ----------
+    t: np.ndarray
+        Sampling times [s], increasing
+    eta: np.ndarray
+        Displacements [m], shape (nt,) or (nt, nz) (or (nz, nt)), NaNs are
+        replaced by 0
+    z: np.ndarray, optional
+        Sampling depths [m] for depth dependent displacements, increasing
+
+    Before t[0] and after t[-1], displacements are held constant.
+    '''
+
+    def __init__(self, t, eta, z=None):
+        self.t = np.asarray(t, dtype=float)
+        self.eta = np.nan_to_num(np.asarray(eta, dtype=float))
+        if z is not None:
+            self.z = np.asarray(z, dtype=float)
+            if self.eta.shape != (self.t.size, self.z.size):
+                self.eta = self.eta.T
+        else:
+            self.z = None
+        self.detadt = np.gradient(self.eta, self.t, axis=0)
+        dt = np.diff(self.t)
+        self._uniform = np.allclose(dt, dt[0])
+        self._idt = 1./dt[0]
+
+    @classmethod
+    def from_dataarray(cls, da, tdim='t', zdim='z'):
+        ''' Build from an xarray DataArray with a time dimension, and
+        optionally a vertical one
+        '''
+        if zdim in da.dims:
+            da = da.transpose(tdim, zdim)
+            return cls(da[tdim].values, da.values, z=da[zdim].values)
+        return cls(da[tdim].values, da.values)
+
+    def _tindex(self, t):
+        if np.ndim(t) == 0:
+            # scalar fast path, used at each time step
+            if self._uniform:
+                x = (t - self.t[0])*self._idt
+                i = min(max(int(floor(x)), 0), self.t.size-2)
+            else:
+                i = min(max(int(np.searchsorted(self.t, t))-1, 0), self.t.size-2)
+                x = i + (t-self.t[i])/(self.t[i+1]-self.t[i])
+        else:
+            t = np.asarray(t, dtype=float)
+            if self._uniform:
+                x = (t - self.t[0])*self._idt
+                i = np.clip(np.floor(x).astype(int), 0, self.t.size-2)
+            else:
+                i = np.clip(np.searchsorted(self.t, t)-1, 0, self.t.size-2)
+                x = i + (t-self.t[i])/(self.t[i+1]-self.t[i])
+        return i, x-i
+
+    def interp(self, t, z=None):
+        ''' Displacement and its time derivative at time(s) t and depth(s) z,
+        arrays of times and depths are broadcast against each other.
+        Depths are required for depth dependent displacements.
+        '''
+        if self.z is not None and z is None:
+            raise ValueError('Depth dependent eta_field requires depths z')
+        i, a = self._tindex(t)
+        if np.ndim(a) == 0:
+            inside = 0. <= a <= 1.
+            a = min(max(a, 0.), 1.)
+        else:
+            inside = (a >= 0.) & (a <= 1.)
+            a = np.clip(a, 0., 1.)
+        if self.z is None:
+            eta = (1.-a)*self.eta[i] + a*self.eta[i+1]
+            detadt = (1.-a)*self.detadt[i] + a*self.detadt[i+1]
+        else:
+            x = np.interp(z, self.z, np.arange(self.z.size, dtype=float))
+            j = np.minimum(np.floor(x).astype(int), self.z.size-2)
+            b = x - j
+            def _bilin(v):
+                return (1.-a)*((1.-b)*v[i,j] + b*v[i,j+1]) \
+                        + a*((1.-b)*v[i+1,j] + b*v[i+1,j+1])
+            eta, detadt = _bilin(self.eta), _bilin(self.detadt)
+        if np.ndim(inside) > 0:
+            detadt = np.where(inside, detadt, 0.)
+        elif not inside:
+            detadt = detadt*0.
+        return eta, detadt
+
+    def __call__(self, t, z=None):
+        return self.interp(t, z)[0]
+
+
+#
+class woa_store():
+    ''' Store of World Ocean Atlas (WOA) temperature and salinity columns
+
+    Grid coordinates are read once. Columns are read from the WOA files
+    only the first time they are requested, then kept in memory and,
+    optionally, in a local cache directory (one small file per grid
+    column) that persists across sessions.
+
+    Parameters
+    ----------
+    tfile, sfile: str
+        WOA temperature and salinity files
+    cache_dir: str, optional
+        Directory of the persistent column cache
+
+    Usage:
+
+    woa = woa_store(cache_dir='woa_cache')
+    wps = woa.waterps(lon_track, lat_track)
+
+    builds the water profiles along a float drift track
+    '''
+
+    def __init__(self, tfile='woa18_A5B7_t00_01.nc', sfile='woa18_A5B7_s00_01.nc',
+                 cache_dir=None):
+        self.tfile, self.sfile = tfile, sfile
+        self.cache_dir = cache_dir
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        nc = Dataset(tfile,'r')
+        self.lon = nc.variables['lon'][:]
+        self.lat = nc.variables['lat'][:]
+        self.depth = nc.variables['depth'][:].data
+        nc.close()
+        self._columns = {}
+        self._surface = None
+
+    def __repr__(self):
+        return 'WOA store: %s, %s, %d columns loaded'%(self.tfile, self.sfile,
+                                                      len(self._columns))
+
+    def __getstate__(self):
+        # loaded columns are not pickled, they are reloaded lazily
+        state = dict(self.__dict__)
+        state['_columns'], state['_surface'] = {}, None
+        return state
+
+    def index(self, lon, lat):
+        ''' Indices (ilat, ilon) of the grid points closest to lon/lat
+        (floats or arrays)
+        '''
+        ilon = np.argmin(np.abs(np.subtract.outer(np.atleast_1d(lon), self.lon)), axis=1)
+        ilat = np.argmin(np.abs(np.subtract.outer(np.atleast_1d(lat), self.lat)), axis=1)
+        if np.ndim(lon) == 0:
+            return ilat[0], ilon[0]
+        return ilat, ilon
+
+    def _cache_file(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, 'woa_%d_%d.npz'%key)
+
+    def load(self, keys):
+        ''' Load columns in memory, from the cache directory if available,
+        from the WOA files otherwise (opened once for all missing columns)
+
+        Parameters
+        ----------
+        keys: list of tuples
+            Grid indices (ilat, ilon)
+        '''
+        missing = []
+        for key in set(keys):
+            if key in self._columns:
+                continue
+            cfile = self._cache_file(key)
+            if cfile is not None and os.path.isfile(cfile):
+                d = np.load(cfile)
+                self._columns[key] = (np.ma.masked_invalid(d['temp']),
+                                      np.ma.masked_invalid(d['s']))
+            else:
+                missing.append(key)
+        if not missing:
+            return
+        nct, ncs = Dataset(self.tfile,'r'), Dataset(self.sfile,'r')
+        for key in missing:
+            temp = nct.variables['t_an'][0,:,key[0],key[1]]
+            s = ncs.variables['s_an'][0,:,key[0],key[1]]
+            self._columns[key] = (temp, s)
+            cfile = self._cache_file(key)
+            if cfile is not None:
+                np.savez(cfile, temp=np.ma.filled(temp, np.nan),
+                         s=np.ma.filled(s, np.nan))
+        nct.close()
+        ncs.close()
+
+    def column(self, lon, lat):
+        ''' Grid longitude, latitude, temperature and salinity closest
+        to lon/lat, profiles are copies of the stored ones and may be
+        modified
+        '''
+        key = tuple(int(i) for i in self.index(lon, lat))
+        self.load([key])
+        temp, s = self._columns[key]
+        return self.lon[key[1]], self.lat[key[0]], temp.copy(), s.copy()
+
+    def waterps(self, lon, lat, **kwargs):
+        ''' Build water profiles for lists of longitudes and latitudes,
+        all required columns are loaded at once
+
+        Parameters
+        ----------
+        lon, lat: list or np.ndarray
+        kwargs: passed to waterp (e.g. dz_table)
+        '''
+        ilat, ilon = self.index(np.asarray(lon), np.asarray(lat))
+        self.load(list(zip(ilat.tolist(), ilon.tolist())))
+        return [waterp(lon=lo, lat=la, woa=self, **kwargs) for lo, la in zip(lon, lat)]
+
+    def surface_temp(self):
+        ''' Surface temperature, read once
+        '''
+        if self._surface is None:
+            nc = Dataset(self.tfile,'r')
+            self._surface = nc.variables['t_an'][0,0,:,:]
+            nc.close()
+        return self._surface
+
+
+_woa_stores = {}
+
+def get_woa_store(tfile='woa18_A5B7_t00_01.nc', sfile='woa18_A5B7_s00_01.nc',
+                  cache_dir=None):
+    ''' Return a woa_store shared across water profiles for a set of files
+    '''
+    key = (tfile, sfile, cache_dir)
+    if key not in _woa_stores:
+        _woa_stores[key] = woa_store(tfile, sfile, cache_dir=cache_dir)
+    return _woa_stores[key]
 
 
 # ------------------------------------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------------------------------------
 # utils functions
 
+#
+class phase_timers():
+    ''' Cumulative wall time and call counts per phase of a simulation,
+    see autonomous_float.time_step(profile=True)
+
+    Phases are timed as laps: the time elapsed since the previous lap is
+    attributed to the phase. Wrapped functions (e.g. water profile getters)
+    are timed independently and overlap with laps.
+    '''
+
+    def __init__(self):
+        self.time = {}
+        self.count = {}
+        self._nested = set()
+        self._t = perf_counter()
+
+    def restart(self):
+        ''' Restart the lap clock, time elapsed since the last lap is ignored
+        '''
+        self._t = perf_counter()
+
+    def lap(self, phase):
+        t = perf_counter()
+        self.time[phase] = self.time.get(phase, 0.) + t - self._t
+        self.count[phase] = self.count.get(phase, 0) + 1
+        self._t = t
+
+    def timed(self, phase, func):
+        ''' Wrap func so that its calls are timed under phase
+        '''
+        self._nested.add(phase)
+        def wrapper(*args, **kwargs):
+            t = perf_counter()
+            out = func(*args, **kwargs)
+            self.time[phase] = self.time.get(phase, 0.) + perf_counter() - t
+            self.count[phase] = self.count.get(phase, 0) + 1
+            return out
+        return wrapper
+
+    def wrap(self, obj, methods, prefix=''):
+        ''' Time methods of an object, until unwrap is called
+        '''
+        for name in methods:
+            if hasattr(obj, name):
+                setattr(obj, name, self.timed(prefix+name, getattr(obj, name)))
+        self._wrapped = methods
+
+    def unwrap(self, obj):
+        for name in getattr(self, '_wrapped', []):
+            obj.__dict__.pop(name, None)
+        self._wrapped = []
+
+    def total(self):
+        ''' Total time of laps (wrapped functions are excluded)
+        '''
+        return sum(t for phase, t in self.time.items() if phase not in self._nested)
+
+    def to_dict(self):
+        return {phase: {'time': self.time[phase], 'count': self.count[phase]}
+                for phase in self.time}
+
+    def to_dataframe(self):
+        import pandas as pd
+        df = pd.DataFrame({'time': self.time, 'count': self.count})
+        df['time_per_call'] = df['time']/df['count']
+        df['fraction'] = df['time']/self.total()
+        df['nested'] = [phase in self._nested for phase in df.index]
+        return df.sort_values('time', ascending=False)
+
+    def __repr__(self):
+        strout = 'Phase timers, total %.3f s:\n'%self.total()
+        for phase in sorted(self.time, key=self.time.get, reverse=True):
+            strout += '  %-22s %9.4f s %9d calls %s\n'%(phase, self.time[phase], self.count[phase],
+                                                       '(nested)' if phase in self._nested else '')
+        return strout
+
+
+#
+class scheduler():
+    ''' Multi-rate scheduler on the integer time step grid
+
+    Each component is assigned a rate and a phase, its ticks t = phase + n*dt
+    are mapped once to the nearest time step index. Iterating over the
+    scheduler yields, for each time step, the tuple of components due.
+
+    Parameters
+    ----------
+    t0: float
+        Initial time [s]
+    dt_step: float
+        Simulation time step [s]
+    T: float
+        Length of the simulation [s]
+    '''
+
+    def __init__(self, t0, dt_step, T):
+        self.t0 = t0
+        self.dt_step = dt_step
+        self.nsteps = int(np.ceil(T/dt_step - 1e-9))
+        self.components = {}
+        self._due = [()]*self.nsteps
+
+    def add(self, name, dt=None, phase=0.):
+        ''' Register a component
+
+        Parameters
+        ----------
+        name: str
+            Component name
+        dt: float, optional
+            Time interval between ticks [s], every time step if None
+        phase: float
+            Time of a reference tick [s], ticks occur at phase + n*dt
+        '''
+        if dt is None or dt <= self.dt_step:
+            # at most one tick per time step
+            dt = self.dt_step if dt is None else dt
+            k = np.arange(self.nsteps)
+        else:
+            t1 = self.t0 + self.nsteps*self.dt_step
+            n = np.arange(np.ceil((self.t0 - phase)/dt - .5),
+                          np.floor((t1 - phase)/dt + .5) + 1)
+            k = np.unique(np.rint((phase + n*dt - self.t0)/self.dt_step).astype(int))
+            k = k[(k >= 0) & (k < self.nsteps)]
+        self.components[name] = (dt, phase, k)
+        for i in k:
+            self._due[i] = self._due[i] + (name,)
+
+    def remove(self, name):
+        if name in self.components:
+            for i in self.components.pop(name)[2]:
+                self._due[i] = tuple(c for c in self._due[i] if c != name)
+
+    def ticks(self, name):
+        ''' Time step indices of a component
+        '''
+        return self.components[name][2]
+
+    def __len__(self):
+        return self.nsteps
+
+    def __getitem__(self, k):
+        return self._due[k]
+
+    def __iter__(self):
+        return iter(self._due)
+
+    def __repr__(self):
+        return 'scheduler: %d steps, '%self.nsteps \
+            + ', '.join('%s (dt=%g, phase=%g, %d ticks)'%(name, c[0], c[1], c[2].size)
+                        for name, c in self.components.items())
+
 #
 def t_modulo_dt(t, dt, dt_step):
     threshold = 0.25 * dt_step / dt
@@ -0,0 +1,318 @@
+import os, io
+import pickle, hashlib
+import itertools
+import types
+from contextlib import redirect_stdout
+from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import xarray as xr
+
+
+#------------------------------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------------------------------
+
+# float attributes not relevant for the cache key
+_f_volatile = ['log', 'ctrl', 'kalman', 'x_kalman', 'gamma_kalman', 't_kalman',
+               'z', 'w', 'v', 'dwdt', 'Ve', 'nrg', '_nfeval', '_eq_maps', 'scheduler',
+               'timers', '_bounds', '_trajectories']
+# variables stored when logs are requested
+_log_var = ['z', 'w', 'v', 'nrg']
+
+
+class eta_sine():
+    ''' Sinusoidal isopycnal displacement, picklable and may thus be used
+    in parallel sweeps (lambdas cannot)
+
+    Parameters
+    ----------
+    amplitude: float
+        displacement amplitude [m]
+    period: float
+        displacement period [s]
+    '''
+
+    def __init__(self, amplitude=0., period=1200.):
+        self.amplitude = amplitude
+        self.period = period
+
+    def __call__(self, t):
+        return self.amplitude*np.sin(2.*np.pi/self.period*t)
+
+    def __repr__(self):
+        return 'eta_sine(amplitude=%r, period=%r)'%(self.amplitude, self.period)
+
+
+class z_constant():
+    ''' Constant target depth, picklable counterpart of lambda t: z+t*0.
+    '''
+
+    def __init__(self, z):
+        self.z = z
+
+    def __call__(self, t):
+        return self.z + np.asarray(t)*0.
+
+    def __repr__(self):
+        return 'z_constant(%r)'%(self.z)
+
+
+def run_sweep(grid, f, waterp, z_target, ctrl, eta=None,
+              T=1800., dt_step=1., dt_store=10.,
+              settle_tol=1., log=False, log_stride=1,
+              profile=False,
+              cache_dir=None, max_workers=None, verbose=1,
+              **kwargs):
+    ''' Run float simulations over a grid of parameters in parallel and
+    gather summary metrics in a labeled Dataset
+
+    Parameters
+    ----------
+    grid: dict
+        Parameters to sweep, keys are prefixed by the object they apply to:
+            'float.<param>': float attribute, e.g. 'float.gamma'
+            'ctrl.<param>': control parameter, e.g. 'ctrl.tau', 'ctrl.mode'
+            'eta.amplitude', 'eta.period': sinusoidal isopycnal displacement
+            'ts.<param>': time_step argument, e.g. 'ts.dt_step'
+            'waterp': index in the list of water profiles
+        values are lists
+    f: autonomous_float
+        Reference float, its piston needs to be initialized
+    waterp: waterp or list of waterp
+        Water profile(s)
+    z_target: float or function
+        Target depth or trajectory, functions need to be picklable for
+        parallel runs (e.g. output of descent, z_constant), lambdas may be
+        used with max_workers=0
+    ctrl: dict
+        Reference control parameters
+    eta: function, optional
+        Reference isopycnal displacement, needs to be picklable for
+        parallel runs (e.g. eta_sine)
+    T, dt_step, dt_store: float
+        see autonomous_float.time_step
+    settle_tol: float
+        Depth error threshold used to compute the settling time [m]
+    log: boolean
+        Store logs (t, z, w, v, nrg) decimated by log_stride, as log_t,
+        log_z, ... variables
+    profile: boolean
+        Profile time stepping phases, cumulative times are stored as
+        prof_<phase> variables (see autonomous_float.time_step)
+    cache_dir: str, optional
+        Directory where results are cached, points already computed are
+        not run again
+    max_workers: int, optional
+        Number of processes, runs serially if 0
+    kwargs: passed to time_step
+
+    Returns
+    -------
+    ds: xarray.Dataset
+        metrics (settling_time, overshoot, rms_error, nrg, z_final),
+        optionally logs and phase timings, with one dimension per swept
+        parameter
+    '''
+    if not isinstance(waterp, (list, tuple)):
+        waterp = [waterp]
+    if not callable(z_target):
+        z_target = z_constant(z_target)
+    base = {'f': f, 'waterp': list(waterp), 'z_target': z_target, 'ctrl': ctrl,
+            'eta': eta, 'settle_tol': settle_tol, 'log': log, 'log_stride': log_stride,
+            'ts': dict(T=T, dt_step=dt_step, dt_store=dt_store, **kwargs)}
+    if profile:
+        base['ts']['profile'] = True
+    base_key = _fingerprint(base) if cache_dir is not None else None
+    #
+    keys = list(grid.keys())
+    points = [dict(zip(keys, values)) for values in itertools.product(*grid.values())]
+    shape = tuple(len(grid[key]) for key in keys)
+    #
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    results = [None]*len(points)
+    todo = []
+    for i, point in enumerate(points):
+        cfile = _cache_file(cache_dir, base_key, point)
+        if cfile is not None and os.path.isfile(cfile):
+            with open(cfile, 'rb') as fptr:
+                results[i] = pickle.load(fptr)
+        else:
+            todo.append(i)
+    if verbose>0:
+        print('Sweep: %d points, %d cached, %d to run'
+              %(len(points), len(points)-len(todo), len(todo)))
+    #
+    def _store(i, out):
+        results[i] = out
+        cfile = _cache_file(cache_dir, base_key, points[i])
+        if cfile is not None:
+            with open(cfile, 'wb') as fptr:
+                pickle.dump(out, fptr)
+    if max_workers == 0:
+        for i in todo:
+            _store(i, run_point(points[i], base))
+    elif todo:
+        try:
+            pickle.dumps(base)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            raise ValueError('Parallel sweeps need picklable z_target, eta and time_step '
+                             +'arguments (e.g. z_constant, eta_sine instead of lambdas), '
+                             +'or max_workers=0: %s'%e)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(run_point, points[i], base): i for i in todo}
+            for n, future in enumerate(as_completed(futures)):
+                _store(futures[future], future.result())
+                if verbose>1:
+                    print('  %d/%d done'%(n+1, len(todo)))
+    #
+    return _gather(results, grid, shape)
+
+
+def run_point(point, base):
+    ''' Run one simulation of a sweep and compute metrics
+    '''
+    f = deepcopy(base['f'])
+    ctrl = deepcopy(base['ctrl'])
+    ts = dict(base['ts'])
+    eta = base['eta']
+    waterp = base['waterp'][0]
+    z_target = base['z_target']
+    eta_params = {}
+    for key, val in point.items():
+        if key == 'waterp':
+            waterp = base['waterp'][val]
+            continue
+        obj, param = key.split('.', 1)
+        if obj == 'float':
+            setattr(f, param, val)
+        elif obj == 'ctrl':
+            ctrl[param] = val
+        elif obj == 'eta':
+            eta_params[param] = val
+        elif obj == 'ts':
+            ts[param] = val
+        else:
+            raise ValueError('Unknown sweep parameter: '+key)
+    if eta_params:
+        eta = eta_sine(**eta_params)
+    if eta is not None:
+        ts['eta'] = eta
+    # keep auxiliary parameters consistent
+    if 'float.m' in point or 'float.V' in point:
+        f.rho_cte = f.m/f.V
+    if 'float.gamma' in point or 'float.V' in point:
+        f.gammaV = f.gamma*f.V
+    if 'v' not in ts:
+        ts['v'] = f.piston.vol
+    ts.setdefault('z', 0.)
+    ts.setdefault('w', 0.)
+    #
+    with redirect_stdout(io.StringIO()):
+        f.time_step(waterp, usepiston=True, z_target=z_target, ctrl=ctrl, **ts)
+    out = _metrics(f.log, z_target, base['settle_tol'],
+                   base['log'], base['log_stride'])
+    if getattr(f, 'timers', None) is not None:
+        out['timers'] = dict(f.timers.time)
+    return out
+
+
+def _metrics(log, z_target, settle_tol, store_log, log_stride):
+    ''' Summary metrics of a simulation log
+    '''
+    t, z = np.array(log.t), np.array(log.z)
+    zt = z_target(t)
+    e = z - zt
+    out = {}
+    # time after which the depth error remains below settle_tol
+    outside = np.where(np.abs(e) > settle_tol)[0]
+    if outside.size == 0:
+        out['settling_time'] = t[0]
+    elif outside[-1] == t.size-1:
+        out['settling_time'] = np.nan
+    else:
+        out['settling_time'] = t[outside[-1]+1]
+    # excursion beyond the final target, in the direction of travel
+    s = np.sign(zt[-1] - z[0])
+    out['overshoot'] = max(0., np.amax(s*(z - zt[-1]))) if s != 0 else np.amax(np.abs(e))
+    out['rms_error'] = np.sqrt(np.mean(e**2))
+    out['nrg'] = log.nrg[-1] if hasattr(log, 'nrg') and log.nrg.size>0 else np.nan
+    out['z_final'] = z[-1]
+    if store_log:
+        out['log'] = {'t': t[::log_stride]}
+        for item in _log_var:
+            if hasattr(log, item):
+                out['log'][item] = np.array(getattr(log, item))[::log_stride]
+    return out
+
+
+def _gather(results, grid, shape):
+    ''' Gather results in an xarray Dataset with one dimension per swept parameter
+    '''
+    dims = [key.replace('.', '_') for key in grid]
+    coords = {dim: list(grid[key]) for dim, key in zip(dims, grid)}
+    ds = xr.Dataset(coords=coords)
+    for m in ['settling_time', 'overshoot', 'rms_error', 'nrg', 'z_final']:
+        ds[m] = (dims, np.array([r[m] for r in results], dtype=float).reshape(shape))
+    if results and 'log' in results[0]:
+        # logs may differ in length if time_step arguments are swept
+        nt = max(r['log']['t'].size for r in results)
+        for item in ['t']+_log_var:
+            if item not in results[0]['log']:
+                continue
+            val = np.full((len(results), nt), np.nan)
+            for i, r in enumerate(results):
+                val[i, :r['log'][item].size] = r['log'][item]
+            ds['log_'+item] = (dims+['record'], val.reshape(shape+(nt,)))
+    if results and 'timers' in results[0]:
+        # phases may differ across points, e.g. with control modes
+        phases = sorted(set().union(*[r['timers'] for r in results]))
+        for phase in phases:
+            val = np.array([r['timers'].get(phase, 0.) for r in results])
+            ds['prof_'+phase.replace('.', '_')] = (dims, val.reshape(shape))
+    return ds
+
+
+def _fingerprint(base):
+    ''' Hash of the sweep reference configuration
+    '''
+    base = dict(base)
+    base['f'] = {key: val for key, val in sorted(vars(base['f']).items())
+                 if key not in _f_volatile}
+    buf = io.BytesIO()
+    _key_pickler(buf).dump(base)
+    return hashlib.sha1(buf.getvalue()).hexdigest()
+
+
+class _key_pickler(pickle.Pickler):
+    ''' Pickler used for cache keys only: lambdas and closures, which cannot
+    be pickled by reference, are replaced by their code, default arguments
+    and closure values
+    '''
+
+    def reducer_override(self, obj):
+        if isinstance(obj, types.FunctionType) and \
+                ('<lambda>' in obj.__qualname__ or '<locals>' in obj.__qualname__):
+            closure = tuple(c.cell_contents for c in obj.__closure__ or ())
+            return _function_key, (obj.__module__, obj.__qualname__, _code_key(obj.__code__),
+                                   obj.__defaults__, obj.__kwdefaults__, closure)
+        return NotImplemented
+
+
+def _code_key(code):
+    return (code.co_code, code.co_names,
+            tuple(_code_key(c) if isinstance(c, types.CodeType) else c
+                  for c in code.co_consts))
+
+
+def _function_key(*args):
+    # placeholder of functions in cache keys, never called
+    return None
+
+
+def _cache_file(cache_dir, base_key, point):
+    if cache_dir is None:
+        return None
+    key = hashlib.sha1((base_key+repr(sorted(point.items()))).encode()).hexdigest()
+    return os.path.join(cache_dir, key+'.p')
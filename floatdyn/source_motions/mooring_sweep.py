@@ -0,0 +1,283 @@
+''' Parallel sweeps of MoorDyn surface mooring computations
+
+The MoorDyn library keeps a global state and writes its outputs in the
+working directory: each case is run in its own process and directory.
+
+Example:
+    from mooring_sweep import run_sweep
+    ds = run_sweep(U0=[0., .1], U1=[.05, .1, .2],
+                   configs=[{'UnstrLen': 100.}, {'UnstrLen': 120.}],
+                   workdir='sweep', cache_dir='sweep/cache')
+    ds.to_netcdf('sweep.nc')
+'''
+
+import os, io
+import re
+import pickle, hashlib
+import itertools
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import xarray as xr
+
+
+#------------------------------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------------------------------
+
+# tables of lines.txt whose columns may be edited
+_tables = ['LINE TYPES', 'LINE PROPERTIES']
+
+
+def run_sweep(U1, U0=None, configs=None, template='Mooring/lines.txt',
+              lib='../compileSO/Lines.so', workdir='mooring_sweep',
+              cache_dir=None, max_workers=None, keep=False, nc_file=None,
+              verbose=1):
+    ''' Compute mooring equilibria over a grid of current speeds and line
+    configurations in parallel and merge line shapes and tensions in a
+    Dataset
+
+    Parameters
+    ----------
+    U1: list
+        bottom current speeds [m/s]
+    U0: list, optional
+        surface current speeds [m/s], equal to U1 if None (no U0 dimension)
+    configs: list, optional
+        line configurations, each one is either None (template unchanged),
+        the path to a lines.txt file or a dict of modifications of the
+        template: keys are column names of the line types and line
+        properties tables (e.g. 'UnstrLen', 'NumSegs', 'EA') or names of
+        solver options (e.g. 'WtrDpth', 'dtM'). Segment tensions are
+        only available if line outputs include them, e.g.
+        {'Flags/Outputs': 'pt'}
+    template: str
+        reference MoorDyn input file
+    lib: str
+        MoorDyn library
+    workdir: str
+        directory where case directories are created
+    cache_dir: str, optional
+        directory where results are cached, cases already computed are not
+        run again
+    max_workers: int, optional
+        number of processes, runs serially if 0
+    keep: boolean
+        keep case directories (MoorDyn input and output files)
+    nc_file: str, optional
+        netcdf file where the Dataset is stored
+    verbose: int
+
+    Returns
+    -------
+    ds: xarray.Dataset
+        x, y, z (node position), tension (segment tension) and fairten
+        (fairlead tension) with dimensions (U0, U1, config, node/segment),
+        NaN for cases where MoorDyn produced no output
+    '''
+    if configs is None:
+        configs = [None]
+    with open(template, 'r') as f:
+        template = f.read()
+    lib = os.path.abspath(lib)
+    workdir = os.path.abspath(workdir)
+    texts = [_lines_text(template, c) for c in configs]
+    #
+    tied = U0 is None
+    if tied:
+        cases = [(u, u, i) for u in U1 for i in range(len(configs))]
+        dims, shape = ['U1', 'config'], (len(U1), len(configs))
+    else:
+        cases = [(u0, u1, i) for u0, u1, i in itertools.product(U0, U1, range(len(configs)))]
+        dims, shape = ['U0', 'U1', 'config'], (len(U0), len(U1), len(configs))
+    keys = [_case_key(u0, u1, texts[i]) for u0, u1, i in cases]
+    #
+    for d in [workdir, cache_dir]:
+        if d is not None and not os.path.isdir(d):
+            os.makedirs(d)
+    results = [None]*len(cases)
+    todo = []
+    for n, key in enumerate(keys):
+        cfile = _cache_file(cache_dir, key)
+        if cfile is not None and os.path.isfile(cfile):
+            with open(cfile, 'rb') as f:
+                results[n] = pickle.load(f)
+        else:
+            todo.append(n)
+    if verbose>0:
+        print('Mooring sweep: %d cases, %d cached, %d to run'
+              %(len(cases), len(cases)-len(todo), len(todo)))
+    #
+    def _store(n, out):
+        results[n] = out
+        if 'x' not in out:
+            # no line output, MoorDyn failed: NaNs in the Dataset, not cached
+            if verbose>0:
+                print('  no output for U0=%g, U1=%g, config %d'%cases[n])
+            return
+        cfile = _cache_file(cache_dir, keys[n])
+        if cfile is not None:
+            with open(cfile, 'wb') as f:
+                pickle.dump(out, f)
+    def _args(n):
+        u0, u1, i = cases[n]
+        return (u0, u1, texts[i], lib, os.path.join(workdir, 'case_'+keys[n][:16]), keep)
+    if max_workers == 0:
+        for n in todo:
+            _store(n, run_case(*_args(n)))
+    elif todo:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(run_case, *_args(n)): n for n in todo}
+            for k, future in enumerate(as_completed(futures)):
+                _store(futures[future], future.result())
+                if verbose>1:
+                    print('  %d/%d done'%(k+1, len(todo)))
+    #
+    ds = _gather(results, dims, shape, U0, U1, configs)
+    if nc_file is not None:
+        ds.to_netcdf(nc_file)
+    return ds
+
+
+def run_case(U0, U1, lines, lib, path, keep=False):
+    ''' Compute the equilibrium of the mooring in the directory path
+
+    Parameters
+    ----------
+    U0, U1: float
+        surface and bottom current speeds [m/s]
+    lines: str
+        content of the MoorDyn input file
+    lib: str
+        absolute path of the MoorDyn library
+    path: str
+        case directory, created if need be
+    keep: boolean
+        keep the case directory
+
+    Returns
+    -------
+    out: dict
+        U0, U1, t, x, y, z, tension, fairten at the last output time
+    '''
+    from surface_mooring import wrapper
+    mdir = os.path.join(path, 'Mooring')
+    if not os.path.isdir(mdir):
+        os.makedirs(mdir)
+    with open(os.path.join(mdir, 'lines.txt'), 'w') as f:
+        f.write(lines)
+    cwd = os.getcwd()
+    # MoorDyn reads and writes in Mooring/ relative to the working directory,
+    # which is specific to each process
+    os.chdir(path)
+    try:
+        with redirect_stdout(io.StringIO()):
+            w = wrapper(lib)
+            w.LinesInit([0., 0., 0.], [0., 0., 0.], U0, U1)
+            # closing the library flushes the output files
+            del w
+        out = _read_last('Mooring/Line1.out')
+        out['fairten'] = _read_last('Mooring/Lines.out').get('FairTen1', np.nan)
+    finally:
+        os.chdir(cwd)
+    out['U0'], out['U1'] = U0, U1
+    if not keep:
+        for fname in os.listdir(mdir):
+            os.remove(os.path.join(mdir, fname))
+        os.rmdir(mdir)
+        os.rmdir(path)
+    return out
+
+
+def _lines_text(template, config):
+    ''' MoorDyn input file content for a configuration
+    '''
+    if config is None:
+        return template
+    if isinstance(config, str):
+        with open(config, 'r') as f:
+            return f.read()
+    lines = template.split('\n')
+    done = set()
+    table, header = None, None
+    for i, line in enumerate(lines):
+        tokens = line.split()
+        if line.startswith('-'):
+            table = next((t for t in _tables if t in line), None)
+            header = None
+            continue
+        if table is not None and header is None:
+            # first line of a table: column names, second line: units
+            header = tokens
+            continue
+        if not tokens or tokens[0].startswith('('):
+            continue
+        if table is not None:
+            keys = [key for key in config if key in header]
+            if keys and len(tokens)==len(header):
+                for key in keys:
+                    tokens[header.index(key)] = str(config[key])
+                    done.add(key)
+                lines[i] = '  '.join(tokens)
+        elif len(tokens)>=2 and tokens[1] in config:
+            # solver option: value name - description
+            lines[i] = re.sub(r'^\S+', str(config[tokens[1]]), line)
+            done.add(tokens[1])
+    missing = set(config) - done
+    if missing:
+        raise ValueError('Unknown line parameters: '+', '.join(sorted(missing)))
+    return '\n'.join(lines)
+
+
+def _read_last(fname):
+    ''' Last record of a MoorDyn output file, as a dict: positions of nodes
+    are gathered in x, y, z and segment tensions in tension
+    '''
+    from surface_mooring import read_line_output
+    if not os.path.isfile(fname):
+        return {}
+    t, X, other = read_line_output(fname, nlast=1)
+    if t.size == 0:
+        return {}
+    out = {key: val[-1] for key, val in other.items()}
+    out['t'] = t[-1]
+    out['x'], out['y'], out['z'] = X[-1,:,0], X[-1,:,1], X[-1,:,2]
+    out['tension'] = out.pop('Te', np.zeros(0))
+    return out
+
+
+def _gather(results, dims, shape, U0, U1, configs):
+    ''' Gather results in an xarray Dataset, line shapes may differ in
+    number of nodes across configurations and are padded with NaNs
+    '''
+    coords = {'U1': list(U1), 'config': np.arange(len(configs))}
+    if 'U0' in dims:
+        coords['U0'] = list(U0)
+    ds = xr.Dataset(coords=coords)
+    ds['config_desc'] = ('config', [repr(c) for c in configs])
+    for v, dim in [('x', 'node'), ('y', 'node'), ('z', 'node'), ('tension', 'segment')]:
+        # failed cases have no line output and are left to NaN
+        n = max(r.get(v, np.zeros(0)).size for r in results) if results else 0
+        val = np.full((len(results), n), np.nan)
+        for i, r in enumerate(results):
+            rv = r.get(v, np.zeros(0))
+            val[i, :rv.size] = rv
+        ds[v] = (dims+[dim], val.reshape(shape+(n,)))
+    for v in ['fairten', 't']:
+        ds[v] = (dims, np.array([r.get(v, np.nan) for r in results], dtype=float).reshape(shape))
+    ds['x'].attrs['units'] = 'm'
+    ds['y'].attrs['units'] = 'm'
+    ds['z'].attrs['units'] = 'm'
+    ds['tension'].attrs['units'] = 'N'
+    ds['fairten'].attrs['units'] = 'N'
+    return ds
+
+
+def _case_key(U0, U1, lines):
+    return hashlib.sha1((repr((float(U0), float(U1)))+lines).encode()).hexdigest()
+
+
+def _cache_file(cache_dir, key):
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, key+'.p')
@@ -1,5 +1,7 @@
 
 import sys, os
+import io, re
+import mmap
 from shutil import copyfile
 import ctypes
 import numpy as np
@@ -8,60 +10,276 @@ import pickle
 
 class wrapper():
     # wrappers around C library
+    # platform state and line forces are held in persistent numpy buffers
+    # that are handed to the library without copy (np.ctypeslib)
 
-    def __init__(self):
-        self._lines = ctypes.cdll.LoadLibrary('../compileSO/Lines.so')
+    def __init__(self, lib='../compileSO/Lines.so', ndof=6):
+        self._lines = ctypes.cdll.LoadLibrary(lib)
         # nm -gU ../compileSO/Lines.so | grep Line
         # https://pgi-jcns.fz-juelich.de/portal/pages/using-c-from-python.html
         # https://docs.python.org/3/library/ctypes.html
 
         #print(dir(_lines.LinesInit))
-        self._lines.LinesInit.argtypes = (ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
-                                          ctypes.c_double, ctypes.c_double)
+        _array = np.ctypeslib.ndpointer(dtype=np.float64, ndim=1, flags='C_CONTIGUOUS')
+        self._lines.LinesInit.argtypes = (_array, _array, ctypes.c_double, ctypes.c_double)
 
-        self._lines.LinesCalc.argtypes = (ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
-                                          ctypes.POINTER(ctypes.c_double), ctypes.c_double, ctypes.c_double)
+        self._lines.LinesCalc.argtypes = (_array, _array, _array, ctypes.c_double, ctypes.c_double)
+
+        # plateform position, velocity and forces exerted by the lines
+        self.ndof = ndof
+        self.x = np.zeros(ndof)
+        self.xd = np.zeros(ndof)
+        self.Flines = np.zeros(ndof)
 
     def __del__(self):
         self._lines.LinesClose()
         print('MoorDyn closed')
 
+    def _set_state(self, x, xd):
+        # in place, buffers passed back by the caller are left untouched
+        if x is not self.x:
+            self.x[:] = 0.
+            self.x[:len(x)] = x
+        if xd is not self.xd:
+            self.xd[:] = 0.
+            self.xd[:len(xd)] = xd
+
     def LinesInit(self, x, xd, U0, U1):
         #global _lines
-        nx=len(x)
-        nxd=len(xd)
-        x_array_type = ctypes.c_double * nx
-        xd_array_type = ctypes.c_double * nxd
-        self._lines.LinesInit(x_array_type(), xd_array_type(), ctypes.c_double(U0), ctypes.c_double(U1))
+        self._set_state(x, xd)
+        self._lines.LinesInit(self.x, self.xd, U0, U1)
 
-    def LinesCalc(self, x, xd, Flines, t, dt):
+    def LinesCalc(self, x, xd, Flines=None, t=0., dt=0.):
+        ''' Advance the lines from t to t+dt, x and xd are the plateform
+        position and velocity.
+        Forces are written in Flines if it is a float64 contiguous array of
+        size ndof, in wrapper.Flines otherwise, and returned
+        '''
         #global _lines
-        nx=len(x)
-        nxd=len(xd)
-        nFlines=len(Flines)
-        x_array_type = ctypes.c_double * nx
-        xd_array_type = ctypes.c_double * nxd
-        Flines_array_type = ctypes.c_double * nFlines
-        self._lines.LinesCalc(x_array_type(), xd_array_type(), Flines_array_type(), ctypes.c_double(t), ctypes.c_double(dt))
+        self._set_state(x, xd)
+        if not (isinstance(Flines, np.ndarray) and Flines.dtype==np.float64
+                and Flines.flags['C_CONTIGUOUS'] and Flines.size==self.ndof):
+            Flines = self.Flines
+        self._lines.LinesCalc(self.x, self.xd, Flines, t, dt)
+        return Flines
+
+
+class plateform():
+    ''' Surface source plateform, translations only
+
+    Parameters
+    ----------
+    m: float
+        mass [kg]
+    ma: float
+        added mass [kg]
+    Cd: float
+        drag coefficient
+    A: float
+        cross section for horizontal drag [m^2]
+    Aw: float
+        water plane area, for the vertical restoring force [m^2]
+    rho: float
+        water density [kg/m^3]
+    '''
+
+    def __init__(self, m=50., ma=25., Cd=1., A=.5, Aw=.5, rho=1025.):
+        self.m = m
+        self.ma = ma
+        self.Cd = Cd
+        self.A = A
+        self.Aw = Aw
+        self.rho = rho
+
+    def force(self, x, xd, U):
+        ''' Hydrostatic restoring force and linearized drag coefficients
+        relative to the surface current U (along x): drag is -c*(xd-U)
+
+        Returns
+        -------
+        F: np.ndarray
+            restoring force [N]
+        c: np.ndarray
+            drag coefficients [kg/s]
+        '''
+        ur = xd[:3].copy()
+        ur[0] -= U
+        F = np.array([0., 0., -self.rho*9.81*self.Aw*x[2]])
+        c = .5*self.rho*self.Cd*np.array([self.A, self.A, self.Aw])
+        c[:2] *= np.sqrt(ur[0]**2+ur[1]**2)
+        c[2] *= np.abs(ur[2])
+        return F, c
+
+
+def coupled_time_step(w, p, T, dt, x0=None, xd0=None, U0=0., U1=0.,
+                      forcing=None, dt_store=None, init=True):
+    ''' Time step the plateform dynamics coupled with the mooring lines,
+    MoorDyn is called every dt without any file input/output
+
+    Parameters
+    ----------
+    w: wrapper
+    p: plateform
+    T, dt: float
+        time length and time step [s]
+    x0, xd0: list, optional
+        initial plateform position and velocity (x, y, z), default to 0
+    U0, U1: float
+        surface and bottom current speeds [m/s]
+    forcing: function, optional
+        external force on the plateform f(t, x, xd) [N], e.g. waves
+    dt_store: float, optional
+        storage time interval, defaults to dt
+    init: boolean
+        compute lines initial conditions (LinesInit)
+
+    Returns
+    -------
+    out: dict
+        t, x, xd, Flines arrays with shape (time, 3)
+    '''
+    x, xd, Flines = w.x, w.xd, w.Flines
+    w._set_state(np.zeros(3) if x0 is None else x0,
+                 np.zeros(3) if xd0 is None else xd0)
+    if init:
+        w.LinesInit(x, xd, U0, U1)
+    M = p.m + p.ma
+    Uv = np.array([U0, 0., 0.])
+    #
+    if dt_store is None:
+        dt_store = dt
+    nstep = int(round(T/dt))
+    istore = max(int(round(dt_store/dt)), 1)
+    nt = nstep//istore + 1
+    out = {'t': np.zeros(nt), 'x': np.zeros((nt, 3)), 'xd': np.zeros((nt, 3)),
+           'Flines': np.zeros((nt, 3))}
+    #
+    t = 0.
+    w.LinesCalc(x, xd, Flines, t, 0.)
+    for i in range(nstep+1):
+        if i%istore == 0:
+            j = i//istore
+            out['t'][j] = t
+            out['x'][j] = x[:3]
+            out['xd'][j] = xd[:3]
+            out['Flines'][j] = Flines[:3]
+        if i == nstep:
+            break
+        F, c = p.force(x, xd, U0)
+        F += Flines[:3] + c*Uv
+        if forcing is not None:
+            F += forcing(t, x[:3], xd[:3])
+        # semi-implicit Euler with implicit drag, lines forces are those at
+        # the start of the step
+        xd[:3] = (M*xd[:3] + dt*F)/(M + dt*c)
+        x[:3] += dt*xd[:3]
+        w.LinesCalc(x, xd, Flines, t, dt)
+        t += dt
+    return out
 
 
 # utils
-def read_output():
-    fname='Mooring/Line1.out'
+def read_output(fname='Mooring/Line1.out'):
+    ''' Node positions at the last output time
+    '''
     print('Read: '+fname)
-    f = open(fname, 'r')
+    t, X, _ = read_line_output(fname, nlast=1)
+    return X[0,:,0], X[0,:,1], X[0,:,2], t[0]
+
+def read_line_output(fname='Mooring/Line1.out', t_min=None, t_max=None,
+                     stride=1, nlast=None):
+    ''' Read the time history of a MoorDyn output file
+
+    The file is memory-mapped, only the first column is parsed to select
+    records, selected records are then parsed at once.
+
+    Parameters
+    ----------
+    fname: str
+        MoorDyn output file, e.g. Mooring/Line1.out
+    t_min, t_max: float, optional
+        time window [s]
+    stride: int
+        keep one record every stride within the window
+    nlast: int, optional
+        keep only the nlast last selected records
+
+    Returns
+    -------
+    t: np.ndarray
+        time (time,)
+    X: np.ndarray
+        node positions (time, node, xyz), empty if not in the file
+    other: dict
+        other columns, variables of nodes or segments (e.g. 'Te' for
+        Seg<i>Te) are gathered in (time, node/segment) arrays, remaining
+        columns (e.g. FairTen1) are (time,) arrays
+    '''
+    with open(fname, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = np.frombuffer(mm, dtype=np.uint8)
+    try:
+        # record boundaries
+        ends = np.flatnonzero(buf == ord('\n'))
+        if ends.size == 0 or ends[-1] != buf.size-1:
+            ends = np.append(ends, buf.size)
+        starts = np.concatenate(([0], ends[:-1]+1))
+        keep = ends > starts
+        starts, ends = starts[keep], ends[keep]
+        header = mm[starts[0]:ends[0]].decode().split()
+        starts, ends = starts[1:], ends[1:]
+        # units line
+        if starts.size and buf[starts[0]] == ord('('):
+            starts, ends = starts[1:], ends[1:]
+        # times, from the first token of each record
+        w = np.minimum(starts[:,None] + np.arange(32), buf.size-1)
+        head = buf[w]
+        blank = (head == ord(' ')) | (head == ord('\t')) | (head == ord('\n'))
+        first = starts + np.argmax(blank, axis=1)
+        if np.any(head[:,0] == ord(' ')) or not np.all(np.any(blank, axis=1)):
+            t = np.loadtxt(io.BytesIO(mm[starts[0]:ends[-1]]), usecols=0, ndmin=1)
+        else:
+            t = np.array([mm[a:b] for a, b in zip(starts, first)], dtype=float)
+        # selection
+        idx = np.arange(t.size)
+        if t_min is not None:
+            idx = idx[t[idx] >= t_min]
+        if t_max is not None:
+            idx = idx[t[idx] <= t_max]
+        idx = idx[::stride]
+        if nlast is not None:
+            idx = idx[-nlast:]
+        if idx.size == 0:
+            d = np.zeros((0, len(header)))
+        else:
+            if stride == 1:
+                # contiguous records
+                data = mm[starts[idx[0]]:ends[idx[-1]]]
+            else:
+                data = b'\n'.join(mm[starts[i]:ends[i]] for i in idx)
+            d = np.loadtxt(io.BytesIO(data), ndmin=2)
+    finally:
+        del buf
+        mm.close()
     #
-    header = f.readline().strip().split()
-    for line in f:
-        d = line.strip().split()
-        #print(' '.join(d))
-        d = np.array([float(s) for s in d])
-        t = d[0]
-        x = d[1::3]
-        y = d[2::3]
-        z = d[3::3]
-    f.close()
-    return x, y, z, t
+    t = d[:,0]
+    pos, groups, other = {}, {}, {}
+    for n, name in enumerate(header[1:], start=1):
+        m = re.match(r'(Node|Seg)(\d+)(\w+)$', name)
+        if m is None:
+            other[name] = d[:,n]
+        elif m.group(3) in ['px', 'py', 'pz']:
+            pos.setdefault(int(m.group(2)), [None]*3)['xyz'.index(m.group(3)[1])] = n
+        else:
+            groups.setdefault(m.group(3), []).append((int(m.group(2)), n))
+    if pos:
+        cols = np.array([pos[k] for k in sorted(pos)])
+        X = d[:,cols]
+    else:
+        X = np.zeros((t.size, 0, 3))
+    for var, cols in groups.items():
+        other[var] = d[:,[n for i, n in sorted(cols)]]
+    return t, X, other
 
 def plot_output():
     # look at output
@@ -90,6 +308,7 @@ if __name__ == '__main__':
         # compute solution
         print('Compute a solution')
         #
+        u0, u1 = 0., 0.
         if len(sys.argv)>=3:
             u0 = float(sys.argv[2])
         if len(sys.argv)>=4:
@@ -101,23 +320,41 @@ if __name__ == '__main__':
         #
         plot_output()
 
-    elif sys.argv[1]=='all'
+    elif sys.argv[1]=='all':
+        from mooring_sweep import run_sweep
         pref='run_U_'
         # store lines.txt
         copyfile('Mooring/lines.txt','Mooring/'+pref+'lines.txt')
         #U0 = [0. , 0.,  ,]
         U1 = [.05, .1, .2, .5, 1.]
-        u1=.1
+        # surface and bottom currents are equal, cases run in parallel
+        ds = run_sweep(U1, cache_dir='Mooring/'+pref+'cache',
+                       nc_file='Mooring/'+pref+'all.nc')
+        # per case files read by surface_mooring_plot
         for i, u1 in enumerate(U1):
-            w = wrapper()
-            w.LinesInit(X, Xd, u1, u1)
-            del w
-            x, y, z, t = read_output()
+            x, y, z = [ds[c].isel(U1=i, config=0).dropna('node').values for c in ['x','y','z']]
             f = open('Mooring/'+pref+'%.03d.p'%i, 'wb')
             pickle.dump([u1,u1,x,y,z],f)
             f.close()
 
-
+    elif sys.argv[1]=='coupled':
+        # plateform motions under surface current and waves
+        u0 = float(sys.argv[2]) if len(sys.argv)>=3 else .1
+        u1 = float(sys.argv[3]) if len(sys.argv)>=4 else u0
+        waves = lambda t, x, xd: np.array([0., 0., 100.*np.sin(2.*np.pi*t/8.)])
+        w = wrapper()
+        out = coupled_time_step(w, plateform(), 600., .1, U0=u0, U1=u1,
+                                forcing=waves, dt_store=1.)
+        del w
+        #
+        plt.figure()
+        for i, c in enumerate(['x', 'y', 'z']):
+            ax = plt.subplot(3, 1, i+1)
+            ax.plot(out['t'], out['x'][:,i])
+            ax.set_ylabel(c+' [m]')
+            ax.grid()
+        ax.set_xlabel('t [s]')
+        plt.show()
 
     elif sys.argv[1]=='plot':
         plot_output()
@@ -128,7 +365,7 @@ if __name__ == '__main__':
         os.remove('Mooring/Lines.out')
 
     else:
-        print('command line argument should be absent or \'compute\', \'all\' or  \'plot\' ')
+        print('command line argument should be absent or \'compute\', \'all\', \'coupled\' or  \'plot\' ')
 
 
 